@@ -0,0 +1,82 @@
+"""
+Benchmark the urgency-only /triage path against the full /predict path.
+
+Both endpoints are driven in-process through FastAPI's TestClient with the
+same randomly drawn symptom sets. /predict keeps an LRU cache keyed on the
+symptom tuple, so every request uses a fresh combination to measure real
+inference rather than cache hits.
+
+Run from this directory with:
+    python benchmark_triage.py [--requests 500] [--seed 42]
+"""
+import argparse
+import random
+import statistics
+import time
+
+from fastapi.testclient import TestClient
+
+from main import app, TRIAGE_SLO_MS
+from model_utils import columns, model_inference, urgency_inference
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _summary(name, samples_ms):
+    print(
+        f"{name:<28} p50={_percentile(samples_ms, 50):8.3f}ms  "
+        f"p95={_percentile(samples_ms, 95):8.3f}ms  "
+        f"p99={_percentile(samples_ms, 99):8.3f}ms  "
+        f"mean={statistics.mean(samples_ms):8.3f}ms"
+    )
+
+
+def _time_calls(fn, inputs):
+    samples = []
+    for item in inputs:
+        start = time.perf_counter()
+        fn(item)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    symptom_sets = [rng.sample(columns, rng.randint(2, 6)) for _ in range(args.requests)]
+    client = TestClient(app)
+
+    # Warm up both code paths (model pages, lazy imports) before timing
+    for symptoms in symptom_sets[:10]:
+        client.post("/predict", json={"symptoms": symptoms})
+        client.post("/triage", json={"symptoms": symptoms})
+
+    fresh_sets = [rng.sample(columns, rng.randint(2, 6)) for _ in range(args.requests)]
+
+    print(f"{args.requests} requests per path, triage SLO {TRIAGE_SLO_MS}ms\n")
+    print("In-process function calls:")
+    _summary("model_inference", _time_calls(model_inference, fresh_sets))
+    _summary("urgency_inference", _time_calls(urgency_inference, fresh_sets))
+
+    print("\nHTTP round trips (TestClient):")
+    predict = _time_calls(lambda s: client.post("/predict", json={"symptoms": s}), fresh_sets)
+    triage_responses = []
+    triage = _time_calls(lambda s: triage_responses.append(client.post("/triage", json={"symptoms": s})), fresh_sets)
+    _summary("POST /predict", predict)
+    _summary("POST /triage", triage)
+
+    server_times = [r.json()["processing_time_ms"] for r in triage_responses]
+    within_slo = sum(t <= TRIAGE_SLO_MS for t in server_times) / len(server_times)
+    print(f"\n/triage server-side time within SLO: {within_slo:.1%}")
+    print(f"/triage speedup over /predict at p50: {_percentile(predict, 50) / _percentile(triage, 50):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,49 @@
-from fastapi import FastAPI, Request, HTTPException, status
+from fastapi import FastAPI, Request, HTTPException, Query, status
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field, validator
 from typing import List, Optional, Dict, Any
 import logging
-import traceback
 from contextlib import asynccontextmanager
 from datetime import datetime
 import time
 from functools import lru_cache
+import asyncio
 import os
+import sys
 
-from model_utils import model_inference, extract_symptoms_from_text, columns
-
-# Enhanced logging configuration
-os.makedirs("logs", exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/app.log'),
-        logging.StreamHandler()
-    ]
-)
+# Repository root, for the shared infrastructure package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.structured_logging import configure_logging, RequestLogContextMiddleware
+from shared.responses import FastJSONResponse, CompressionMiddleware, StaticJSONResource
+from shared.rate_limit import RateLimitMiddleware, client_address
+from shared.audit import audit_log_from_env
+from shared.execution import HealthCheckMiddleware, Overloaded, executor_from_env
+
+# Structured JSON logging through a background queue listener. Configured
+# before the model is loaded so start-up messages go through it as well.
+configure_logging("disease-prediction-api", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "app.log"))
 logger = logging.getLogger(__name__)
 
+from model_utils import (
+    model_inference, batch_model_inference, urgency_inference, extract_symptoms_from_text,
+    symptoms_to_mask, mask_to_symptoms, columns, MODEL_VERSION, TRIAGE_MODEL_VERSION
+)
+from session_store import SymptomSessionStore
+from referral import HospitalReferralClient, select_facilities
+
+# Latency objective for the urgency-only triage path, in milliseconds
+TRIAGE_SLO_MS = float(os.getenv("TRIAGE_SLO_MS", "10"))
+
+# Accumulated symptoms per chat session for /webhook
+session_store = SymptomSessionStore(
+    ttl_seconds=float(os.getenv("SESSION_TTL_SECONDS", "1800")),
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", "10000"))
+)
+
 class SymptomInput(BaseModel):
-    symptoms: List[str] = Field(..., min_items=1, max_items=20, description="List of symptoms")
+    symptoms: List[str] = Field(..., min_length=1, max_length=20, description="List of symptoms")
 
     @validator('symptoms')
     def validate_symptoms(cls, v):
@@ -44,22 +61,65 @@ class PredictionResponse(BaseModel):
     processing_time_ms: float
     symptoms_used: List[str]
 
+class TriageResponse(BaseModel):
+    urgency: str
+    timestamp: datetime
+    processing_time_ms: float
+    slo_ms: float
+    symptoms_used: List[str]
+
+class ReferralInput(SymptomInput):
+    lat: float = Field(..., ge=-90, le=90, description="Patient latitude")
+    lon: float = Field(..., ge=-180, le=180, description="Patient longitude")
+    top_n: int = Field(3, ge=1, le=10, description="Number of facilities to return")
+
 class WebhookRequest(BaseModel):
     queryResult: Dict[str, Any]
 
+# Hospital API client for /triage/referral (HOSPITAL_API_URL)
+referral_client = HospitalReferralClient()
+
+# Model inference runs here, off the event loop, with admission control
+# (EXECUTOR_*). Batches are admitted by prediction count: up to 200 (two full
+# batches) at once, so small batches don't each take a full batch's share.
+cpu_executor = executor_from_env({"/predict/batch": 200})
+
+# Write-behind audit trail of predictions and referrals (AUDIT_DB_PATH)
+audit_log = audit_log_from_env("disease-prediction-api")
+
+def _audit_predictions(kind, symptoms, predictions, latency_ms, **fields):
+    """Queue an audit record of a prediction; only touches memory"""
+    audit_log.record(
+        kind,
+        symptom_mask=symptoms_to_mask(symptoms),
+        top_k=[(prediction["disease"], prediction["confidence"]) for prediction in predictions],
+        urgency=predictions[0]["urgency"] if predictions else None,
+        model_version=MODEL_VERSION,
+        latency_ms=latency_ms,
+        **fields
+    )
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    audit_log.start()
     logger.info("Disease Prediction API started and ready to receive requests")
     yield
+    await referral_client.close()
+    await asyncio.to_thread(audit_log.close)
+    cpu_executor.shutdown(wait=False)
     logger.info("Disease Prediction API is shutting down")
 
 app = FastAPI(
     title="Disease Prediction API",
     description="AI-powered disease prediction based on symptoms",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
+# Per-client limits (RATE_LIMIT_*); innermost, so 429s still get CORS headers
+app.add_middleware(RateLimitMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -67,28 +127,46 @@ app.add_middleware(
     allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestLogContextMiddleware)
+app.add_middleware(CompressionMiddleware)
 
-class SymptomInput(BaseModel):
-    symptoms: List[str]
+def health_status():
+    return {"status": "healthy", "service": "disease-prediction-api", "executor": cpu_executor.stats()}
+
+# Outermost: health checks are answered even while the executor is saturated
+app.add_middleware(HealthCheckMiddleware, status=health_status)
+
+class BatchSymptomInput(BaseModel):
+    requests: List[SymptomInput] = Field(..., min_length=1, max_length=100, description="Symptom lists to predict for")
+    explain: bool = Field(False, description="Attach per-symptom contributions to each prediction")
+
+class BatchPredictionResponse(BaseModel):
+    results: List[Dict[str, Any]]
+    timestamp: datetime
+    processing_time_ms: float
 
 @lru_cache(maxsize=1000)
-def cached_model_inference(symptoms_tuple):
+def cached_model_inference(symptoms_tuple, explain=False):
     """Cached version of model inference for better performance"""
-    return model_inference(list(symptoms_tuple))
+    return model_inference(list(symptoms_tuple), explain=explain)
 
 @app.post("/predict", response_model=PredictionResponse)
-async def predict_disease(input: SymptomInput):
+async def predict_disease(
+    input: SymptomInput,
+    explain: bool = Query(False, description="Attach per-symptom contributions to each prediction")
+):
     """
     Predict diseases based on symptoms.
 
     - **symptoms**: List of symptoms (1-20 items)
+    - **explain**: Include how much each reported symptom drove each disease
 
     Returns predictions with confidence scores and urgency levels.
     """
     start_time = time.time()
 
     try:
-        logger.info(f"Prediction request with symptoms: {input.symptoms}")
+        logger.info("Prediction request with symptoms: %s", input.symptoms)
 
         # Validate symptoms against known symptoms
         valid_symptoms = [s for s in input.symptoms if s in columns]
@@ -100,60 +178,293 @@ async def predict_disease(input: SymptomInput):
 
         # Use cached inference for better performance
         symptoms_tuple = tuple(sorted(valid_symptoms))
-        predictions = cached_model_inference(symptoms_tuple)
+        predictions = await cpu_executor.run("/predict", cached_model_inference, symptoms_tuple, explain)
 
         processing_time = (time.time() - start_time) * 1000
+        _audit_predictions("prediction", valid_symptoms, predictions, processing_time)
 
-        response = PredictionResponse(
-            predictions=predictions,
-            timestamp=datetime.now(),
-            processing_time_ms=round(processing_time, 2),
-            symptoms_used=valid_symptoms
-        )
+        # Returned as a response directly: the fields already match
+        # PredictionResponse, so re-validating them on every call is wasted work
+        response = FastJSONResponse({
+            "predictions": predictions,
+            "timestamp": datetime.now(),
+            "processing_time_ms": round(processing_time, 2),
+            "symptoms_used": valid_symptoms
+        })
 
-        logger.info(f"Prediction completed in {processing_time:.2f}ms")
+        logger.info("Prediction completed in %.2fms", processing_time)
         return response
 
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Prediction error: {e}\n{traceback.format_exc()}")
+        logger.exception("Prediction error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Prediction failed: {str(e)}"
         )
 
 
+@app.post("/predict/batch", response_model=BatchPredictionResponse)
+async def predict_disease_batch(input: BatchSymptomInput):
+    """
+    Predict diseases for several symptom lists in a single model pass.
+
+    - **requests**: List of `{"symptoms": [...]}` objects (1-100 items)
+    - **explain**: Include per-symptom contributions for every prediction
+
+    Results are returned in input order. Items without any known symptom get
+    an `error` instead of predictions.
+    """
+    start_time = time.time()
+
+    try:
+        valid_lists = [
+            [s for s in item.symptoms if s in columns]
+            for item in input.requests
+        ]
+        known = [symptoms for symptoms in valid_lists if symptoms]
+        predictions = iter(
+            await cpu_executor.run_weighted(
+                "/predict/batch", len(known), batch_model_inference, known, explain=input.explain
+            ) if known else []
+        )
+
+        results = []
+        for symptoms in valid_lists:
+            if symptoms:
+                results.append({"symptoms_used": symptoms, "predictions": next(predictions)})
+            else:
+                results.append({
+                    "symptoms_used": [],
+                    "predictions": [],
+                    "error": "No valid symptoms found. Please check symptom names."
+                })
+
+        processing_time = (time.time() - start_time) * 1000
+        for result in results:
+            if result["predictions"]:
+                _audit_predictions("prediction", result["symptoms_used"], result["predictions"], processing_time)
+        logger.info("Batch prediction of %d items completed in %.2fms", len(results), processing_time)
+        return FastJSONResponse({
+            "results": results,
+            "timestamp": datetime.now(),
+            "processing_time_ms": round(processing_time, 2)
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Batch prediction error: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Batch prediction failed: {str(e)}"
+        )
+
+
+@app.post("/triage", response_model=TriageResponse)
+async def triage(input: SymptomInput):
+    """
+    Urgency-only prediction for emergency intake.
+
+    - **symptoms**: List of symptoms
+
+    Runs only the urgency model (the distilled triage tree when available),
+    skipping disease ranking entirely. Targets `TRIAGE_SLO_MS` server-side;
+    slower requests are logged as SLO breaches.
+    """
+    start_time = time.perf_counter()
+
+    valid_symptoms = [s for s in input.symptoms if s in columns]
+    if not valid_symptoms:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No valid symptoms found. Please check symptom names."
+        )
+
+    try:
+        # Inline: one shallow tree is quicker to evaluate than a hand-off to the executor
+        urgency = urgency_inference(valid_symptoms)
+    except Exception as e:
+        logger.exception("Triage error: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Triage failed: {str(e)}"
+        )
+
+    processing_time = (time.perf_counter() - start_time) * 1000
+    if processing_time > TRIAGE_SLO_MS:
+        logger.warning("Triage SLO breach: %.2fms > %sms", processing_time, TRIAGE_SLO_MS)
+    audit_log.record(
+        "triage",
+        symptom_mask=symptoms_to_mask(valid_symptoms),
+        urgency=urgency,
+        model_version=TRIAGE_MODEL_VERSION,
+        latency_ms=processing_time
+    )
+
+    return FastJSONResponse({
+        "urgency": urgency,
+        "timestamp": datetime.now(),
+        "processing_time_ms": round(processing_time, 3),
+        "slo_ms": TRIAGE_SLO_MS,
+        "symptoms_used": valid_symptoms
+    })
+
+
+async def _timed(awaitable):
+    """Result of an awaitable and how long it took, in milliseconds"""
+    start = time.perf_counter()
+    result = await awaitable
+    return result, (time.perf_counter() - start) * 1000
+
+
+@app.post("/triage/referral")
+async def triage_referral(input: ReferralInput, request: Request):
+    """
+    Disease prediction and facility referral in one round trip.
+
+    - **symptoms**: List of symptoms
+    - **lat**, **lon**: Patient location
+    - **top_n**: Number of facilities to return (1-10)
+
+    Model inference runs concurrently with a speculative Hospital API search
+    for every facility tier; the predicted urgency then picks the tier
+    (High: hospitals, Medium: medical centres and up, Low: any facility).
+    If the Hospital API is unavailable the predictions are still returned,
+    with an empty facility list and a `referral_error`.
+    """
+    start_time = time.perf_counter()
+
+    valid_symptoms = [s for s in input.symptoms if s in columns]
+    if not valid_symptoms:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No valid symptoms found. Please check symptom names."
+        )
+
+    inference, search = await asyncio.gather(
+        _timed(cpu_executor.run("/triage/referral", cached_model_inference, tuple(sorted(valid_symptoms)))),
+        _timed(referral_client.nearest_by_category(input.lat, input.lon, input.top_n, client_address(request.scope))),
+        return_exceptions=True
+    )
+
+    if isinstance(inference, HTTPException):
+        raise inference
+    if isinstance(inference, Exception):
+        logger.error("Referral prediction error: %s", inference)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Prediction failed: {str(inference)}"
+        )
+    predictions, inference_ms = inference
+    urgency = predictions[0]["urgency"]
+
+    referral_error = None
+    if isinstance(search, Exception):
+        logger.warning("Hospital API unavailable for referral: %s", search)
+        nearest_by_category, search_ms = {}, None
+        referral_error = f"Hospital search failed: {str(search)}"
+    else:
+        nearest_by_category, search_ms = search
+    tier, categories, facilities = select_facilities(urgency, nearest_by_category, input.top_n)
+
+    processing_time = (time.perf_counter() - start_time) * 1000
+    logger.info("Triage referral (%s -> %s) completed in %.2fms", urgency, tier, processing_time)
+    _audit_predictions(
+        "referral", valid_symptoms, predictions, processing_time,
+        lat=input.lat, lon=input.lon, facilities=[facility["facility_id"] for facility in facilities]
+    )
+    body = {
+        "urgency": urgency,
+        "predictions": predictions,
+        "referral": {
+            "tier": tier,
+            "categories": list(categories) if categories else None,
+            "facilities": facilities
+        },
+        "timestamp": datetime.now(),
+        "processing_time_ms": round(processing_time, 2),
+        "stage_times_ms": {
+            "inference": round(inference_ms, 2),
+            "hospital_search": round(search_ms, 2) if search_ms is not None else None
+        },
+        "symptoms_used": valid_symptoms
+    }
+    if referral_error:
+        body["referral_error"] = referral_error
+    return FastJSONResponse(body)
+
+
 @app.post("/webhook")
 async def webhook(request: Request):
+    """
+    Chat fulfillment endpoint.
+
+    When the body carries a `session` id (as Dialogflow requests do), only
+    this turn's text is parsed; its symptoms are merged into the session's
+    accumulated symptoms and the combined set is re-scored.
+    """
     try:
         body = await request.json()
         user_query = body.get('queryResult', {}).get('queryText', '')
+        session_id = body.get('session')
         matched_symptoms = extract_symptoms_from_text(user_query)
 
+        if session_id:
+            mask = session_store.merge(session_id, symptoms_to_mask(matched_symptoms))
+            matched_symptoms = mask_to_symptoms(mask)
+
         if not matched_symptoms:
             return JSONResponse({"fulfillmentText": "Error: No known symptoms detected in your query."})
 
-        predictions = model_inference(matched_symptoms)
+        # Memoized on the symptom set, so a turn that adds nothing new is free
+        start_time = time.perf_counter()
+        predictions = await cpu_executor.run("/webhook", cached_model_inference, tuple(sorted(matched_symptoms)))
+        _audit_predictions(
+            "chat_prediction", matched_symptoms, predictions, (time.perf_counter() - start_time) * 1000
+        )
 
         # Build human-friendly message
         response_lines = ["🤖 Based on your symptoms, here are possible conditions:"]
         for i, pred in enumerate(predictions, 1):
             line = f"{i}. 🦠 {pred['disease']} — Urgency: {pred['urgency']} (Confidence: {pred['confidence']}%)"
             response_lines.append(line)
+        if session_id:
+            noted = ", ".join(symptom.replace("_", " ") for symptom in matched_symptoms)
+            response_lines.append(f"📝 Symptoms noted so far: {noted}")
 
         return JSONResponse({"fulfillmentText": "\n".join(response_lines)})
+    except Overloaded as e:
+        # Chat platforms expect a 200 with a message to relay
+        return JSONResponse({"fulfillmentText": f"⏳ We're handling a lot of requests, please try again in {e.retry_after}s."})
     except Exception as e:
-        logging.error(f"Webhook error: {e}\n{traceback.format_exc()}")
+        logger.exception("Webhook error: %s", e)
         return JSONResponse({"fulfillmentText": f"Error: {str(e)}"})
 
 
+_symptoms_resource = None
+
 @app.get("/symptoms")
-async def get_symptoms():
+async def get_symptoms(request: Request):
+    """
+    Symptom vocabulary the model understands.
+
+    Serialized once per model; clients revalidating with If-None-Match get a
+    bodyless 304 while the vocabulary is unchanged.
+    """
+    global _symptoms_resource
     try:
         if columns is None:
             raise ValueError("Symptoms list is not available")
-        return JSONResponse(content=columns)
+        if _symptoms_resource is None or _symptoms_resource.payload is not columns:
+            _symptoms_resource = StaticJSONResource(columns)
+        return _symptoms_resource.response(request)
     except Exception as e:
-        logging.error(f"Symptoms route error: {e}\n{traceback.format_exc()}")
+        logger.exception("Symptoms route error: %s", e)
         return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.get("/health")
+async def health_check():
+    """Liveness probe, with the executor's load; served by HealthCheckMiddleware ahead of routing"""
+    return health_status()
@@ -1,50 +1,183 @@
+import hashlib
 import joblib
 import numpy as np
 import pandas as pd
 import logging
 import os
+from functools import lru_cache
 
-os.makedirs("logs", exist_ok=True)
-logging.basicConfig(filename='logs/app.log', level=logging.INFO,
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+from explainer import TreePathExplainer
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = "models/disease_urgency_model.pkl"
 
 # Load models and encoders
-model = joblib.load("models/disease_urgency_model.pkl")
+model = joblib.load(MODEL_PATH)
 disease_encoder = joblib.load("models/disease_encoder.pkl")
 urgency_encoder = joblib.load("models/urgency_encoder.pkl")
 columns = pd.read_csv("models/Training_with_Urgency.csv").drop(['Disease', 'Urgency_Level'], axis=1).columns.tolist()
 
-import numpy as np
-import pandas as pd
-import logging
+# Distilled single-tree urgency model for /triage (written by model_training.py).
+# Falls back to the full forest's urgency estimator when it hasn't been trained.
+TRIAGE_MODEL_PATH = "models/urgency_triage_model.pkl"
+if os.path.exists(TRIAGE_MODEL_PATH):
+    triage_model = joblib.load(TRIAGE_MODEL_PATH)
+else:
+    logger.warning("%s not found, triage will use the full urgency forest", TRIAGE_MODEL_PATH)
+    triage_model = model.estimators_[1]
+
+_column_index = {symptom: i for i, symptom in enumerate(columns)}
+
+
+def _file_version(path):
+    """Short content digest of a model file, identifying it in the audit trail"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+# Recorded with every audited prediction; MODEL_VERSION overrides the digest
+MODEL_VERSION = os.getenv("MODEL_VERSION") or _file_version(MODEL_PATH)
+TRIAGE_MODEL_VERSION = _file_version(TRIAGE_MODEL_PATH) if os.path.exists(TRIAGE_MODEL_PATH) else MODEL_VERSION
+
+
+@lru_cache(maxsize=1)
+def get_explainer():
+    """Tree-path explainer for the disease estimator, built once per model"""
+    return TreePathExplainer(model.estimators_[0])
+
+
+def build_input_frame(symptom_lists):
+    """Binary symptom matrix (one row per symptom list) in training column order"""
+    matrix = np.zeros((len(symptom_lists), len(columns)), dtype=np.int64)
+    for row, symptom_list in enumerate(symptom_lists):
+        for symptom in symptom_list:
+            idx = _column_index.get(symptom)
+            if idx is not None:
+                matrix[row, idx] = 1
+    return pd.DataFrame(matrix, columns=columns)
+
+
+def symptoms_to_mask(symptom_list):
+    """Encode symptoms as an integer bitmask (bit i <=> columns[i])"""
+    mask = 0
+    for symptom in symptom_list:
+        idx = _column_index.get(symptom)
+        if idx is not None:
+            mask |= 1 << idx
+    return mask
+
+
+def mask_to_symptoms(mask):
+    """Decode a symptom bitmask back into column names, in column order"""
+    symptoms = []
+    while mask:
+        low_bit = mask & -mask
+        symptoms.append(columns[low_bit.bit_length() - 1])
+        mask ^= low_bit
+    return symptoms
+
+
+def _explanation(contributions, input_row, bias):
+    """Split one class's contributions into reported symptoms vs. everything else"""
+    reported = np.flatnonzero(input_row)
+    symptom_contributions = sorted(
+        (
+            {"symptom": columns[i], "contribution": round(float(contributions[i]) * 100, 2)}
+            for i in reported
+        ),
+        key=lambda item: -abs(item["contribution"]),
+    )
+    absent = float(contributions.sum() - contributions[reported].sum())
+    return {
+        "baseline": round(float(bias) * 100, 2),
+        "symptom_contributions": symptom_contributions,
+        "absent_symptoms": round(absent * 100, 2),
+    }
+
+
+def batch_model_inference(symptom_lists, top_k=3, explain=False):
+    """
+    Predict the top diseases and the urgency level for several symptom lists at once.
+
+    Args:
+        symptom_lists: List of symptom lists (column names)
+        top_k: Number of diseases to return per symptom list
+        explain: Attach per-symptom contributions to each predicted disease
+
+    Returns:
+        One list of prediction dicts per input, in input order
+    """
+    input_df = build_input_frame(symptom_lists)
+
+    # Only the urgency estimator is needed here; model.predict() would also
+    # run the disease estimator a second time.
+    urgency_levels = urgency_encoder.inverse_transform(model.estimators_[1].predict(input_df))
+
+    if explain:
+        # The decision paths give the probabilities too, so they replace the
+        # predict_proba() call instead of adding a second pass over the forest.
+        explainer = get_explainer()
+        disease_probs, top_indices, contributions = explainer.explain(input_df, top_k)
+    else:
+        disease_probs = model.estimators_[0].predict_proba(input_df)
+        top_indices = np.argsort(-disease_probs, axis=1)[:, :top_k]
+
+    input_matrix = input_df.to_numpy()
+    results = []
+    for row, urgency_level in enumerate(urgency_levels):
+        top_predictions = []
+        for rank, idx in enumerate(top_indices[row]):
+            prediction = {
+                "disease": disease_encoder.classes_[idx],
+                "confidence": round(float(disease_probs[row, idx]) * 100, 1),
+                "urgency": urgency_level
+            }
+            if explain:
+                prediction["explanation"] = _explanation(
+                    contributions[row, rank], input_matrix[row], explainer.bias[idx]
+                )
+            top_predictions.append(prediction)
+        results.append(top_predictions)
+
+    logger.debug("Predicted: %s", results)
+    return results
+
+
+def model_inference(symptom_list, top_k=3, explain=False):
+    return batch_model_inference([symptom_list], top_k=top_k, explain=explain)[0]
+
+
+def _tree_predict(estimator, active_features):
+    """Walk one binary-feature decision tree directly, skipping sklearn's input validation"""
+    tree = estimator.tree_
+    node = 0
+    while tree.children_left[node] != -1:
+        value = 1 if tree.feature[node] in active_features else 0
+        if value <= tree.threshold[node]:
+            node = tree.children_left[node]
+        else:
+            node = tree.children_right[node]
+    return estimator.classes_[int(np.argmax(tree.value[node, 0]))]
+
+
+def urgency_inference(symptom_list):
+    """
+    Predict only the urgency level, for emergency triage.
 
-def model_inference(symptom_list):
-    # Create binary feature vector for symptoms
-    input_vector = [1 if symptom in symptom_list else 0 for symptom in columns]
-    input_df = pd.DataFrame([input_vector], columns=columns)
-
-    # Predict [disease_id, urgency_id]
-    predicted = model.predict(input_df)[0]
-    urgency_pred = predicted[1]
-    urgency_level = urgency_encoder.inverse_transform([urgency_pred])[0]
-
-    # Get probabilities from disease estimator (assumed to be model.estimators_[0])
-    disease_probs = model.estimators_[0].predict_proba(input_df)[0]
-
-    # Get top 3 diseases with confidence
-    top_indices = np.argsort(-disease_probs)[:3]
-    top_predictions = []
-    for idx in top_indices:
-        disease = disease_encoder.classes_[idx]  # ✅ Correct usage
-        confidence = round(float(disease_probs[idx]) * 100, 1)
-        top_predictions.append({
-            "disease": disease,
-            "confidence": confidence,
-            "urgency": urgency_level
-        })
-
-    logging.info(f"Predicted: {top_predictions}")
-    return top_predictions
+    Skips the disease estimator, top-k ranking and disease decoding entirely.
+    With the distilled triage tree this is a handful of array lookups; with
+    the forest fallback it is a single predict() on the urgency estimator.
+    """
+    if hasattr(triage_model, "tree_"):
+        active = {_column_index[s] for s in symptom_list if s in _column_index}
+        urgency_id = _tree_predict(triage_model, active)
+    else:
+        urgency_id = triage_model.predict(build_input_frame([symptom_list]))[0]
+    return urgency_encoder.classes_[urgency_id]
 
 
 
@@ -0,0 +1,113 @@
+"""
+Client for the Hospital Referral API, used by the combined /triage/referral
+endpoint.
+
+The facility tier a patient should be sent to depends on the urgency the
+model predicts, but waiting for the prediction before querying the Hospital
+API would serialize the two calls. Instead the nearest facilities of every
+tier are fetched speculatively, in one POST /recommend-hospitals/batch
+request (one query per facility category a tier can use, plus one
+unfiltered query), while inference runs. Once the urgency is known, the
+matching tier's lists are merged by distance; each per-category list holds
+that category's top_n nearest, so the merged top_n is exact.
+
+The Hospital API rate-limits per client. With INTERNAL_API_TOKEN set on
+both services, each lookup carries the token and the end client's address
+(see shared/rate_limit.py), so it counts against that client's limit
+rather than one bucket shared by every user of this API.
+"""
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from shared.rate_limit import internal_client_headers
+
+logger = logging.getLogger(__name__)
+
+HOSPITAL_API_URL = os.getenv("HOSPITAL_API_URL", "http://localhost:8001")
+HOSPITAL_API_TIMEOUT_SECONDS = float(os.getenv("HOSPITAL_API_TIMEOUT_SECONDS", "5"))
+
+# Urgency level -> (tier name, facility categories it may use; None for any)
+URGENCY_TIERS: Dict[str, Tuple[str, Optional[Tuple[str, ...]]]] = {
+    "High": ("hospital", ("district_hospital", "regional_hospital", "central_hospital")),
+    "Medium": ("medical_centre", ("medical_centre", "district_hospital", "regional_hospital", "central_hospital")),
+    "Low": ("primary_care", None),
+}
+
+# Every category any tier uses, then the unfiltered query (None)
+_QUERY_CATEGORIES: List[Optional[str]] = sorted({
+    category for _, categories in URGENCY_TIERS.values() for category in (categories or ())
+}) + [None]
+
+
+def tier_for(urgency: str) -> Tuple[str, Optional[Tuple[str, ...]]]:
+    """Tier for an urgency level; unknown levels get the most capable tier"""
+    return URGENCY_TIERS.get(urgency, URGENCY_TIERS["High"])
+
+
+def select_facilities(
+    urgency: str, nearest_by_category: Dict[Optional[str], List[Dict]], top_n: int
+) -> Tuple[str, Optional[Tuple[str, ...]], List[Dict]]:
+    """
+    The top_n nearest facilities of the urgency's tier.
+
+    Returns:
+        Tuple of (tier name, its categories, facilities nearest first)
+    """
+    tier, categories = tier_for(urgency)
+    if categories is None:
+        return tier, categories, nearest_by_category.get(None, [])[:top_n]
+    merged = [facility for category in categories for facility in nearest_by_category.get(category, [])]
+    merged.sort(key=lambda facility: (facility["distance_km"], facility.get("facility_id", 0)))
+    return tier, categories, merged[:top_n]
+
+
+class HospitalReferralClient:
+    """Async client for the Hospital API's batch search, with one pooled connection set"""
+
+    def __init__(
+        self,
+        base_url: str = HOSPITAL_API_URL,
+        timeout: float = HOSPITAL_API_TIMEOUT_SECONDS,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use so it binds to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, transport=self.transport)
+        return self._client
+
+    async def nearest_by_category(
+        self, lat: float, lon: float, top_n: int, client: Optional[str] = None
+    ) -> Dict[Optional[str], List[Dict]]:
+        """
+        Nearest top_n facilities of each category a tier can use, and of any category.
+
+        Args:
+            client: Address of the end client the lookup is made for, for the Hospital API's rate limit
+        """
+        queries = [
+            {"lat": lat, "lon": lon, "top_n": top_n, **({"category": category} if category else {})}
+            for category in _QUERY_CATEGORIES
+        ]
+        response = await self.client.post(
+            "/recommend-hospitals/batch",
+            # Only the facilities finally referred to are audited, by /triage/referral
+            json={"queries": queries, "speculative": True},
+            headers=internal_client_headers(client),
+        )
+        response.raise_for_status()
+        return dict(zip(_QUERY_CATEGORIES, response.json()["results"]))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,71 @@
+"""
+Server-side chat session state for the /webhook conversation flow.
+
+Each chat session is reduced to a single integer bitmask over the model's
+symptom columns (bit i set <=> columns[i] has been mentioned at some point
+in the conversation). A new turn only needs its own text run through the
+symptom extractor; the result is OR-ed into the session's mask and the
+merged mask is re-scored. Per-turn cost therefore depends on the length of
+the new message, not on how long the conversation has been going.
+
+Sessions live in an OrderedDict kept in least-recently-used order. Every
+access refreshes a session's expiry and moves it to the end, so with a
+single TTL the front of the dict is also the next to expire: purging stale
+sessions and evicting over-capacity ones both only ever pop from the front.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class SymptomSessionStore:
+    """Per-session symptom bitmasks with TTL expiry and LRU eviction"""
+
+    def __init__(self, ttl_seconds: float = 1800, max_sessions: int = 10000, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._clock = clock
+        self._sessions = OrderedDict()  # session_id -> (mask, expires_at)
+        self._lock = threading.Lock()
+
+    def _purge_expired(self, now: float):
+        while self._sessions:
+            session_id, (_, expires_at) = next(iter(self._sessions.items()))
+            if expires_at > now:
+                break
+            self._sessions.popitem(last=False)
+
+    def get(self, session_id: str) -> Optional[int]:
+        """Current mask for a session, or None if unknown or expired"""
+        with self._lock:
+            now = self._clock()
+            self._purge_expired(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (entry[0], now + self.ttl_seconds)
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def merge(self, session_id: str, mask: int) -> int:
+        """OR a turn's symptom mask into the session and return the accumulated mask"""
+        with self._lock:
+            now = self._clock()
+            self._purge_expired(now)
+            entry = self._sessions.pop(session_id, None)
+            merged = (entry[0] if entry else 0) | mask
+            self._sessions[session_id] = (merged, now + self.ttl_seconds)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return merged
+
+    def clear(self, session_id: str):
+        """Forget a session"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            self._purge_expired(self._clock())
+            return len(self._sessions)
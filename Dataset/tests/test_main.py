@@ -1,4 +1,5 @@
 import pytest
+import json
 from fastapi.testclient import TestClient
 from main import app
 
@@ -21,8 +22,21 @@ def test_predict_disease_success():
 def test_predict_disease_empty_symptoms():
     """Test prediction with empty symptoms list"""
     response = client.post("/predict", json={"symptoms": []})
-    assert response.status_code == 400
-    assert response.json()["detail"] == "No valid symptoms found. Please check symptom names."
+    assert response.status_code == 422
+
+def test_symptom_inputs_are_validated_everywhere():
+    """Every endpoint normalizes symptoms and enforces the list limits"""
+    response = client.post("/triage", json={"symptoms": ["  Chest_Pain ", "BREATHLESSNESS"]})
+    assert response.status_code == 200
+    assert response.json()["symptoms_used"] == ["chest_pain", "breathlessness"]
+
+    batch = client.post("/predict/batch", json={"requests": [{"symptoms": [" Cough "]}]})
+    assert batch.status_code == 200
+    assert batch.json()["results"][0]["symptoms_used"] == ["cough"]
+
+    assert client.post("/predict/batch", json={"requests": [{"symptoms": ["cough"] * 21}]}).status_code == 422
+    assert client.post("/triage", json={"symptoms": ["  "]}).status_code == 422
+    assert client.post("/predict/batch", json={"requests": []}).status_code == 422
 
 def test_predict_disease_invalid_input():
     """Test prediction with invalid input format"""
@@ -75,3 +89,297 @@ def test_get_symptoms_error_handling(monkeypatch):
     response = client.get("/symptoms")
     assert response.status_code == 500
     assert "error" in response.json()
+
+def test_predict_disease_with_explanation():
+    """Explanations decompose each confidence into baseline + symptom contributions"""
+    response = client.post("/predict?explain=true", json={"symptoms": ["high_fever", "headache", "vomiting"]})
+    assert response.status_code == 200
+    for pred in response.json()["predictions"]:
+        explanation = pred["explanation"]
+        reported = {c["symptom"] for c in explanation["symptom_contributions"]}
+        assert reported == {"high_fever", "headache", "vomiting"}
+        total = explanation["baseline"] + explanation["absent_symptoms"] + sum(
+            c["contribution"] for c in explanation["symptom_contributions"]
+        )
+        assert abs(total - pred["confidence"]) < 0.5
+
+def test_explainer_matches_predict_proba():
+    """Tree-path contributions reproduce the forest's probabilities exactly"""
+    import numpy as np
+    from model_utils import model, build_input_frame, get_explainer
+
+    X = build_input_frame([["high_fever", "headache"], ["cough", "chills", "fatigue"]])
+    explainer = get_explainer()
+    probabilities, top_classes, contributions = explainer.explain(X, top_k=3)
+    expected = model.estimators_[0].predict_proba(X)
+    np.testing.assert_allclose(probabilities, expected, atol=1e-9)
+    reconstructed = explainer.bias[top_classes] + contributions.sum(axis=2)
+    np.testing.assert_allclose(reconstructed, np.take_along_axis(expected, top_classes, axis=1), atol=1e-9)
+
+def test_predict_batch_preserves_order():
+    """Batch predictions come back in input order and match single predictions"""
+    batch = [["high_fever", "headache"], ["not_a_symptom"], ["cough", "fatigue"]]
+    response = client.post("/predict/batch", json={"requests": [{"symptoms": s} for s in batch]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 3
+    assert "error" in results[1]
+    for idx in (0, 2):
+        single = client.post("/predict", json={"symptoms": batch[idx]}).json()["predictions"]
+        assert results[idx]["predictions"] == single
+
+def test_predict_batch_with_explanation():
+    """Batch requests support explanation mode"""
+    response = client.post(
+        "/predict/batch",
+        json={"requests": [{"symptoms": ["cough"]}, {"symptoms": ["itching", "skin_rash"]}], "explain": True}
+    )
+    assert response.status_code == 200
+    for result in response.json()["results"]:
+        assert all("explanation" in pred for pred in result["predictions"])
+
+def test_triage_success():
+    """Triage returns only an urgency level within the known classes"""
+    from model_utils import urgency_encoder
+    response = client.post("/triage", json={"symptoms": ["high_fever", "headache", "vomiting"]})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["urgency"] in urgency_encoder.classes_
+    assert body["symptoms_used"] == ["high_fever", "headache", "vomiting"]
+    assert body["slo_ms"] > 0
+    assert "predictions" not in body
+
+def test_triage_no_valid_symptoms():
+    """Triage rejects inputs without any known symptom"""
+    response = client.post("/triage", json={"symptoms": ["spaghetti"]})
+    assert response.status_code == 400
+
+def test_triage_tree_walk_matches_sklearn():
+    """The direct tree walk used by triage agrees with sklearn's predict"""
+    import numpy as np
+    from model_utils import model, build_input_frame, _tree_predict
+
+    tree = model.estimators_[1].estimators_[0]
+    symptom_lists = [["high_fever", "headache"], ["cough", "chills"], ["chest_pain", "breathlessness", "sweating"]]
+    X = build_input_frame(symptom_lists)
+    expected = tree.predict(X)
+    for row, symptoms in enumerate(symptom_lists):
+        active = set(np.flatnonzero(X.iloc[row].to_numpy()))
+        assert _tree_predict(tree, active) == expected[row]
+
+def test_triage_forest_fallback_matches_predict(monkeypatch):
+    """Without a distilled model, triage uses the full model's urgency estimator"""
+    import model_utils
+    monkeypatch.setattr(model_utils, "triage_model", model_utils.model.estimators_[1])
+    symptoms = ["itching", "skin_rash", "nodal_skin_eruptions"]
+    assert model_utils.urgency_inference(symptoms) == model_utils.model_inference(symptoms)[0]["urgency"]
+
+def test_webhook_session_accumulates_symptoms():
+    """Symptoms from earlier turns of a session are kept for later turns"""
+    session = "projects/test/agent/sessions/accumulate"
+    first = client.post("/webhook", json={"session": session, "queryResult": {"queryText": "I have a bad headache"}})
+    assert "headache" in first.json()["fulfillmentText"]
+
+    second = client.post("/webhook", json={"session": session, "queryResult": {"queryText": "and now I keep vomiting"}})
+    msg = second.json()["fulfillmentText"]
+    assert "Symptoms noted so far" in msg
+    assert "headache" in msg and "vomiting" in msg
+
+    # A turn without new symptoms still answers from the accumulated state
+    third = client.post("/webhook", json={"session": session, "queryResult": {"queryText": "what should I do?"}})
+    assert "🦠" in third.json()["fulfillmentText"]
+
+def test_webhook_sessions_are_isolated():
+    """Different sessions do not share symptoms"""
+    client.post("/webhook", json={"session": "iso-a", "queryResult": {"queryText": "I have a cough"}})
+    response = client.post("/webhook", json={"session": "iso-b", "queryResult": {"queryText": "hello there"}})
+    assert "No known symptoms detected" in response.json()["fulfillmentText"]
+
+def test_symptom_mask_roundtrip():
+    """Bitmask encoding preserves the symptom set in column order"""
+    from model_utils import symptoms_to_mask, mask_to_symptoms, columns
+    symptoms = [columns[-1], columns[0], columns[40], "unknown_symptom"]
+    assert mask_to_symptoms(symptoms_to_mask(symptoms)) == [columns[0], columns[40], columns[-1]]
+
+def test_session_store_ttl_and_lru():
+    """Sessions expire after their TTL and the least recently used is evicted first"""
+    from session_store import SymptomSessionStore
+    now = [0.0]
+    store = SymptomSessionStore(ttl_seconds=10, max_sessions=2, clock=lambda: now[0])
+    assert store.merge("a", 0b01) == 0b01
+    assert store.merge("a", 0b10) == 0b11
+    store.merge("b", 0b100)
+    store.get("a")              # "b" is now least recently used
+    store.merge("c", 0b1000)
+    assert store.get("b") is None
+    assert store.get("a") == 0b11
+
+    now[0] = 25.0
+    assert store.get("a") is None
+    assert len(store) == 0
+
+def test_get_symptoms_etag_revalidation():
+    """Unchanged symptom vocabulary revalidates to a bodyless 304"""
+    first = client.get("/symptoms")
+    etag = first.headers["etag"]
+    assert etag
+    second = client.get("/symptoms", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.content == b""
+    assert second.headers["etag"] == etag
+
+def test_large_responses_are_compressed():
+    """Responses above the size threshold are compressed when the client accepts it"""
+    response = client.get("/symptoms", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert isinstance(response.json(), list)
+
+    small = client.post("/triage", json={"symptoms": ["cough"]}, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+
+def _hospital_transport(delay=0.0, fail=False, seen=None, requests=None):
+    """Mock Hospital API batch endpoint: facility i of a query is (i + 1) km away"""
+    import asyncio
+    import httpx
+
+    async def handler(request):
+        if requests is not None:
+            requests.append(request)
+        await asyncio.sleep(delay)
+        if fail:
+            return httpx.Response(503, json={"detail": "unavailable"})
+        queries = json.loads(request.content)["queries"]
+        if seen is not None:
+            seen.extend(queries)
+        return httpx.Response(200, json={"results": [
+            [
+                {
+                    "facility_id": 100 * q + i,
+                    "facility_name": f"{query.get('category', 'any')} {i}",
+                    "facility_type": query.get("category", "any"),
+                    "latitude": query["lat"], "longitude": query["lon"],
+                    "distance_km": float(i + 1 + q / 10),
+                }
+                for i in range(query["top_n"])
+            ]
+            for q, query in enumerate(queries)
+        ]})
+
+    return httpx.MockTransport(handler)
+
+def test_triage_referral_picks_tier_by_urgency(monkeypatch):
+    """The predicted urgency selects the facility tier from one batched hospital search"""
+    import main
+    from referral import HospitalReferralClient, URGENCY_TIERS
+
+    seen = []
+    monkeypatch.setattr(main, "referral_client", HospitalReferralClient(transport=_hospital_transport(seen=seen)))
+    response = client.post("/triage/referral", json={"symptoms": ["chest_pain", "breathlessness"], "lat": 3.85, "lon": 11.5, "top_n": 4})
+    assert response.status_code == 200
+    body = response.json()
+
+    tier, categories = URGENCY_TIERS[body["urgency"]]
+    assert body["urgency"] == body["predictions"][0]["urgency"]
+    assert body["referral"]["tier"] == tier
+    facilities = body["referral"]["facilities"]
+    assert len(facilities) == 4
+    assert [f["distance_km"] for f in facilities] == sorted(f["distance_km"] for f in facilities)
+    if categories:
+        assert {f["facility_type"] for f in facilities} <= set(categories)
+    assert {q.get("category") for q in seen} >= {None, "district_hospital", "medical_centre"}
+    assert "referral_error" not in body
+
+def test_triage_referral_forwards_client_to_hospital_api(monkeypatch):
+    """With an internal token, lookups are rate-limited as the end client, not as this API"""
+    import main
+    from shared import rate_limit
+    from referral import HospitalReferralClient
+
+    requests = []
+    monkeypatch.setattr(main, "referral_client", HospitalReferralClient(transport=_hospital_transport(requests=requests)))
+    client.post("/triage/referral", json={"symptoms": ["cough"], "lat": 4.05, "lon": 9.7})
+    assert "x-internal-token" not in requests[-1].headers
+
+    monkeypatch.setattr(rate_limit, "INTERNAL_API_TOKEN", "s3cret")
+    client.post("/triage/referral", json={"symptoms": ["cough"], "lat": 4.05, "lon": 9.7})
+    assert requests[-1].headers["x-internal-token"] == "s3cret"
+    assert requests[-1].headers["x-client-address"] == "testclient"
+
+def test_triage_referral_runs_stages_concurrently(monkeypatch):
+    """Inference and the hospital search overlap instead of adding up"""
+    import time
+    import main
+    from referral import HospitalReferralClient
+
+    def slow_inference(symptoms_tuple, explain=False):
+        time.sleep(0.3)
+        return [{"disease": "Test", "confidence": 90.0, "urgency": "Low"}]
+
+    monkeypatch.setattr(main, "cached_model_inference", slow_inference)
+    monkeypatch.setattr(main, "referral_client", HospitalReferralClient(transport=_hospital_transport(delay=0.3)))
+    start = time.perf_counter()
+    response = client.post("/triage/referral", json={"symptoms": ["cough"], "lat": 4.05, "lon": 9.7})
+    assert response.status_code == 200
+    assert time.perf_counter() - start < 0.55
+    assert response.json()["referral"]["tier"] == "primary_care"
+
+def test_triage_referral_degrades_without_hospital_api(monkeypatch):
+    """Predictions are still returned when the Hospital API fails"""
+    import main
+    from referral import HospitalReferralClient
+
+    monkeypatch.setattr(main, "referral_client", HospitalReferralClient(transport=_hospital_transport(fail=True)))
+    response = client.post("/triage/referral", json={"symptoms": ["cough", "high_fever"], "lat": 4.05, "lon": 9.7})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["predictions"]
+    assert body["referral"]["facilities"] == []
+    assert "503" in body["referral_error"]
+
+    assert client.post("/triage/referral", json={"symptoms": ["spaghetti"], "lat": 4.05, "lon": 9.7}).status_code == 400
+
+def test_predictions_and_referrals_are_audited(monkeypatch, tmp_path):
+    """Each prediction and referral leaves a compact audit record"""
+    import main
+    from model_utils import symptoms_to_mask, MODEL_VERSION
+    from referral import HospitalReferralClient
+    from shared.audit import AuditLog
+
+    audit = AuditLog(str(tmp_path / "audit.db"), "disease-prediction-api")
+    monkeypatch.setattr(main, "audit_log", audit)
+    monkeypatch.setattr(main, "referral_client", HospitalReferralClient(transport=_hospital_transport()))
+    predicted = client.post("/predict", json={"symptoms": ["fever", "headache"]}).json()
+    referred = client.post("/triage/referral", json={"symptoms": ["cough"], "lat": 4.05, "lon": 9.7}).json()
+    audit.flush()
+
+    referral, prediction = audit.query()
+    assert int(prediction["symptom_mask"], 16) == symptoms_to_mask(["fever", "headache"])
+    assert prediction["top_k"] == [[p["disease"], p["confidence"]] for p in predicted["predictions"]]
+    assert prediction["urgency"] == predicted["predictions"][0]["urgency"]
+    assert prediction["model_version"] == MODEL_VERSION
+    assert (referral["kind"], referral["lat"], referral["lon"]) == ("referral", 4.05, 9.7)
+    assert referral["facilities"] == [f["facility_id"] for f in referred["referral"]["facilities"]]
+    audit.close()
+
+def test_health_answers_while_inference_is_shed(monkeypatch):
+    """A saturated executor sheds predictions with 503 while /health keeps answering"""
+    import main
+    from shared.execution import CPUExecutor
+
+    executor = CPUExecutor(workers=1)
+    monkeypatch.setattr(executor, "_admit", lambda endpoint, weight=1: False)
+    monkeypatch.setattr(main, "cpu_executor", executor)
+
+    response = client.post("/predict", json={"symptoms": ["fever", "headache"]})
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    batch = client.post("/predict/batch", json={"requests": [{"symptoms": ["cough"]}]})
+    assert batch.status_code == 503
+    webhook = client.post("/webhook", json={"queryResult": {"queryText": "I have a headache"}})
+    assert "try again" in webhook.json()["fulfillmentText"]
+
+    health = client.get("/health")
+    assert health.status_code == 200
+    assert health.json()["status"] == "healthy"
+    assert health.json()["executor"]["workers"] == 1
+    executor.shutdown()
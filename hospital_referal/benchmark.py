@@ -0,0 +1,347 @@
+"""
+Reproducible benchmark of hospital search engines and API throughput.
+
+Generates seeded query points uniformly over Cameroon's extent, half of
+them with a facility type filter, with top_n drawn from TOP_N_CHOICES, and
+times one search per query with each engine:
+
+  geodesic             the original recommend_hospitals(): type filter with
+                       str.contains, geopy geodesic() per facility through
+                       DataFrame.apply, then sort_values
+  vectorized           type filter from the attribute index, ellipsoidal
+                       distances to every facility it selects, exact top-k
+  kdtree               FacilitySpatialIndex.nearest() on the same selection
+  recommend            today's recommend_hospitals() with its location
+                       cell cache, cold (first pass) and warm (second pass)
+
+on the real facility table and on synthetic copies scaled --scales times
+(each extra copy jittered by --jitter-deg so the density grows). Engines
+are checked to return the same facilities at the same distances before
+they are timed. geodesic is only run on tables up to --geodesic-max-rows
+and for --geodesic-queries queries, as it needs seconds per query on
+large tables.
+
+It then measures full-API throughput in-process (ASGI transport, no
+network) for /recommend-hospitals at each --concurrency level.
+
+--save-baseline writes the results as JSON; --compare checks a run against
+such a file and exits with status 1 when any median latency grew, or any
+throughput fell, by more than --tolerance. Baselines are machine-specific:
+compare runs from the same host.
+
+Run with:
+    python benchmark.py [--queries 300] [--scales 1,10,100] [--save-baseline benchmark_baseline.json]
+    python benchmark.py --compare benchmark_baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, List, Sequence
+
+# The API must not rate limit, shed or log every benchmark request; set
+# before main.py (and the logging it configures) is imported
+os.environ.setdefault("RATE_LIMIT_REQUESTS", "0")
+os.environ.setdefault("EXECUTOR_QUEUE_SIZE", "256")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic
+
+from dataset_manager import FacilitySnapshot
+from distance_accuracy import LAT_RANGE, LON_RANGE
+from facility_index import AttributeIndex
+from geo import distance_km, nearest_in_blocks
+from spatial_index import FacilitySpatialIndex
+
+TYPE_FILTERS = ("District", "Santé", "Clinic", "Régional", "Medical")
+TOP_N_CHOICES = (1, 5, 10, 20, 50)
+
+
+def make_queries(count: int, seed: int) -> List[Dict]:
+    """Seeded query points over Cameroon, half of them type-filtered"""
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(*LAT_RANGE, count)
+    lons = rng.uniform(*LON_RANGE, count)
+    return [
+        {
+            "lat": float(lats[i]),
+            "lon": float(lons[i]),
+            "top_n": int(rng.choice(TOP_N_CHOICES)),
+            "type": str(rng.choice(TYPE_FILTERS)) if i % 2 else None,
+        }
+        for i in range(count)
+    ]
+
+
+def scale_facilities(frame: pd.DataFrame, factor: int, jitter_deg: float, seed: int) -> pd.DataFrame:
+    """The table plus factor - 1 copies with jittered coordinates"""
+    if factor == 1:
+        return frame
+    rng = np.random.default_rng(seed)
+    copies = [frame]
+    for _ in range(factor - 1):
+        copy = frame.copy()
+        copy["latitude"] = np.clip(copy["latitude"] + rng.normal(0, jitter_deg, len(copy)), *LAT_RANGE)
+        copy["longitude"] = np.clip(copy["longitude"] + rng.normal(0, jitter_deg, len(copy)), *LON_RANGE)
+        copies.append(copy)
+    scaled = pd.concat(copies, ignore_index=True)
+    scaled["facility_id"] = np.arange(len(scaled), dtype=np.int64)
+    scaled["facility_category"] = scaled["facility_category"].astype(str).astype("category")
+    return scaled
+
+
+def snapshot_of(frame: pd.DataFrame) -> FacilitySnapshot:
+    """Indexed snapshot of a table, without the (unused here) transfer graph"""
+    index = FacilitySpatialIndex(frame["latitude"].to_numpy(), frame["longitude"].to_numpy(), keys=frame["facility_id"].to_numpy())
+    return FacilitySnapshot(frame, index, AttributeIndex(frame), None, version=1)
+
+
+# --- Engines: each returns (row positions, distances in km), nearest first --
+
+def geodesic_engine(snapshot: FacilitySnapshot) -> Callable:
+    df = snapshot.df.assign(position=np.arange(len(snapshot.df)))
+
+    def search(lat, lon, top_n, required_type):
+        data = df.copy()
+        if required_type:
+            data = data[data["facility_type"].str.contains(required_type, case=False, na=False)]
+        data["distance_km"] = data.apply(lambda row: geodesic((lat, lon), (row["latitude"], row["longitude"])).km, axis=1)
+        data = data.sort_values("distance_km").head(top_n)
+        return data["position"].to_numpy(), data["distance_km"].to_numpy()
+
+    return search
+
+
+def vectorized_engine(snapshot: FacilitySnapshot) -> Callable:
+    lats = snapshot.df["latitude"].to_numpy()
+    lons = snapshot.df["longitude"].to_numpy()
+
+    def search(lat, lon, top_n, required_type):
+        rows = snapshot.select(required_type)
+        rows = np.arange(len(lats)) if rows is None else rows
+        positions, distances = nearest_in_blocks([lat], [lon], lats[rows], lons[rows], [top_n])[0]
+        return rows[positions], distances
+
+    return search
+
+
+def kdtree_engine(snapshot: FacilitySnapshot) -> Callable:
+    def search(lat, lon, top_n, required_type):
+        return snapshot.spatial_index.nearest(lat, lon, top_n, snapshot.select(required_type))
+
+    return search
+
+
+def recommend_engine(snapshot: FacilitySnapshot) -> Callable:
+    import hospital_recommender
+
+    def search(lat, lon, top_n, required_type):
+        hospital_recommender.dataset.snapshot = snapshot
+        result = hospital_recommender.recommend_hospitals((lat, lon), top_n, required_type)
+        positions = np.array([snapshot.position_of(facility_id) for facility_id in result["facility_id"]], dtype=np.int64)
+        return positions, result["distance_km"].to_numpy()
+
+    return search
+
+
+ENGINES = {
+    "geodesic": geodesic_engine,
+    "vectorized": vectorized_engine,
+    "kdtree": kdtree_engine,
+    "recommend": recommend_engine,
+}
+
+
+def time_engine(search: Callable, queries: Sequence[Dict]) -> np.ndarray:
+    """Seconds taken by each query"""
+    timings = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        search(query["lat"], query["lon"], query["top_n"], query["type"])
+        timings[i] = time.perf_counter() - start
+    return timings
+
+
+def check_agreement(reference: Callable, search: Callable, snapshot: FacilitySnapshot, queries: Sequence[Dict], tolerance_km: float):
+    """Raise if an engine's distances differ from the reference's beyond tolerance_km"""
+    lats = snapshot.df["latitude"].to_numpy()
+    lons = snapshot.df["longitude"].to_numpy()
+    for query in queries:
+        args = (query["lat"], query["lon"], query["top_n"], query["type"])
+        expected, found = reference(*args), search(*args)
+        found_distances = distance_km(query["lat"], query["lon"], lats[found[0]], lons[found[0]])
+        if len(found[0]) != len(expected[0]) or np.abs(np.sort(found_distances) - expected[1]).max(initial=0) > tolerance_km:
+            raise AssertionError(f"Engine disagrees with the exact search for {query}")
+
+
+def summarize(timings: np.ndarray) -> Dict[str, float]:
+    return {
+        "queries": len(timings),
+        "median_us": round(float(np.median(timings)) * 1e6, 1),
+        "p95_us": round(float(np.percentile(timings, 95)) * 1e6, 1),
+        "mean_us": round(float(timings.mean()) * 1e6, 1),
+    }
+
+
+def run_engines(base: pd.DataFrame, args) -> Dict[str, Dict]:
+    import hospital_recommender
+
+    queries = make_queries(args.queries, args.seed)
+    original_snapshot = hospital_recommender.dataset.snapshot
+    results = {}
+    try:
+        for factor in args.scales:
+            frame = scale_facilities(base, factor, args.jitter_deg, args.seed + factor)
+            snapshot = snapshot_of(frame)
+            engines = {name: build(snapshot) for name, build in ENGINES.items()}
+            reference = engines["vectorized"]
+            check = queries[:args.check_queries]
+            for name in ("kdtree", "recommend"):
+                check_agreement(reference, engines[name], snapshot, check, tolerance_km=0.006)
+            use_geodesic = len(frame) <= args.geodesic_max_rows
+            if use_geodesic:
+                # geodesic and the ellipsoidal engine agree to metres, not exactly
+                check_agreement(reference, engines["geodesic"], snapshot, check[:5], tolerance_km=0.05)
+
+            for name, search in engines.items():
+                if name == "geodesic":
+                    if not use_geodesic:
+                        continue
+                    results[f"{name}@x{factor}"] = summarize(time_engine(search, queries[:args.geodesic_queries]))
+                elif name == "recommend":
+                    snapshot.location_cache.clear()
+                    results[f"{name}-cold@x{factor}"] = summarize(time_engine(search, queries))
+                    results[f"{name}-warm@x{factor}"] = summarize(time_engine(search, queries))
+                else:
+                    results[f"{name}@x{factor}"] = summarize(time_engine(search, queries))
+                for key in [k for k in results if k.endswith(f"@x{factor}")]:
+                    results[key]["rows"] = len(frame)
+            print(f"  x{factor}: {len(frame)} facilities done", file=sys.stderr)
+    finally:
+        hospital_recommender.dataset.snapshot = original_snapshot
+    return results
+
+
+async def _throughput(app, queries: Sequence[Dict], concurrency: int) -> Dict[str, float]:
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        async def one(query):
+            params = {k: v for k, v in query.items() if v is not None}
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get("/recommend-hospitals", params=params)
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(query) for query in queries))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(queries),
+        "rps": round(len(queries) / elapsed, 1),
+        "p50_ms": round(float(np.median(latencies)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+    }
+
+
+def run_throughput(args) -> Dict[str, Dict]:
+    from main import app
+
+    queries = make_queries(args.api_requests, args.seed + 1)
+    return {f"c{level}": asyncio.run(_throughput(app, queries, level)) for level in args.concurrency}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Human-readable regressions of results against a baseline"""
+    regressions = []
+    for key, stats in results["engines"].items():
+        before = baseline.get("engines", {}).get(key)
+        if before and stats["median_us"] > before["median_us"] * (1 + tolerance):
+            regressions.append(f"{key}: median {before['median_us']:.1f} -> {stats['median_us']:.1f} us")
+    for key, stats in results["throughput"].items():
+        before = baseline.get("throughput", {}).get(key)
+        if before and stats["rps"] < before["rps"] * (1 - tolerance):
+            regressions.append(f"throughput {key}: {before['rps']:.1f} -> {stats['rps']:.1f} req/s")
+    return regressions
+
+
+def print_report(results: Dict):
+    print(f"{'engine':<16} {'scale':>6} {'rows':>8} {'median us':>11} {'p95 us':>11} {'vs geodesic':>12}")
+    engines = results["engines"]
+    for key, stats in engines.items():
+        name, scale = key.split("@")
+        reference = engines.get(f"geodesic@{scale}")
+        speedup = f"{reference['median_us'] / stats['median_us']:11.0f}x" if reference else f"{'-':>12}"
+        print(f"{name:<16} {scale:>6} {stats['rows']:>8} {stats['median_us']:>11.1f} {stats['p95_us']:>11.1f} {speedup}")
+
+    print(f"\n{'concurrency':<12} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for key, stats in results["throughput"].items():
+        print(f"{key[1:]:<12} {stats['rps']:>9.1f} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f}")
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--scales", type=_ints, default=[1, 10, 100], help="comma-separated table multipliers")
+    parser.add_argument("--jitter-deg", type=float, default=0.1)
+    parser.add_argument("--geodesic-queries", type=int, default=5)
+    parser.add_argument("--geodesic-max-rows", type=int, default=50000)
+    parser.add_argument("--check-queries", type=int, default=50, help="queries checked against the exact search")
+    parser.add_argument("--concurrency", type=_ints, default=[1, 8, 32])
+    parser.add_argument("--api-requests", type=int, default=500)
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    from hospital_recommender import load_hospital_data
+
+    base, _ = load_hospital_data()
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "facilities": len(base),
+            "queries": args.queries,
+            "seed": args.seed,
+        },
+        "engines": run_engines(base, args),
+        "throughput": run_throughput(args),
+    }
+    print_report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as handle:
+            json.dump(results, handle, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        if regressions:
+            print(f"\nRegressions beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.tolerance:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
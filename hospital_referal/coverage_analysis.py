@@ -0,0 +1,234 @@
+"""
+National coverage analysis: distance from every grid cell to the nearest facility.
+
+Lays a regular latitude/longitude grid of roughly --resolution-km cells over
+the facility dataset's bounding box and computes, for every cell centre,
+the exact distance to the nearest facility of each category (and of any
+category). Rows of the grid are split into tiles and solved across a
+process pool; each worker builds the per-category spatial indexes once and
+writes its tile straight into shared memory-mapped output arrays, so the
+grid never has to fit in one process's memory.
+
+There are no boundary polygons in the dataset, so each cell is attributed
+to the Admin1 region of its nearest facility, and cells further than
+--max-reach-km from every facility are treated as outside the country
+(the bounding box also covers parts of neighbouring countries).
+
+Outputs in --output-dir:
+    grid.json                 grid geometry, categories and file layout
+    distance_<category>.f32   float32 (rows, cols) memmap, km to the nearest facility
+    region.i16                int16 (rows, cols) memmap, index into grid.json regions, -1 outside
+    summary.json              per region and category: area, mean/max distance and
+                              area further than each --thresholds distance (km2)
+
+Run with:
+    python coverage_analysis.py [--resolution-km 2] [--workers 4] [--output-dir coverage]
+
+Load a result with:
+    np.memmap("coverage/distance_all.f32", dtype=np.float32, mode="r", shape=(rows, cols))
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from geo import EARTH_RADIUS_KM
+from spatial_index import FacilitySpatialIndex
+
+ALL_FACILITIES = "all"
+DEFAULT_THRESHOLDS_KM = (5.0, 10.0, 20.0, 50.0)
+
+# Per-process state set up by _init_worker
+_worker: Dict = {}
+
+
+def grid_geometry(bounds: Sequence[float], resolution_km: float) -> Dict:
+    """
+    Cell-centre grid over (min_lat, max_lat, min_lon, max_lon).
+
+    The longitude step is scaled by cos(mid-latitude) so cells are roughly
+    square on the ground.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounds
+    km_per_degree = np.radians(1) * EARTH_RADIUS_KM
+    lat_step = resolution_km / km_per_degree
+    lon_step = resolution_km / (km_per_degree * np.cos(np.radians((min_lat + max_lat) / 2)))
+    rows = max(1, int(np.ceil((max_lat - min_lat) / lat_step)))
+    cols = max(1, int(np.ceil((max_lon - min_lon) / lon_step)))
+    return {
+        "lat0": min_lat + lat_step / 2, "lon0": min_lon + lon_step / 2,
+        "lat_step": lat_step, "lon_step": lon_step,
+        "rows": rows, "cols": cols,
+    }
+
+
+def cell_areas_km2(geometry: Dict) -> np.ndarray:
+    """Area of one cell in each grid row (km2); cells shrink with cos(latitude)"""
+    lats = geometry["lat0"] + geometry["lat_step"] * np.arange(geometry["rows"])
+    return (EARTH_RADIUS_KM ** 2) * np.radians(geometry["lat_step"]) * np.radians(geometry["lon_step"]) * np.cos(np.radians(lats))
+
+
+def _init_worker(latitudes, longitudes, groups, region_codes, geometry, output_dir):
+    _worker["indexes"] = {
+        name: (FacilitySpatialIndex(latitudes[rows], longitudes[rows]), rows) for name, rows in groups.items()
+    }
+    _worker["region_codes"] = region_codes
+    _worker["geometry"] = geometry
+    _worker["output_dir"] = output_dir
+
+
+def _open(output_dir: str, name: str, dtype, shape, mode: str = "r+") -> np.memmap:
+    return np.memmap(os.path.join(output_dir, name), dtype=dtype, mode=mode, shape=shape)
+
+
+def _solve_tile(row_range) -> int:
+    """Fill grid rows [start, stop) of every output array; runs in a worker"""
+    start, stop = row_range
+    geometry, output_dir = _worker["geometry"], _worker["output_dir"]
+    shape = (geometry["rows"], geometry["cols"])
+    lats = geometry["lat0"] + geometry["lat_step"] * np.arange(start, stop)
+    lons = geometry["lon0"] + geometry["lon_step"] * np.arange(geometry["cols"])
+    grid_lats = np.repeat(lats, len(lons))
+    grid_lons = np.tile(lons, len(lats))
+
+    for name, (index, rows) in _worker["indexes"].items():
+        positions, distances = index.nearest_many(grid_lats, grid_lons, 1)
+        output = _open(output_dir, f"distance_{name}.f32", np.float32, shape)
+        output[start:stop] = distances[:, 0].reshape(len(lats), len(lons))
+        output.flush()
+        if name == ALL_FACILITIES:
+            regions = _open(output_dir, "region.i16", np.int16, shape)
+            regions[start:stop] = _worker["region_codes"][rows[positions[:, 0]]].reshape(len(lats), len(lons))
+            regions.flush()
+    return stop - start
+
+
+def run_coverage(
+    frame: pd.DataFrame,
+    output_dir: str,
+    resolution_km: float = 2.0,
+    workers: Optional[int] = None,
+    tile_rows: int = 32,
+    max_reach_km: float = 50.0,
+    thresholds_km: Sequence[float] = DEFAULT_THRESHOLDS_KM,
+) -> Dict:
+    """
+    Compute the coverage grids for a cleaned facility table and write them to output_dir.
+
+    Returns:
+        The summary written to summary.json
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    latitudes = frame["latitude"].to_numpy(dtype=np.float64)
+    longitudes = frame["longitude"].to_numpy(dtype=np.float64)
+    geometry = grid_geometry((latitudes.min(), latitudes.max(), longitudes.min(), longitudes.max()), resolution_km)
+    shape = (geometry["rows"], geometry["cols"])
+
+    categories = sorted(frame["facility_category"].astype(str).unique())
+    groups = {ALL_FACILITIES: np.arange(len(frame))}
+    groups.update({name: np.flatnonzero(frame["facility_category"].astype(str).to_numpy() == name) for name in categories})
+    regions = sorted(frame["admin1"].dropna().unique()) if "admin1" in frame else []
+    region_codes = pd.Categorical(frame["admin1"], categories=regions).codes.astype(np.int16) if regions \
+        else np.full(len(frame), -1, dtype=np.int16)
+
+    for name in groups:
+        _open(output_dir, f"distance_{name}.f32", np.float32, shape, mode="w+").flush()
+    _open(output_dir, "region.i16", np.int16, shape, mode="w+").flush()
+
+    tiles = [(start, min(start + tile_rows, shape[0])) for start in range(0, shape[0], tile_rows)]
+    init_args = (latitudes, longitudes, groups, region_codes, geometry, output_dir)
+    if workers == 1:
+        _init_worker(*init_args)
+        for tile in tiles:
+            _solve_tile(tile)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as pool:
+            list(pool.map(_solve_tile, tiles))
+
+    metadata = {
+        **geometry,
+        "resolution_km": resolution_km,
+        "categories": [ALL_FACILITIES] + categories,
+        "regions": regions,
+        "max_reach_km": max_reach_km,
+        "files": {name: f"distance_{name}.f32" for name in groups},
+        "region_file": "region.i16",
+    }
+    with open(os.path.join(output_dir, "grid.json"), "w") as handle:
+        json.dump(metadata, handle, indent=2)
+
+    summary = summarize(output_dir, metadata, thresholds_km)
+    with open(os.path.join(output_dir, "summary.json"), "w") as handle:
+        json.dump(summary, handle, indent=2)
+    return summary
+
+
+def summarize(output_dir: str, metadata: Dict, thresholds_km: Sequence[float] = DEFAULT_THRESHOLDS_KM) -> Dict:
+    """Per-region, per-category area and distance statistics from the written grids"""
+    shape = (metadata["rows"], metadata["cols"])
+    areas = np.broadcast_to(cell_areas_km2(metadata)[:, None], shape)
+    regions = _open(output_dir, metadata["region_file"], np.int16, shape, mode="r")
+    nearest_any = _open(output_dir, metadata["files"][ALL_FACILITIES], np.float32, shape, mode="r")
+    inside = nearest_any <= metadata["max_reach_km"]
+
+    summary: Dict[str, Dict] = {}
+    region_names: List[str] = metadata["regions"]
+    for code, region in enumerate(region_names):
+        mask = inside & (regions == code)
+        region_area = float(areas[mask].sum())
+        summary[region] = {"area_km2": round(region_area, 1), "categories": {}}
+        for name in metadata["categories"]:
+            distances = _open(output_dir, metadata["files"][name], np.float32, shape, mode="r")[mask]
+            cell_areas = areas[mask]
+            summary[region]["categories"][name] = {
+                "mean_distance_km": round(float(np.average(distances, weights=cell_areas)), 2) if len(distances) else None,
+                "max_distance_km": round(float(distances.max()), 2) if len(distances) else None,
+                "area_beyond_km2": {
+                    f"{threshold:g}": round(float(cell_areas[distances > threshold].sum()), 1)
+                    for threshold in thresholds_km
+                },
+            }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolution-km", type=float, default=2.0)
+    parser.add_argument("--output-dir", default="coverage")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument("--tile-rows", type=int, default=32, help="grid rows per work unit")
+    parser.add_argument("--max-reach-km", type=float, default=50.0)
+    parser.add_argument("--thresholds", default=",".join(f"{t:g}" for t in DEFAULT_THRESHOLDS_KM),
+                        help="comma-separated distances (km) for the area-beyond figures")
+    args = parser.parse_args()
+
+    # Imported here so pool workers started with "spawn" don't load the dataset
+    from hospital_recommender import load_hospital_data
+
+    frame, _ = load_hospital_data()
+    start = time.perf_counter()
+    summary = run_coverage(
+        frame, args.output_dir, args.resolution_km, args.workers, args.tile_rows, args.max_reach_km,
+        [float(t) for t in args.thresholds.split(",")],
+    )
+    with open(os.path.join(args.output_dir, "grid.json")) as handle:
+        metadata = json.load(handle)
+    print(f"{metadata['rows']} x {metadata['cols']} grid at {args.resolution_km:g} km, "
+          f"{len(metadata['categories'])} categories in {time.perf_counter() - start:.1f}s -> {args.output_dir}\n")
+
+    threshold = f"{float(args.thresholds.split(',')[-1]):g}"
+    print(f"{'region':<16} {'area km2':>10} {'mean km':>8} {'>' + threshold + ' km (hosp.)':>18}")
+    for region, stats in summary.items():
+        everything = stats["categories"][ALL_FACILITIES]
+        hospitals = stats["categories"].get("district_hospital", everything)
+        print(f"{region:<16} {stats['area_km2']:>10.0f} {everything['mean_distance_km'] or 0:>8.1f} "
+              f"{hospitals['area_beyond_km2'][threshold]:>18.0f}")
+
+
+if __name__ == "__main__":
+    main()
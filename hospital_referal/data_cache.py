@@ -0,0 +1,145 @@
+"""
+Binary columnar cache for the cleaned facility table.
+
+Parsing camerounhopitals.xlsx with openpyxl takes most of a second and
+dominated cold start on autoscaled instances, even though the file only
+changes when someone edits it. FacilityDataCache stores the table after
+cleaning as an uncompressed .npz archive:
+  - float64 coordinate arrays, ready for the distance engine and indexes
+  - fixed-width unicode arrays for text columns, with a null mask each
+  - codes + categories for categorical columns
+  - any extra precomputed arrays (e.g. the facility transfer graph)
+
+Nothing in the archive needs pickle, so loading is a few memory copies.
+
+The cache file name is derived from the SHA-256 of the source file and
+CACHE_FORMAT_VERSION, so editing the xlsx (or changing how it is cleaned,
+which must bump the version) automatically misses the old cache. Stale
+archives for the same source are removed whenever a new one is written, and
+writes go through a temporary file and os.replace() so concurrent workers
+never read a half-written cache.
+"""
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the cleaning logic or the stored layout changes
+CACHE_FORMAT_VERSION = "3"
+
+_NULL_SUFFIX = "__null"
+_CODES_SUFFIX = "__codes"
+_CATEGORIES_SUFFIX = "__categories"
+_EXTRA_PREFIX = "extra__"
+_COLUMNS_KEY = "__columns__"
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def frame_to_arrays(frame: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """Split a DataFrame into pickle-free NumPy arrays"""
+    arrays = {_COLUMNS_KEY: np.asarray(list(frame.columns), dtype=str)}
+    for column in frame.columns:
+        series = frame[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            arrays[column + _CODES_SUFFIX] = series.cat.codes.to_numpy()
+            arrays[column + _CATEGORIES_SUFFIX] = np.asarray(series.cat.categories, dtype=str)
+        elif pd.api.types.is_numeric_dtype(series.dtype):
+            arrays[column] = series.to_numpy()
+        else:
+            nulls = series.isna().to_numpy()
+            arrays[column] = np.where(nulls, "", series.fillna("").astype(str).to_numpy()).astype(str)
+            arrays[column + _NULL_SUFFIX] = nulls
+    return arrays
+
+
+def arrays_to_frame(arrays: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """Rebuild the DataFrame written by frame_to_arrays()"""
+    data = {}
+    for column in arrays[_COLUMNS_KEY].tolist():
+        if column + _CODES_SUFFIX in arrays:
+            data[column] = pd.Categorical.from_codes(
+                arrays[column + _CODES_SUFFIX], categories=arrays[column + _CATEGORIES_SUFFIX].tolist()
+            )
+        elif column + _NULL_SUFFIX in arrays:
+            values = arrays[column].astype(object)
+            values[arrays[column + _NULL_SUFFIX]] = None
+            data[column] = values
+        else:
+            data[column] = arrays[column]
+    return pd.DataFrame(data)
+
+
+class FacilityDataCache:
+    """Columnar cache file for one source file, keyed by its content hash"""
+
+    def __init__(self, source: str, cache_dir: Optional[str] = None):
+        self.source = source
+        self.cache_dir = cache_dir or os.getenv(
+            "HOSPITAL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(source)), ".cache")
+        )
+        self.stem = os.path.splitext(os.path.basename(source))[0]
+        self.source_digest = file_digest(source)
+        self.digest = hashlib.sha256((self.source_digest + CACHE_FORMAT_VERSION).encode()).hexdigest()[:16]
+        self.path = os.path.join(self.cache_dir, f"{self.stem}-{self.digest}.npz")
+
+    def load(self) -> Optional[Dict[str, np.ndarray]]:
+        """All cached arrays, or None on a miss or unreadable cache"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path, allow_pickle=False) as archive:
+                return {name: archive[name] for name in archive.files}
+        except Exception as e:
+            logger.warning("Ignoring unreadable facility cache %s: %s", self.path, e)
+            return None
+
+    def load_frame(self):
+        """Tuple of (DataFrame, extra arrays) from the cache, or None on a miss"""
+        arrays = self.load()
+        if arrays is None:
+            return None
+        extras = {
+            name[len(_EXTRA_PREFIX):]: value for name, value in arrays.items() if name.startswith(_EXTRA_PREFIX)
+        }
+        return arrays_to_frame(arrays), extras
+
+    def save_frame(self, frame: pd.DataFrame, extras: Optional[Dict[str, np.ndarray]] = None):
+        """Write the frame (and extra arrays) atomically, replacing stale caches for this source"""
+        arrays = frame_to_arrays(frame)
+        for name, value in (extras or {}).items():
+            arrays[_EXTRA_PREFIX + name] = np.asarray(value)
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".npz.tmp")
+            with os.fdopen(handle, "wb") as tmp:
+                np.savez(tmp, **arrays)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # A read-only filesystem only costs us the cache, not the service
+            logger.warning("Could not write facility cache %s: %s", self.path, e)
+            return
+
+        for stale in glob.glob(os.path.join(self.cache_dir, f"{self.stem}-*.npz")):
+            if stale != self.path:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+        logger.info("Wrote facility cache %s", self.path)
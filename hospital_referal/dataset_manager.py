@@ -0,0 +1,279 @@
+"""
+Live facility dataset: consistent snapshots, reloads and single-facility edits.
+
+The facility table and everything derived from it (spatial index, attribute
+index, location cache, transfer graph) are bundled into an immutable
+FacilitySnapshot. A request reads DatasetManager.snapshot once and uses only
+that object, so it sees one consistent version of the data however many
+changes land meanwhile; publishing a new version is a single reference
+assignment.
+
+Edits through the admin API are applied copy-on-write without rebuilding:
+  - rows keep their positions: a removed facility becomes a tombstone
+    (excluded through the snapshot's live-row mask) and an added or updated
+    facility is appended as a new row under its facility_id
+  - the attribute index is patched for just the affected rows
+  - the spatial index shares the previous KD-tree and scans appended rows
+    as a small tail
+  - the location cache starts empty, and escalations fall back to an exact
+    search until the transfer graph is current again
+
+Every edit schedules a background rebuild (after REBUILD_DELAY_SECONDS, so
+bursts of edits share one) that compacts the table, dropping tombstones,
+and rebuilds the tree and transfer graph. A full reload re-reads the source
+file the same way. Admin edits live in memory: they are lost on restart or
+on a full reload, and each worker process holds its own copy.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from facility_index import AttributeIndex, normalize_facility_type
+from geo_cache import GeoCellCache
+from ingest import facility_id_for
+from spatial_index import FacilitySpatialIndex
+from transfer_graph import TransferGraph, facility_levels
+
+logger = logging.getLogger(__name__)
+
+LOCATION_CACHE_CELL_DEG = float(os.getenv("LOCATION_CACHE_CELL_DEG", "0.05"))
+LOCATION_CACHE_SIZE = int(os.getenv("LOCATION_CACHE_SIZE", "50000"))
+
+# Delay before a background rebuild, so bursts of edits share one
+REBUILD_DELAY_SECONDS = float(os.getenv("DATASET_REBUILD_DELAY_SECONDS", "1"))
+
+# Columns an admin may set on a facility
+EDITABLE_COLUMNS = ("facility_name", "facility_type", "latitude", "longitude", "admin1", "ownership", "country")
+
+
+def build_transfer_graph(df: pd.DataFrame) -> TransferGraph:
+    """Facility-to-facility transfer graph by care level for a cleaned table"""
+    return TransferGraph.build(
+        df["latitude"].to_numpy(), df["longitude"].to_numpy(), facility_levels(df["facility_category"])
+    )
+
+
+def _edited_version(dataset_version: Optional[str]) -> Optional[str]:
+    if dataset_version is None or dataset_version.endswith("+edited"):
+        return dataset_version
+    return dataset_version + "+edited"
+
+
+class FacilitySnapshot:
+    """One immutable version of the facility table and its indexes"""
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        spatial_index: FacilitySpatialIndex,
+        attribute_index: AttributeIndex,
+        transfer_graph: Optional[TransferGraph],
+        version: int,
+        live: Optional[np.ndarray] = None,
+        id_positions: Optional[Dict[int, int]] = None,
+        dataset_version: Optional[str] = None,
+    ):
+        self.df = df
+        self.spatial_index = spatial_index
+        self.attribute_index = attribute_index
+        # None while edits have made the precomputed graph stale
+        self.transfer_graph = transfer_graph
+        # Changes with every edit or reload, but not with compaction
+        self.version = version
+        # SHA-256 of the source file, "+edited" once admin edits are applied;
+        # unlike version (a per-process counter) it identifies the data itself
+        self.dataset_version = dataset_version
+        # None when every row is live, otherwise a mask excluding tombstones
+        self.live = live
+        self.live_rows = None if live is None else np.flatnonzero(live)
+        self.id_positions = id_positions if id_positions is not None else {
+            int(facility_id): position for position, facility_id in enumerate(df["facility_id"].to_numpy())
+        }
+        self.location_cache = GeoCellCache(spatial_index, cell_deg=LOCATION_CACHE_CELL_DEG, capacity=LOCATION_CACHE_SIZE)
+
+    @classmethod
+    def build(
+        cls,
+        df: pd.DataFrame,
+        transfer_graph: Optional[TransferGraph] = None,
+        version: int = 1,
+        dataset_version: Optional[str] = None,
+    ) -> "FacilitySnapshot":
+        """Snapshot with every index built from scratch (dataset_version defaults to df.attrs["source_sha256"])"""
+        return cls(
+            df,
+            FacilitySpatialIndex(df["latitude"].to_numpy(), df["longitude"].to_numpy(), keys=df["facility_id"].to_numpy()),
+            AttributeIndex(df),
+            transfer_graph if transfer_graph is not None else build_transfer_graph(df),
+            version,
+            dataset_version=dataset_version or df.attrs.get("source_sha256"),
+        )
+
+    @property
+    def facility_count(self) -> int:
+        return len(self.id_positions)
+
+    def select(self, type_query=None, category=None, region=None, ownership=None) -> Optional[np.ndarray]:
+        """Live rows matching the filters, or None for "every row" (see AttributeIndex.select)"""
+        rows = self.attribute_index.select(type_query, category, region, ownership)
+        return self.live_rows if rows is None else rows
+
+    def position_of(self, facility_id: int) -> int:
+        """Row position of a live facility; KeyError if there is none"""
+        try:
+            return self.id_positions[int(facility_id)]
+        except KeyError:
+            raise KeyError(f"Unknown facility id {facility_id}")
+
+    def compacted(self) -> "FacilitySnapshot":
+        """
+        Fresh snapshot of the live rows, with every index rebuilt.
+
+        The facilities are the same, so the version is kept: cursors and
+        cached responses bound to it stay valid across a background rebuild.
+        """
+        df = self.df if self.live is None else self.df[self.live].reset_index(drop=True)
+        return FacilitySnapshot.build(df, version=self.version, dataset_version=self.dataset_version)
+
+    def edited(self, remove: Optional[int] = None, add: Optional[Dict[str, Any]] = None) -> "FacilitySnapshot":
+        """
+        Snapshot with one row tombstoned and/or one row appended, built
+        incrementally from this one.
+        """
+        df = self.df
+        live = np.ones(len(df), dtype=bool) if self.live is None else self.live.copy()
+        id_positions = dict(self.id_positions)
+        spatial_index = self.spatial_index
+        removed, added = [], []
+
+        if remove is not None:
+            live[remove] = False
+            del id_positions[int(df["facility_id"].iat[remove])]
+            removed.append(remove)
+
+        if add is not None:
+            row = pd.DataFrame([add]).reindex(columns=df.columns)
+            row["facility_category"] = row["facility_type"].map(normalize_facility_type)
+            row = row.astype({column: df[column].dtype for column in ("facility_id", "latitude", "longitude")})
+            df = pd.concat([df, row], ignore_index=True)
+            df["facility_category"] = df["facility_category"].astype(str).astype("category")
+            live = np.append(live, True)
+            id_positions[int(add["facility_id"])] = len(df) - 1
+            spatial_index = spatial_index.appended([add["latitude"]], [add["longitude"]], [add["facility_id"]])
+            added.append(len(df) - 1)
+
+        return FacilitySnapshot(
+            df,
+            spatial_index,
+            self.attribute_index.updated(df, removed, added),
+            None,
+            self.version + 1,
+            live=None if live.all() else live,
+            id_positions=id_positions,
+            dataset_version=_edited_version(self.dataset_version),
+        )
+
+
+class DatasetManager:
+    """Owner of the current FacilitySnapshot; serializes changes and swaps snapshots"""
+
+    def __init__(self, loader: Callable[[], Tuple[pd.DataFrame, TransferGraph]], rebuild_delay: float = REBUILD_DELAY_SECONDS):
+        self.loader = loader
+        self.rebuild_delay = rebuild_delay
+        self._lock = threading.Lock()
+        self._rebuild_timer: Optional[threading.Timer] = None
+
+        df, graph = loader()
+        self.snapshot = FacilitySnapshot.build(df, graph)
+
+    def _publish(self, snapshot: FacilitySnapshot):
+        self.snapshot = snapshot
+        logger.info("Published facility snapshot v%d with %d facilities", snapshot.version, snapshot.facility_count)
+
+    def reload(self) -> FacilitySnapshot:
+        """Re-read the source file and atomically replace the dataset"""
+        df, graph = self.loader()
+        with self._lock:
+            snapshot = FacilitySnapshot.build(df, graph, version=self.snapshot.version + 1)
+            self._publish(snapshot)
+        return snapshot
+
+    def _validated(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        for column in ("facility_name", "facility_type"):
+            if not isinstance(record.get(column), str) or not record[column].strip():
+                raise ValueError(f"{column} is required")
+            record[column] = record[column].strip()
+        lat, lon = record.get("latitude"), record.get("longitude")
+        if lat is None or lon is None or not (-90 <= lat <= 90) or not (-180 <= lon <= 180) or (lat == 0 or lon == 0):
+            raise ValueError(f"Invalid coordinates: lat={lat}, lon={lon}")
+        return record
+
+    def add_facility(self, record: Dict[str, Any]) -> int:
+        """Add a facility; returns its new facility_id (derived like the source file's, see facility_id_for)"""
+        with self._lock:
+            snapshot = self.snapshot
+            record = self._validated({k: v for k, v in record.items() if k in EDITABLE_COLUMNS})
+            facility_id = facility_id_for(record["facility_name"], record["latitude"], record["longitude"], snapshot.id_positions)
+            record["facility_id"] = facility_id
+            self._publish(snapshot.edited(add=record))
+        self.schedule_rebuild()
+        return facility_id
+
+    def update_facility(self, facility_id: int, changes: Dict[str, Any]) -> Dict[str, Any]:
+        """Change some columns of a facility; returns its updated record"""
+        with self._lock:
+            snapshot = self.snapshot
+            position = snapshot.position_of(facility_id)
+            current = snapshot.df.iloc[position].to_dict()
+            record = {column: current.get(column) for column in EDITABLE_COLUMNS}
+            record.update({k: v for k, v in changes.items() if k in EDITABLE_COLUMNS})
+            record = self._validated({**record, "facility_id": int(facility_id)})
+            self._publish(snapshot.edited(remove=position, add=record))
+        self.schedule_rebuild()
+        return record
+
+    def remove_facility(self, facility_id: int):
+        """Remove a facility; KeyError if it does not exist"""
+        with self._lock:
+            snapshot = self.snapshot
+            self._publish(snapshot.edited(remove=snapshot.position_of(facility_id)))
+        self.schedule_rebuild()
+
+    def schedule_rebuild(self):
+        """Compact and rebuild the indexes in the background, after rebuild_delay"""
+        with self._lock:
+            if self._rebuild_timer is not None:
+                self._rebuild_timer.cancel()
+            self._rebuild_timer = threading.Timer(self.rebuild_delay, self._background_rebuild)
+            self._rebuild_timer.daemon = True
+            self._rebuild_timer.start()
+
+    def _background_rebuild(self):
+        try:
+            self.rebuild()
+        except Exception as e:
+            logger.exception("Background facility index rebuild failed: %s", e)
+
+    def rebuild(self) -> FacilitySnapshot:
+        """
+        Replace the current snapshot with a compacted, fully indexed copy.
+
+        The rebuild runs outside the lock; if an edit lands meanwhile the
+        result is stale and the rebuild starts over from the newer snapshot.
+        """
+        while True:
+            base = self.snapshot
+            if base.live is None and base.transfer_graph is not None and not len(base.spatial_index.tail):
+                return base
+            started = time.perf_counter()
+            rebuilt = base.compacted()
+            with self._lock:
+                if self.snapshot is base:
+                    self._publish(rebuilt)
+                    logger.info("Rebuilt facility indexes in %.3fs", time.perf_counter() - started)
+                    return rebuilt
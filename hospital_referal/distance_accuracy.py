@@ -0,0 +1,53 @@
+"""
+Measure the vectorized distance engines in geo.py against geopy's geodesic().
+
+Draws random point pairs inside Cameroon's extent (the same scale of
+distances the API serves) and prints absolute and relative errors, plus how
+much faster each engine is than one geodesic() call per pair.
+
+Run with:
+    python distance_accuracy.py [--pairs 20000] [--seed 42]
+"""
+import argparse
+import time
+
+import numpy as np
+from geopy.distance import geodesic
+
+from geo import ellipsoidal_km, haversine_km
+
+# Cameroon's bounding box, slightly padded
+LAT_RANGE = (1.6, 13.1)
+LON_RANGE = (8.4, 16.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    lat1, lat2 = rng.uniform(*LAT_RANGE, size=(2, args.pairs))
+    lon1, lon2 = rng.uniform(*LON_RANGE, size=(2, args.pairs))
+
+    start = time.perf_counter()
+    reference = np.array([geodesic((a, b), (c, d)).km for a, b, c, d in zip(lat1, lon1, lat2, lon2)])
+    geodesic_time = time.perf_counter() - start
+
+    print(f"{args.pairs} pairs, geodesic distances {reference.min():.1f}-{reference.max():.1f} km\n")
+    print(f"{'engine':<12} {'max abs':>12} {'mean abs':>12} {'max rel':>10} {'speedup':>9}")
+    for name, engine in (("haversine", haversine_km), ("ellipsoidal", ellipsoidal_km)):
+        start = time.perf_counter()
+        result = engine(lat1, lon1, lat2, lon2)
+        elapsed = time.perf_counter() - start
+        error = np.abs(result - reference)
+        relative = error / np.maximum(reference, 1e-9)
+        print(
+            f"{name:<12} {error.max() * 1000:10.1f} m {error.mean() * 1000:10.2f} m "
+            f"{relative.max() * 100:9.4f}% {geodesic_time / elapsed:8.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
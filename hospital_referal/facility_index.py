@@ -0,0 +1,182 @@
+"""
+Load-time attribute indexes over the facility table.
+
+recommend_hospitals() used to copy the whole facility frame and run a
+case-insensitive str.contains() over every row to apply its type filter,
+and the Admin1 (region) and Ownership columns could not be filtered on.
+
+AttributeIndex is built once per loaded table and keeps, for every distinct
+value of each filterable attribute, the sorted array of row positions
+holding it:
+  - raw facility type (the free-text Facility_t value)
+  - facility category, a normalized taxonomy of those free-text types
+    (see FACILITY_CATEGORIES) that also gives each type a care level
+  - region (Admin1) and ownership, matched case-insensitively
+
+updated() derives the index for an edited table copy-on-write, touching
+only the groups of rows that were removed or appended, so single-facility
+edits don't rebuild it.
+
+select() turns a combination of filters into one sorted row-position array
+by set intersection. The legacy substring/regex `type` filter is evaluated
+against the handful of distinct type names rather than every row. The
+result feeds FacilitySpatialIndex.nearest() as its subset; None means "no
+filter", so unfiltered queries never materialize a row set at all.
+"""
+import copy
+import re
+import unicodedata
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+# Normalized facility categories and their level in the referral pyramid
+FACILITY_CATEGORIES = {
+    "health_centre": 1,
+    "dispensary": 1,
+    "clinic": 1,
+    "medical_centre": 2,
+    "district_hospital": 3,
+    "regional_hospital": 4,
+    "central_hospital": 5,
+    "other": 0,
+}
+
+# (category, pattern) rules applied in order to accent-stripped, lowercased types
+_CATEGORY_RULES = [
+    ("district_hospital", re.compile(r"\bdistrict\b")),
+    ("regional_hospital", re.compile(r"\bregional\b")),
+    ("central_hospital", re.compile(r"\b(general|generale|central|centraux|reference)\b")),
+    ("medical_centre", re.compile(r"\b(centre medical|medical cent(re|er)|cma)\b")),
+    ("health_centre", re.compile(r"\b(centre de sante|health cent(re|er)|csi)\b")),
+    ("dispensary", re.compile(r"\b(dispensaire|dispensary)\b")),
+    ("clinic", re.compile(r"\b(clinic|clinique)\b")),
+]
+
+_EMPTY = np.empty(0, dtype=np.intp)
+
+
+def _fold(value: str) -> str:
+    """Lowercase and strip accents so "Hôpital" and "hopital" compare equal"""
+    decomposed = unicodedata.normalize("NFKD", value)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold().strip()
+
+
+def normalize_facility_type(raw_type) -> str:
+    """Map a free-text facility type onto FACILITY_CATEGORIES"""
+    if not isinstance(raw_type, str):
+        return "other"
+    folded = _fold(raw_type)
+    for category, pattern in _CATEGORY_RULES:
+        if pattern.search(folded):
+            return category
+    return "other"
+
+
+def _identity(value: str) -> str:
+    return value
+
+
+def _group_positions(values: pd.Series, key=_identity) -> Dict[str, np.ndarray]:
+    """Sorted row positions for every distinct (keyed) non-null value"""
+    groups: Dict[str, list] = {}
+    for position, value in enumerate(values.to_numpy()):
+        if isinstance(value, str) and value.strip():
+            groups.setdefault(key(value), []).append(position)
+    return {k: np.asarray(v, dtype=np.intp) for k, v in groups.items()}
+
+
+class AttributeIndex:
+    """Row-position sets per facility type, category, region and ownership"""
+
+    def __init__(self, frame: pd.DataFrame):
+        self.size = len(frame)
+        for name, column, key in self._groups():
+            setattr(self, name, _group_positions(frame[column], key=key) if column in frame else {})
+
+    @staticmethod
+    def _groups():
+        """(attribute name, column, key function) for every indexed attribute"""
+        return (
+            ("type_rows", "facility_type", _identity),
+            ("category_rows", "facility_category", _identity),
+            ("region_rows", "admin1", _fold),
+            ("ownership_rows", "ownership", _fold),
+        )
+
+    def updated(self, frame: pd.DataFrame, removed: Iterable[int] = (), added: Iterable[int] = ()) -> "AttributeIndex":
+        """
+        Index for an edited table, leaving this one untouched.
+
+        Args:
+            frame: The edited table; rows keep their positions and new rows are
+                appended after all existing ones
+            removed: Positions of rows to drop from the index
+            added: Positions of appended rows to index
+        """
+        index = copy.copy(self)
+        index.size = len(frame)
+        for name, column, key in self._groups():
+            if column not in frame:
+                continue
+            groups = dict(getattr(self, name))
+            values = frame[column]
+            for position in removed:
+                value = values.iat[position]
+                if isinstance(value, str) and value.strip():
+                    rows = groups[key(value)]
+                    groups[key(value)] = rows[rows != position]
+            for position in added:
+                value = values.iat[position]
+                if isinstance(value, str) and value.strip():
+                    groups[key(value)] = np.append(groups.get(key(value), _EMPTY), np.intp(position))
+            setattr(index, name, {value: rows for value, rows in groups.items() if len(rows)})
+        return index
+
+    def type_names(self) -> list:
+        # Types whose last facility was removed keep an empty group
+        return sorted(name for name, rows in self.type_rows.items() if len(rows))
+
+    def _matching_types(self, type_query: str) -> np.ndarray:
+        """Rows whose raw type contains type_query (case-insensitive regex, like str.contains)"""
+        names = pd.Series(list(self.type_rows), dtype=object)
+        matches = names[names.str.contains(type_query, case=False, na=False)]
+        if matches.empty:
+            return _EMPTY
+        return np.sort(np.concatenate([self.type_rows[name] for name in matches]))
+
+    def select(
+        self,
+        type_query: Optional[str] = None,
+        category: Optional[str] = None,
+        region: Optional[str] = None,
+        ownership: Optional[str] = None,
+    ) -> Optional[np.ndarray]:
+        """
+        Intersect the requested filters into one sorted array of row positions.
+
+        Returns:
+            None when no filter is given, otherwise the (possibly empty) rows
+            matching every filter
+        """
+        selections = []
+        if type_query:
+            selections.append(self._matching_types(type_query))
+        if category:
+            selections.append(self.category_rows.get(category, _EMPTY))
+        if region:
+            selections.append(self.region_rows.get(_fold(region), _EMPTY))
+        if ownership:
+            selections.append(self.ownership_rows.get(_fold(ownership), _EMPTY))
+        if not selections:
+            return None
+
+        # Intersect smallest-first so every step works on the fewest rows
+        selections.sort(key=len)
+        rows = selections[0]
+        for other in selections[1:]:
+            if len(rows) == 0:
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
@@ -10,33 +10,27 @@ Run once with:
     python fix_encoding.py
 It overwrites camerounhopitals.xlsx in place after backing up the original
 to camerounhopitals.xlsx.bak.
+
+The repair itself lives in ingest.py, which applies it to every registry
+it ingests.
 """
 import shutil
 import pandas as pd
 
+from ingest import repair_mojibake
+
 SOURCE = "camerounhopitals.xlsx"
 BACKUP = "camerounhopitals.xlsx.bak"
 TEXT_COLUMNS = ["Facility_n", "Facility_t", "Admin1", "Ownership"]
 
 
-def fix_mojibake(value):
-    if not isinstance(value, str):
-        return value
-    try:
-        repaired = value.encode("cp437").decode("utf-8")
-    except (UnicodeDecodeError, UnicodeEncodeError):
-        # Value wasn't actually mis-decoded this way — leave it alone.
-        return value
-    return repaired
-
-
 def main():
     shutil.copy(SOURCE, BACKUP)
     df = pd.read_excel(SOURCE)
 
     for col in TEXT_COLUMNS:
         if col in df.columns:
-            df[col] = df[col].apply(fix_mojibake)
+            df[col] = repair_mojibake(df[col])
 
     df.to_excel(SOURCE, index=False)
 
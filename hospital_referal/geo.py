@@ -0,0 +1,183 @@
+"""
+Vectorized distance engine for the Hospital Referral API.
+
+recommend_hospitals() used to call geopy.distance.geodesic once per facility
+per request through DataFrame.apply(axis=1). Karney's geodesic algorithm is
+exact but iterative and runs in pure Python, so that one line dominated the
+cost of every request.
+
+The functions here take one query point and NumPy float64 coordinate arrays
+(or broadcastable arrays of query points) and compute all distances in a
+handful of array operations:
+
+  - haversine_km: great-circle distance on a sphere of the mean Earth radius.
+  - ellipsoidal_km: Lambert's formula on the WGS-84 ellipsoid. It starts from
+    the spherical central angle between the reduced latitudes and applies a
+    first-order flattening correction, which brings it to within metres of
+    geodesic() at the distances that matter here.
+
+Accuracy against geopy's geodesic() for 20,000 random point pairs within
+Cameroon's extent (lat 1.6-13.1, lon 8.4-16.2, distances 5-1,430 km), as
+measured by distance_accuracy.py:
+
+    engine        max abs error   mean abs error   max relative   speedup
+    haversine     6.8 km          1.9 km           0.56 %         ~1800x
+    ellipsoidal   1.8 m           0.4 m            0.0001 %       ~900x
+
+ellipsoidal_km is therefore the default engine (distance_km): it agrees with
+the previous geodesic results to the 10 m resolution the API rounds to,
+while haversine_km stays available where a cheaper, sphere-consistent metric
+is wanted (e.g. spatial indexing).
+"""
+import numpy as np
+
+# Mean Earth radius (IUGG), used for spherical approximations
+EARTH_RADIUS_KM = 6371.0088
+
+# WGS-84 ellipsoid
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+
+
+def _central_angle(lat1, lon1, lat2, lon2):
+    """Great-circle central angle (radians) between points given in radians"""
+    sin_dlat = np.sin((lat2 - lat1) / 2)
+    sin_dlon = np.sin((lon2 - lon1) / 2)
+    h = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lat2) * sin_dlon * sin_dlon
+    return 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def haversine_km(lat, lon, lats, lons):
+    """
+    Great-circle distances in km on a spherical Earth.
+
+    Args:
+        lat, lon: Query point(s) in degrees
+        lats, lons: Facility coordinates in degrees (arrays broadcastable with the query)
+
+    Returns:
+        Array of distances in kilometres
+    """
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(np.asarray(lats, dtype=np.float64)), np.radians(np.asarray(lons, dtype=np.float64))
+    return EARTH_RADIUS_KM * _central_angle(lat1, lon1, lat2, lon2)
+
+
+def ellipsoidal_km(lat, lon, lats, lons):
+    """
+    Distances in km on the WGS-84 ellipsoid using Lambert's formula.
+
+    Args:
+        lat, lon: Query point(s) in degrees
+        lats, lons: Facility coordinates in degrees (arrays broadcastable with the query)
+
+    Returns:
+        Array of distances in kilometres (metre-level agreement with geodesic())
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+
+    # Reduced (parametric) latitudes
+    beta1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat)))
+    beta2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lats)))
+    sigma = _central_angle(beta1, np.radians(lon), beta2, np.radians(lons))
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    sin_half_sigma_sq = np.sin(sigma / 2) ** 2
+    cos_half_sigma_sq = np.cos(sigma / 2) ** 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / cos_half_sigma_sq
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / sin_half_sigma_sq
+        distance = WGS84_A_KM * (sigma - WGS84_F / 2 * (x + y))
+
+    # Coincident points make the correction terms 0/0
+    return np.where(sigma == 0, 0.0, distance)
+
+
+# Default engine used by the API
+distance_km = ellipsoidal_km
+
+
+def bounding_box(lat: float, lon: float, radius_km: float, slack: float = 0.01):
+    """
+    Latitude/longitude box containing every point within radius_km.
+
+    The longitude half-width is asin(sin(r / R) / cos(lat)), the widest the
+    circle gets, rather than a flat r / 111 km: a degree of longitude
+    shrinks with cos(lat). `slack` widens the radius to cover the difference
+    between the sphere and the ellipsoid. When the circle reaches a pole
+    every longitude is included. The box does not wrap the antimeridian.
+
+    Returns:
+        Tuple of (min_lat, max_lat, min_lon, max_lon) in degrees
+    """
+    angle = radius_km * (1 + slack) / EARTH_RADIUS_KM
+    lat_delta = np.degrees(angle)
+    min_lat, max_lat = lat - lat_delta, lat + lat_delta
+    if min_lat <= -90 or max_lat >= 90 or angle >= np.pi / 2:
+        return max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0
+
+    lon_delta = np.degrees(np.arcsin(min(1.0, np.sin(angle) / np.cos(np.radians(lat)))))
+    return min_lat, max_lat, lon - lon_delta, lon + lon_delta
+
+
+# Upper bound on the memory one block of the point-by-facility distance
+# matrix takes to compute, temporaries included
+DISTANCE_BLOCK_BYTES = 32 * 1024 * 1024
+# Peak number of float64 arrays of a block's shape alive at once: about 9.2
+# while ellipsoidal_km runs (measured with tracemalloc), plus the previous
+# block, which is still referenced until the new one is assigned, and some
+# margin. One block of distances is this many times smaller than
+# DISTANCE_BLOCK_BYTES.
+DISTANCE_TEMPORARIES = 12
+
+
+def nearest_in_blocks(query_lats, query_lons, lats, lons, k_per_query, block_bytes: int = DISTANCE_BLOCK_BYTES, keys=None):
+    """
+    Exact k-nearest facilities for many query points at once.
+
+    The point-by-facility distance matrix is computed a block of query rows
+    at a time, with the block height chosen so computing one block (the
+    distances and the DISTANCE_TEMPORARIES arrays of their shape that
+    distance_km creates) stays under block_bytes however large the facility
+    table is.
+
+    Args:
+        query_lats, query_lons: Query points in degrees
+        lats, lons: Facility coordinates in degrees
+        k_per_query: Number of facilities wanted for each query point
+        block_bytes: Memory bound for computing one block of the distance matrix
+        keys: Per-facility tie-breakers (e.g. facility ids); positions if omitted
+
+    Returns:
+        List with one (facility positions, distances in km) tuple per query,
+        nearest first, ties broken by key
+    """
+    query_lats = np.asarray(query_lats, dtype=np.float64)
+    query_lons = np.asarray(query_lons, dtype=np.float64)
+    k_per_query = np.minimum(np.asarray(k_per_query, dtype=np.intp), len(lats))
+    rows_per_block = max(1, block_bytes // (8 * DISTANCE_TEMPORARIES * max(len(lats), 1)))
+    keys = np.arange(len(lats)) if keys is None else np.asarray(keys)
+
+    results = []
+    for start in range(0, len(query_lats), rows_per_block):
+        stop = start + rows_per_block
+        block = distance_km(query_lats[start:stop, None], query_lons[start:stop, None], lats[None, :], lons[None, :])
+        ks = k_per_query[start:stop]
+        k_max = int(ks.max()) if len(ks) else 0
+        if k_max == 0:
+            results.extend((np.empty(0, dtype=np.intp), np.empty(0)) for _ in ks)
+            continue
+
+        # k-th smallest distance per row; everything up to it (ties included)
+        # is a candidate, so ordering matches a full sort exactly
+        # Copied out so the partitioned copy of the block can be freed
+        kth = np.partition(block, k_max - 1, axis=1)[:, k_max - 1].copy()
+        for row, k in enumerate(ks):
+            candidates = np.flatnonzero(block[row] <= kth[row])
+            distances = block[row, candidates]
+            order = np.lexsort((keys[candidates], distances))[:k]
+            results.append((candidates[order], distances[order]))
+    return results
@@ -0,0 +1,132 @@
+"""
+Coordinate-quantized result caching for nearest-facility queries.
+
+Caching /recommend-hospitals on its exact arguments never hits: GPS fixes
+practically never repeat to the last decimal. GeoCellCache instead snaps
+each query to a cell of a fixed latitude/longitude grid and caches, per
+cell and filter combination, a *candidate superset*: a set of facilities
+guaranteed to contain the exact nearest MAX_TOP_N facilities of every point
+inside the cell. A request re-ranks only that superset by its own exact
+distances, so results are identical to an uncached search and any top_n up
+to MAX_TOP_N is served from the same entry.
+
+Why the superset is sufficient: let c be the cell centre, r the largest
+distance from c to any point of the cell, and D the distance from c to its
+K-th nearest facility. For a query point p in the cell, those K facilities
+are all within D + r of p, so p's own K nearest are within D + r of p, and
+therefore within D + 2r of c (triangle inequality). Caching every facility
+within D + 2r of c (plus a metre-level slack for the distance
+approximation) covers all of them, ties included.
+
+Entries are kept in an LRU of bounded size. Hits and misses are counted so
+the hit rate can be reported.
+"""
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+from geo import distance_km
+from spatial_index import FacilitySpatialIndex
+
+# Largest top_n the API serves; supersets are built for this many results
+MAX_TOP_N = 50
+
+# Allowance for the ellipsoidal approximation not being an exact metric (km)
+_TRIANGLE_SLACK_KM = 0.01
+
+
+class GeoCellCache:
+    """LRU of per-grid-cell candidate supersets for exact k-nearest re-ranking"""
+
+    def __init__(self, spatial_index: FacilitySpatialIndex, cell_deg: float = 0.05, capacity: int = 50000, max_k: int = MAX_TOP_N):
+        self.spatial_index = spatial_index
+        self.cell_deg = cell_deg
+        self.capacity = capacity
+        self.max_k = max_k
+        self._entries: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cell_of(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def _superset(self, cell: Tuple[int, int], subset: Optional[np.ndarray]) -> np.ndarray:
+        """Facilities that can appear in the top max_k of any point of the cell"""
+        size = len(self.spatial_index) if subset is None else len(subset)
+        if size <= self.max_k:
+            return np.arange(size) if subset is None else subset
+
+        south, west = cell[0] * self.cell_deg, cell[1] * self.cell_deg
+        center_lat, center_lon = south + self.cell_deg / 2, west + self.cell_deg / 2
+        corner_lats = np.array([south, south, south + self.cell_deg, south + self.cell_deg])
+        corner_lons = np.array([west, west + self.cell_deg, west, west + self.cell_deg])
+        half_diagonal = distance_km(center_lat, center_lon, corner_lats, corner_lons).max()
+
+        _, nearest = self.spatial_index.nearest(center_lat, center_lon, self.max_k, subset)
+        radius = nearest[-1] + 2 * half_diagonal + _TRIANGLE_SLACK_KM
+        candidates, _ = self.spatial_index.within(center_lat, center_lon, radius, subset)
+        return np.sort(candidates)
+
+    def candidates(self, lat: float, lon: float, k: int, subset: Optional[np.ndarray] = None, filter_key: Hashable = None) -> np.ndarray:
+        """
+        Row positions guaranteed to contain the k nearest facilities, unordered.
+
+        This is the cell's cached superset (computed on a miss), or the exact
+        k nearest when k is above max_k and the cache is bypassed.
+        """
+        if k > self.max_k:
+            return self.spatial_index.nearest(lat, lon, k, subset)[0]
+
+        key = (filter_key, self.cell_of(lat, lon))
+        with self._lock:
+            candidates = self._entries.get(key)
+            if candidates is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if candidates is None:
+            candidates = self._superset(key[1], subset)
+            with self._lock:
+                self._entries[key] = candidates
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+        return candidates
+
+    def nearest(self, lat: float, lon: float, k: int, subset: Optional[np.ndarray] = None, filter_key: Hashable = None):
+        """
+        Exact k nearest facilities, served from the cell's cached superset.
+
+        Args:
+            lat, lon: Query point in degrees
+            k: Number of facilities wanted (above max_k the cache is bypassed)
+            subset: Sorted row positions the filters select, or None
+            filter_key: Hashable description of the filters that produced subset
+
+        Returns:
+            Tuple of (row positions, distances in km), nearest first
+        """
+        candidates = self.candidates(lat, lon, k, subset, filter_key)
+        distances = self.spatial_index.distances(lat, lon, candidates)
+        order = np.lexsort((self.spatial_index.keys[candidates], distances))[:k]
+        return candidates[order], distances[order]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "cell_deg": self.cell_deg,
+            }
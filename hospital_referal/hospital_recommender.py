@@ -1,59 +1,123 @@
+import numpy as np
 import pandas as pd
-from geopy.distance import geodesic
+import base64
+import json
 import logging
-from typing import Tuple, Optional
+from typing import Any, Dict, List, Tuple, Optional
 import os
 
+from data_cache import FacilityDataCache, file_digest
+from dataset_manager import DatasetManager, build_transfer_graph
+from facility_index import FACILITY_CATEGORIES, normalize_facility_type
+from geo import nearest_in_blocks
+from ingest import stable_facility_ids, standardize_columns, valid_coordinates
+from performance import performance_monitor
+from transfer_graph import TransferGraph
+
 logger = logging.getLogger(__name__)
 
-def load_hospital_data():
-    """Load and clean hospital data with proper error handling"""
-    try:
-        if not os.path.exists("camerounhopitals.xlsx"):
-            raise FileNotFoundError("Hospital data file not found")
+HOSPITAL_DATA_FILE = os.getenv("HOSPITAL_DATA_FILE", "camerounhopitals.xlsx")
+
+def clean_hospital_data(df: pd.DataFrame) -> pd.DataFrame:
+    """Normalize column names, drop unusable coordinates and derive categories"""
+    df = standardize_columns(df)
+
+    # Clean data
+    initial_count = len(df)
+    df = df[valid_coordinates(df)]
+    df = df.reset_index(drop=True)
+
+    # float64 coordinate columns hand the distance engine zero-copy arrays
+    df["latitude"] = df["latitude"].astype(np.float64)
+    df["longitude"] = df["longitude"].astype(np.float64)
+
+    # Ids for clients (e.g. referral escalation) that survive edits to the
+    # source file, derived from name and coordinates rather than row position
+    df.insert(0, "facility_id", stable_facility_ids(df))
+
+    # Clean facility names
+    df["facility_name"] = df["facility_name"].str.strip()
+    df["facility_type"] = df["facility_type"].str.strip()
+
+    # Normalize free-text facility types into the category taxonomy
+    df["facility_category"] = df["facility_type"].map(normalize_facility_type).astype("category")
 
-        df = pd.read_excel("camerounhopitals.xlsx")
-        logger.info(f"Loaded {len(df)} hospital records")
+    final_count = len(df)
+    logger.info("Cleaned data: %d -> %d records", initial_count, final_count)
+    return df
 
-        # Clean column names
-        df.columns = df.columns.str.lower().str.strip()
-        df = df.rename(columns={
-            "facility_n": "facility_name",
-            "facility_t": "facility_type",
-            "lat": "latitude",
-            "long": "longitude"
-        })
+def load_hospital_data(path: str = HOSPITAL_DATA_FILE, use_cache: bool = True) -> Tuple[pd.DataFrame, TransferGraph]:
+    """
+    Load the cleaned hospital table and its transfer graph, from the columnar
+    cache when it is current.
 
-        # Clean data
-        initial_count = len(df)
-        df = df[df["latitude"].notnull() & df["longitude"].notnull()]
-        df = df[(df["latitude"] != 0) & (df["longitude"] != 0)]
-        df = df[(df["latitude"].between(-90, 90)) & (df["longitude"].between(-180, 180))]
+    The file (xlsx, or CSV as written by ingest.py) is only parsed (and the graph only built) when the cache is
+    missing or was built from a different version of the file; the fresh
+    results are then cached. The frame's attrs["source_sha256"] holds the
+    file's SHA-256, the dataset version audit records carry.
+    """
+    try:
+        if not os.path.exists(path):
+            raise FileNotFoundError("Hospital data file not found")
 
-        # Clean facility names
-        df["facility_name"] = df["facility_name"].str.strip()
-        df["facility_type"] = df["facility_type"].str.strip()
+        cache = FacilityDataCache(path) if use_cache else None
+        source_digest = cache.source_digest if cache else file_digest(path)
+        cached = cache.load_frame() if cache else None
+        if cached is not None:
+            df, extras = cached
+            graph = TransferGraph.from_arrays(extras)
+            if graph is not None:
+                logger.info("Loaded %d hospital records from cache %s", len(df), cache.path)
+                df.attrs["source_sha256"] = source_digest
+                return df, graph
 
-        final_count = len(df)
-        logger.info(f"Cleaned data: {initial_count} -> {final_count} records")
+        df = pd.read_csv(path) if path.lower().endswith(".csv") else pd.read_excel(path)
+        logger.info("Loaded %d hospital records", len(df))
+        df = clean_hospital_data(df)
+        graph = build_transfer_graph(df)
 
-        return df
+        if cache:
+            cache.save_frame(df, graph.to_arrays())
+        # Dataset version recorded in the audit trail
+        df.attrs["source_sha256"] = source_digest
+        return df, graph
 
     except Exception as e:
-        logger.error(f"Error loading hospital data: {e}")
+        logger.error("Error loading hospital data: %s", e)
         raise
 
-# Load data at startup
-df = load_hospital_data()
+RESULT_COLUMNS = ["facility_id", "facility_name", "facility_type", "latitude", "longitude", "distance_km"]
+
+# Load data and build the indexes at startup. Each function below reads
+# dataset.snapshot once and works on that consistent version throughout.
+dataset = DatasetManager(load_hospital_data)
 
-def recommend_hospitals(patient_coords: Tuple[float, float], top_n: int = 5, required_type: Optional[str] = None) -> pd.DataFrame:
+_SNAPSHOT_ATTRIBUTES = ("df", "spatial_index", "attribute_index", "location_cache", "transfer_graph")
+
+def __getattr__(name):
+    # Module-level views (hospital_recommender.df etc.) of the current snapshot
+    if name in _SNAPSHOT_ATTRIBUTES:
+        return getattr(dataset.snapshot, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def recommend_hospitals(
+    patient_coords: Tuple[float, float],
+    top_n: int = 5,
+    required_type: Optional[str] = None,
+    category: Optional[str] = None,
+    region: Optional[str] = None,
+    ownership: Optional[str] = None
+) -> pd.DataFrame:
     """
-    Recommend hospitals based on patient location and optional type filter.
+    Recommend hospitals based on patient location and optional filters.
 
     Args:
         patient_coords: Tuple of (latitude, longitude)
         top_n: Number of hospitals to return
-        required_type: Optional filter by facility type
+        required_type: Optional filter by facility type (case-insensitive substring)
+        category: Optional normalized facility category (see FACILITY_CATEGORIES)
+        region: Optional region (Admin1) name
+        ownership: Optional ownership value
 
     Returns:
         DataFrame with recommended hospitals
@@ -64,49 +128,304 @@ def recommend_hospitals(patient_coords: Tuple[float, float], top_n: int = 5, req
         if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
             raise ValueError(f"Invalid coordinates: lat={lat}, lon={lon}")
 
-        data = df.copy()
-        logger.info(f"Starting with {len(data)} hospitals")
+        snapshot = dataset.snapshot
+        logger.debug("Starting with %d hospitals", snapshot.facility_count)
+
+        # Combine the filters into one row set from the precomputed indexes
+        with performance_monitor.stage("recommend_hospitals", "filter"):
+            subset = snapshot.select(required_type, category, region, ownership)
+        if subset is not None:
+            logger.debug(
+                "After filters type=%s category=%s region=%s ownership=%s: %d hospitals",
+                required_type, category, region, ownership, len(subset)
+            )
+
+            if len(subset) == 0:
+                logger.warning(
+                    "No hospitals found matching type=%s category=%s region=%s ownership=%s",
+                    required_type, category, region, ownership
+                )
+                return pd.DataFrame(columns=RESULT_COLUMNS)
 
-        # Apply type filter if specified
-        if required_type:
-            original_count = len(data)
-            data = data[data["facility_type"].str.contains(required_type, case=False, na=False)]
-            logger.info(f"After type filter '{required_type}': {len(data)} hospitals")
+        # k-nearest search re-ranking the query cell's cached candidates (built
+        # from the spatial index on a miss); exact distances are only computed
+        # for that handful of facilities
+        filter_key = (required_type, category, region, ownership)
+        with performance_monitor.stage("recommend_hospitals", "distance"):
+            candidates = snapshot.location_cache.candidates(lat, lon, top_n, subset, filter_key)
+            distances = snapshot.spatial_index.distances(lat, lon, candidates)
 
-            if data.empty:
-                logger.warning(f"No hospitals found matching type: {required_type}")
-                return pd.DataFrame(columns=["facility_name", "facility_type", "latitude", "longitude", "distance_km"])
+        with performance_monitor.stage("recommend_hospitals", "sort"):
+            order = np.lexsort((snapshot.spatial_index.keys[candidates], distances))[:top_n]
+            result = snapshot.df.iloc[candidates[order]][RESULT_COLUMNS[:-1]].assign(
+                distance_km=np.round(distances[order], 2)
+            )
+        logger.debug("Returning %d hospitals", len(result))
 
-        # Calculate distances
-        def calculate_distance(row):
-            try:
-                return geodesic(patient_coords, (row["latitude"], row["longitude"])).km
-            except Exception as e:
-                logger.warning(f"Error calculating distance for {row['facility_name']}: {e}")
-                return float('inf')
+        return result
 
-        data["distance_km"] = data.apply(calculate_distance, axis=1)
+    except Exception as e:
+        logger.error("Error in recommend_hospitals: %s", e)
+        raise
 
-        # Remove hospitals with invalid distances
-        data = data[data["distance_km"] != float('inf')]
+def hospitals_within_radius(
+    patient_coords: Tuple[float, float],
+    radius_km: float,
+    offset: int = 0,
+    limit: int = 20,
+    required_type: Optional[str] = None,
+    category: Optional[str] = None,
+    region: Optional[str] = None,
+    ownership: Optional[str] = None
+) -> Tuple[int, pd.DataFrame]:
+    """
+    All hospitals within a radius of the patient, nearest first, one page at a time.
 
-        # Sort by distance and get top N
-        data = data.sort_values("distance_km").head(top_n)
-        data["distance_km"] = data["distance_km"].round(2)
+    The spatial index's ball query keeps only facilities near the circle,
+    and exact distances are computed for those survivors alone.
 
-        result = data[["facility_name", "facility_type", "latitude", "longitude", "distance_km"]]
-        logger.info(f"Returning {len(result)} hospitals")
+    Args:
+        patient_coords: Tuple of (latitude, longitude)
+        radius_km: Search radius in kilometres
+        offset: Number of facilities to skip
+        limit: Maximum number of facilities to return
+        required_type, category, region, ownership: Optional filters, as for recommend_hospitals
 
-        return result
+    Returns:
+        Tuple of (total number of facilities in the radius, DataFrame for the page)
+    """
+    lat, lon = patient_coords
+    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        raise ValueError(f"Invalid coordinates: lat={lat}, lon={lon}")
+    if radius_km <= 0:
+        raise ValueError(f"Invalid radius: {radius_km}")
+
+    snapshot = dataset.snapshot
+    subset = snapshot.select(required_type, category, region, ownership)
+    if subset is not None and len(subset) == 0:
+        return 0, pd.DataFrame(columns=RESULT_COLUMNS)
+
+    positions, distances = snapshot.spatial_index.within(lat, lon, radius_km, subset)
+    page = slice(offset, offset + limit)
+    result = snapshot.df.iloc[positions[page]][RESULT_COLUMNS[:-1]].assign(distance_km=np.round(distances[page], 2))
+    return len(positions), result
+
+# "d" and "i" are the distance and facility_id of the last facility returned,
+# "v" the snapshot version they refer to
+_CURSOR_FIELDS = ("lat", "lon", "type", "category", "region", "ownership", "d", "i", "w", "v")
+
+class StaleCursorError(ValueError):
+    """A cursor issued for a facility snapshot that has since been replaced"""
+
+def encode_cursor(state: Dict[str, Any]) -> str:
+    """Opaque, URL-safe token for a nearest-facility iteration state"""
+    payload = json.dumps([state[name] for name in _CURSOR_FIELDS], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(token: str) -> Dict[str, Any]:
+    """Iteration state from a cursor made by encode_cursor(); ValueError if malformed"""
+    try:
+        payload = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(payload)
+        if not isinstance(values, list) or len(values) != len(_CURSOR_FIELDS):
+            raise ValueError("wrong shape")
+        state = dict(zip(_CURSOR_FIELDS, values))
+        state["d"], state["i"], state["w"] = float(state["d"]), int(state["i"]), float(state["w"])
+        state["v"] = int(state["v"])
+        if not (-90 <= state["lat"] <= 90) or not (-180 <= state["lon"] <= 180):
+            raise ValueError("coordinates out of range")
+        return state
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def nearest_hospitals_page(
+    patient_coords: Tuple[float, float],
+    page_size: int = 20,
+    required_type: Optional[str] = None,
+    category: Optional[str] = None,
+    region: Optional[str] = None,
+    ownership: Optional[str] = None,
+    cursor: Optional[Dict[str, Any]] = None
+) -> Tuple[pd.DataFrame, Optional[Dict[str, Any]]]:
+    """
+    One page of an incremental nearest-facility iteration.
+
+    The first page is an ordinary k-nearest search. Every page also returns
+    the iteration state (query, filters, last distance and facility_id,
+    snapshot version) from which the next page continues: the search resumes
+    in the annulus beyond the last facility returned instead of re-ranking
+    everything before it. Facilities at equal distances are ordered by
+    facility_id.
+
+    Args:
+        patient_coords: Tuple of (latitude, longitude); ignored when resuming
+        page_size: Number of hospitals per page
+        required_type, category, region, ownership: Optional filters; ignored when resuming
+        cursor: State returned with the previous page (see decode_cursor)
+
+    Returns:
+        Tuple of (DataFrame for the page, state for the next page or None when exhausted)
+
+    Raises:
+        StaleCursorError: The cursor was issued for an earlier snapshot; facilities
+            added or moved since could be skipped, so the iteration must restart
+    """
+    if cursor is not None:
+        lat, lon = cursor["lat"], cursor["lon"]
+        required_type, category = cursor["type"], cursor["category"]
+        region, ownership = cursor["region"], cursor["ownership"]
+    else:
+        lat, lon = patient_coords
+    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        raise ValueError(f"Invalid coordinates: lat={lat}, lon={lon}")
+
+    snapshot = dataset.snapshot
+    if cursor is not None and cursor["v"] != snapshot.version:
+        raise StaleCursorError(
+            f"Cursor is from facility data version {cursor['v']}, now at {snapshot.version}; "
+            "start again from the first page"
+        )
+    subset = snapshot.select(required_type, category, region, ownership)
+    if cursor is None:
+        positions, distances = snapshot.spatial_index.nearest(lat, lon, page_size, subset)
+    else:
+        positions, distances = snapshot.spatial_index.nearest_after(
+            lat, lon, page_size, (cursor["d"], cursor["i"]), subset, cursor["w"]
+        )
+
+    page = snapshot.df.iloc[positions][RESULT_COLUMNS[:-1]].assign(distance_km=np.round(distances, 2))
+    if len(positions) < page_size:
+        return page, None
+
+    return page, {
+        "lat": lat, "lon": lon,
+        "type": required_type, "category": category, "region": region, "ownership": ownership,
+        "d": float(distances[-1]), "i": int(snapshot.df["facility_id"].iat[positions[-1]]),
+        # The next annulus starts as wide as this page's distance span
+        "w": max(float(distances[-1] - distances[0]), 1.0),
+        "v": snapshot.version,
+    }
+
+def batch_recommend_hospitals(queries: List[Dict]) -> List[List[Dict]]:
+    """
+    Recommend hospitals for many patient locations in one pass.
+
+    Queries sharing the same filters are solved together with the blocked
+    distance matrix, so hundreds of locations cost a few vectorized passes
+    rather than hundreds of separate searches.
+
+    Args:
+        queries: Dicts with "lat", "lon" and optional "top_n", "type",
+            "category", "region" and "ownership" keys
+
+    Returns:
+        One list of result records per query, in input order
+    """
+    try:
+        snapshot = dataset.snapshot
+        results: List[Optional[List[Dict]]] = [None] * len(queries)
+
+        groups: Dict[tuple, List[int]] = {}
+        for i, query in enumerate(queries):
+            lat, lon = query["lat"], query["lon"]
+            if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+                raise ValueError(f"Invalid coordinates in query {i}: lat={lat}, lon={lon}")
+            key = tuple(query.get(name) for name in ("type", "category", "region", "ownership"))
+            groups.setdefault(key, []).append(i)
+
+        ids = snapshot.df["facility_id"].to_numpy()
+        names = snapshot.df["facility_name"].to_numpy()
+        types = snapshot.df["facility_type"].to_numpy()
+        latitudes = snapshot.df["latitude"].to_numpy()
+        longitudes = snapshot.df["longitude"].to_numpy()
+
+        for key, members in groups.items():
+            subset = snapshot.select(*key)
+            rows = np.arange(len(snapshot.df)) if subset is None else subset
+            found = nearest_in_blocks(
+                [queries[i]["lat"] for i in members],
+                [queries[i]["lon"] for i in members],
+                latitudes[rows],
+                longitudes[rows],
+                [queries[i].get("top_n", 5) for i in members],
+                keys=ids[rows],
+            )
+            for i, (local, distances) in zip(members, found):
+                positions = rows[local]
+                results[i] = [
+                    {
+                        "facility_id": int(ids[p]),
+                        "facility_name": names[p],
+                        "facility_type": types[p],
+                        "latitude": float(latitudes[p]),
+                        "longitude": float(longitudes[p]),
+                        "distance_km": round(float(d), 2),
+                    }
+                    for p, d in zip(positions, distances)
+                ]
+
+        logger.debug("Solved %d batch queries in %d filter groups", len(queries), len(groups))
+        return results
 
     except Exception as e:
-        logger.error(f"Error in recommend_hospitals: {e}")
+        logger.error("Error in batch_recommend_hospitals: %s", e)
         raise
 
+def escalate_referral(facility_id: int, min_level: Optional[int] = None, top_n: int = 5) -> Tuple[Dict, pd.DataFrame]:
+    """
+    Nearest higher-level facilities to refer a patient on to from a facility.
+
+    Answered from the precomputed transfer graph, without a distance search.
+    While admin edits have made the graph stale (until the background
+    rebuild), the same answer is computed with an exact spatial search.
+
+    Args:
+        facility_id: Id of the referring facility
+        min_level: Lowest acceptable care level; defaults to one above the facility's own
+        top_n: Number of facilities to return (at most the graph's k per level)
+
+    Returns:
+        Tuple of (referring facility record, DataFrame of destinations with
+        their category and level)
+
+    Raises:
+        KeyError: If no facility has this id
+    """
+    snapshot = dataset.snapshot
+    position = snapshot.position_of(facility_id)
+
+    row = snapshot.df.iloc[position]
+    level = FACILITY_CATEGORIES.get(row["facility_category"], 0)
+    facility = {
+        "facility_id": int(row["facility_id"]),
+        "facility_name": row["facility_name"],
+        "facility_type": row["facility_type"],
+        "facility_category": row["facility_category"],
+        "level": level,
+        "latitude": float(row["latitude"]),
+        "longitude": float(row["longitude"]),
+    }
+
+    min_level = level + 1 if min_level is None else min_level
+    if snapshot.transfer_graph is not None:
+        positions, distances = snapshot.transfer_graph.escalation(position, min_level, top_n)
+    else:
+        levels = snapshot.df["facility_category"].map(FACILITY_CATEGORIES).astype(int).to_numpy()
+        rows = snapshot.select()
+        rows = np.flatnonzero(levels >= min_level) if rows is None else rows[levels[rows] >= min_level]
+        positions, distances = snapshot.spatial_index.nearest(
+            row["latitude"], row["longitude"], top_n, rows[rows != position]
+        )
+    result = snapshot.df.iloc[positions][RESULT_COLUMNS[:-1] + ["facility_category"]].assign(
+        level=lambda frame: frame["facility_category"].map(FACILITY_CATEGORIES).astype(int),
+        distance_km=np.round(distances, 2)
+    )
+    return facility, result
+
 def get_facility_types() -> list:
     """Get list of available facility types"""
     try:
-        return sorted(df["facility_type"].dropna().unique().tolist())
+        return dataset.snapshot.attribute_index.type_names()
     except Exception as e:
-        logger.error(f"Error getting facility types: {e}")
+        logger.error("Error getting facility types: %s", e)
         return []
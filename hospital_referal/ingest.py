@@ -0,0 +1,470 @@
+"""
+Ingestion pipeline for facility registries.
+
+Builds the facility table the API loads from one or more registry files
+(CSV, GeoJSON or xlsx, in priority order), in stages:
+
+  read       sources are streamed in chunks of --chunksize rows (GeoJSON is
+             decoded one feature at a time, never as a whole document)
+  repair     mojibake (UTF-8 read as CP437, see fix_encoding.py) is detected
+             with one vectorized pattern match per column and each distinct
+             damaged value is repaired once
+  validate   coordinates are coerced to float64 and rows with missing,
+             zero, out-of-range or out-of-bounds coordinates are dropped
+             with a single combined mask
+  normalize  names, types, regions and ownership are whitespace-normalized
+  categorize free-text types are mapped onto FACILITY_CATEGORIES, once per
+             distinct type
+  dedup      facilities are bucketed into grid cells of --dedup-radius-km;
+             only pairs in the same or adjacent cells are compared, and a
+             pair is a duplicate when it is within the radius and the folded
+             names are at least --name-similarity alike. Each duplicate
+             cluster keeps its first record (earliest source wins).
+  write      the table is written in the registry's column layout (xlsx or
+             CSV), ready for load_hospital_data()
+
+and prints how long each stage took and how many rows went in and out.
+
+Run with:
+    python ingest.py registry.csv extra.geojson --output facilities.xlsx
+"""
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from facility_index import _fold, normalize_facility_type
+from geo import EARTH_RADIUS_KM, distance_km
+
+# Column names accepted for each field, after lowercasing
+COLUMN_ALIASES = {
+    "facility_n": "facility_name", "name": "facility_name",
+    "facility_t": "facility_type", "type": "facility_type",
+    "lat": "latitude", "y": "latitude",
+    "long": "longitude", "lon": "longitude", "lng": "longitude", "x": "longitude",
+    "region": "admin1",
+    "owner": "ownership",
+}
+
+# Output columns, in the registry's own naming, as read by clean_hospital_data()
+OUTPUT_COLUMNS = {
+    "country": "Country", "admin1": "Admin1", "facility_name": "Facility_n", "facility_type": "Facility_t",
+    "ownership": "Ownership", "latitude": "Lat", "longitude": "Long", "ll_source": "LL_source",
+}
+
+TEXT_COLUMNS = ["facility_name", "facility_type", "admin1", "ownership"]
+
+# Box-drawing and other CP437 characters that UTF-8 accents turn into
+MOJIBAKE_MARKERS = re.compile("[├┬┤╗╝╚╔═║│┼▒░▓ΓÇÖ⌐]")
+
+DEFAULT_CHUNKSIZE = 50000
+# Characters of a GeoJSON file read at a time
+GEOJSON_BLOCK_CHARS = 1 << 16
+DEFAULT_DEDUP_RADIUS_KM = 0.2
+DEFAULT_NAME_SIMILARITY = 0.85
+
+# Facility ids stay below 2**53 so JavaScript and Dart clients read them exactly
+FACILITY_ID_BITS = 52
+# ~1 m: coordinates differing only beyond this keep a facility's id
+FACILITY_ID_COORD_DECIMALS = 5
+
+
+# --- Shared cleaning helpers (also used by clean_hospital_data) ------------
+
+def standardize_columns(frame: pd.DataFrame) -> pd.DataFrame:
+    """Lowercase column names and map known aliases onto the API's names"""
+    frame.columns = frame.columns.str.lower().str.strip()
+    return frame.rename(columns={k: v for k, v in COLUMN_ALIASES.items() if v not in frame.columns})
+
+
+def valid_coordinates(frame: pd.DataFrame, bounds: Optional[Sequence[float]] = None) -> pd.Series:
+    """One boolean mask for rows with usable coordinates (inside bounds, if given)"""
+    lat, lon = frame["latitude"], frame["longitude"]
+    mask = lat.notnull() & lon.notnull() & (lat != 0) & (lon != 0) & lat.between(-90, 90) & lon.between(-180, 180)
+    if bounds is not None:
+        min_lat, max_lat, min_lon, max_lon = bounds
+        mask &= lat.between(min_lat, max_lat) & lon.between(min_lon, max_lon)
+    return mask
+
+
+def facility_id_for(name, lat: float, lon: float, taken=()) -> int:
+    """
+    Stable id for a facility, derived from its folded name and rounded
+    coordinates rather than its row position.
+
+    Editing or re-ordering the registry, or re-ingesting it, leaves the ids of
+    unchanged facilities as they were, so ids held by clients (referrals,
+    audit records, cursors) keep pointing at the same facility. A hash that
+    is already in `taken` (a duplicate or a collision) moves on to the next
+    free id.
+    """
+    folded = " ".join(_fold(name).split()) if isinstance(name, str) else ""
+    key = f"{folded}|{lat:.{FACILITY_ID_COORD_DECIMALS}f}|{lon:.{FACILITY_ID_COORD_DECIMALS}f}"
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    facility_id = int.from_bytes(digest, "big") >> (64 - FACILITY_ID_BITS)
+    while facility_id in taken:
+        facility_id = (facility_id + 1) % (1 << FACILITY_ID_BITS)
+    return facility_id
+
+
+def stable_facility_ids(frame: pd.DataFrame) -> np.ndarray:
+    """facility_id_for() of every row, unique within the frame (earlier rows win ties)"""
+    taken = set()
+    ids = np.empty(len(frame), dtype=np.int64)
+    for row, (name, lat, lon) in enumerate(zip(frame["facility_name"], frame["latitude"], frame["longitude"])):
+        ids[row] = facility_id_for(name, float(lat), float(lon), taken)
+        taken.add(int(ids[row]))
+    return ids
+
+
+def fix_mojibake(value):
+    """Undo UTF-8 text decoded as CP437; other values are returned unchanged"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return value.encode("cp437").decode("utf-8")
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        # Value wasn't actually mis-decoded this way — leave it alone.
+        return value
+
+
+def repair_mojibake(values: pd.Series) -> pd.Series:
+    """Vectorized fix_mojibake(): only distinct values carrying markers are decoded"""
+    damaged = values.astype("string").str.contains(MOJIBAKE_MARKERS, na=False).to_numpy()
+    if not damaged.any():
+        return values
+    repairs = {value: fix_mojibake(value) for value in pd.unique(values[damaged])}
+    repaired = values.copy()
+    repaired[damaged] = values[damaged].map(repairs)
+    return repaired
+
+
+# --- Readers ---------------------------------------------------------------
+
+class _JSONStream:
+    """One JSON document decoded a value at a time, reading the file in blocks"""
+
+    def __init__(self, handle, block_chars: int = GEOJSON_BLOCK_CHARS):
+        self.handle = handle
+        self.block_chars = block_chars
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read(self) -> bool:
+        """Append the next block, dropping what has been consumed; False at the end of the file"""
+        block = self.handle.read(self.block_chars)
+        if not block:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Next non-whitespace character, or "" at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._read():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        """Consume the next character, which must be one of chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed GeoJSON: expected one of {chars!r}, found {char or 'end of file'!r}")
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        """Decode the next complete value, reading more of the file until it is"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the very end of the buffer may continue in the next block
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+
+def _iter_geojson_features(handle, block_chars: int = GEOJSON_BLOCK_CHARS) -> Iterator[Dict]:
+    """Features of a FeatureCollection one at a time, without loading the whole file"""
+    stream = _JSONStream(handle, block_chars)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if key == "features":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.pos += 1
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            # Other members ("type", "crs", ...) are small
+            stream.value()
+        if stream.expect(",}") == "}":
+            return
+
+
+def _read_geojson(path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    with open(path, encoding="utf-8") as handle:
+        rows = []
+        for feature in _iter_geojson_features(handle):
+            row = dict(feature.get("properties") or {})
+            geometry = feature.get("geometry") or {}
+            if geometry.get("type") == "Point" and len(geometry.get("coordinates") or []) >= 2:
+                row["longitude"], row["latitude"] = geometry["coordinates"][:2]
+            rows.append(row)
+            if len(rows) == chunksize:
+                yield pd.DataFrame(rows)
+                rows = []
+        if rows:
+            yield pd.DataFrame(rows)
+
+
+def _read_xlsx(path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(name) for name in next(rows)]
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header)
+    finally:
+        workbook.close()
+
+
+def read_source(path: str, chunksize: int = DEFAULT_CHUNKSIZE) -> Iterator[pd.DataFrame]:
+    """Chunks of a registry file with standardized column names"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        chunks = pd.read_csv(path, chunksize=chunksize, encoding="utf-8")
+    elif extension in (".geojson", ".json"):
+        chunks = _read_geojson(path, chunksize)
+    elif extension in (".xlsx", ".xlsm"):
+        chunks = _read_xlsx(path, chunksize)
+    else:
+        raise ValueError(f"Unsupported registry format: {path}")
+    for chunk in chunks:
+        yield standardize_columns(chunk)
+
+
+# --- Deduplication ---------------------------------------------------------
+
+def candidate_pairs(latitudes: np.ndarray, longitudes: np.ndarray, cell_km: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Index pairs (i < j) in the same or adjacent grid cells of about cell_km.
+
+    Longitude cells are widened by the cosine of the highest latitude so a
+    cell is never narrower than cell_km on the ground.
+    """
+    if len(latitudes) < 2 or cell_km <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    lat_step = np.degrees(cell_km / EARTH_RADIUS_KM)
+    lon_step = lat_step / max(np.cos(np.radians(np.abs(latitudes).max())), 1e-6)
+    cells = pd.DataFrame({
+        "row": np.floor(latitudes / lat_step).astype(np.int64),
+        "col": np.floor(longitudes / lon_step).astype(np.int64),
+        "i": np.arange(len(latitudes)),
+    })
+
+    firsts, seconds = [], []
+    for d_row in (-1, 0, 1):
+        for d_col in (-1, 0, 1):
+            shifted = cells.assign(row=cells["row"] + d_row, col=cells["col"] + d_col)
+            pairs = cells.merge(shifted, on=["row", "col"], suffixes=("", "_other"))
+            pairs = pairs[pairs["i"] < pairs["i_other"]]
+            firsts.append(pairs["i"].to_numpy())
+            seconds.append(pairs["i_other"].to_numpy())
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def name_similarity(first: str, second: str) -> float:
+    """Similarity of two facility names in [0, 1], ignoring case and accents"""
+    return difflib.SequenceMatcher(None, _fold(first), _fold(second)).ratio()
+
+
+def duplicate_clusters(
+    frame: pd.DataFrame, radius_km: float = DEFAULT_DEDUP_RADIUS_KM, min_similarity: float = DEFAULT_NAME_SIMILARITY
+) -> np.ndarray:
+    """
+    Cluster label per row: rows within radius_km with similar names share a
+    label (transitively), which is the position of the cluster's first row.
+    """
+    latitudes = frame["latitude"].to_numpy(dtype=np.float64)
+    longitudes = frame["longitude"].to_numpy(dtype=np.float64)
+    first, second = candidate_pairs(latitudes, longitudes, radius_km)
+
+    close = distance_km(latitudes[first], longitudes[first], latitudes[second], longitudes[second]) <= radius_km
+    first, second = first[close], second[close]
+    names = frame["facility_name"].fillna("").astype(str).to_numpy()
+    similar = np.fromiter(
+        (name_similarity(names[i], names[j]) >= min_similarity for i, j in zip(first, second)),
+        dtype=bool, count=len(first),
+    )
+
+    # Union-find with the smallest position as each cluster's root
+    parent = np.arange(len(frame))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(first[similar], second[similar]):
+        a, b = root(i), root(j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    return np.fromiter((root(i) for i in range(len(frame))), dtype=np.intp, count=len(frame))
+
+
+# --- Pipeline --------------------------------------------------------------
+
+class StageTimer:
+    """Accumulated wall time and row counts per pipeline stage"""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def record(self, stage: str, seconds: float, rows_in: int, rows_out: int):
+        entry = self.stages.setdefault(stage, {"seconds": 0.0, "rows_in": 0, "rows_out": 0})
+        entry["seconds"] += seconds
+        entry["rows_in"] += rows_in
+        entry["rows_out"] += rows_out
+
+    def report(self) -> str:
+        lines = [f"{'stage':<10} {'seconds':>9} {'rows in':>10} {'rows out':>10}"]
+        for stage, entry in self.stages.items():
+            lines.append(f"{stage:<10} {entry['seconds']:>9.3f} {entry['rows_in']:>10} {entry['rows_out']:>10}")
+        lines.append(f"{'total':<10} {sum(e['seconds'] for e in self.stages.values()):>9.3f}")
+        return "\n".join(lines)
+
+
+def _clean_chunk(chunk: pd.DataFrame, timer: StageTimer, bounds: Optional[Sequence[float]]) -> pd.DataFrame:
+    for column in OUTPUT_COLUMNS:
+        if column not in chunk:
+            chunk[column] = None
+
+    started = time.perf_counter()
+    for column in TEXT_COLUMNS:
+        chunk[column] = repair_mojibake(chunk[column])
+    timer.record("repair", time.perf_counter() - started, len(chunk), len(chunk))
+
+    started = time.perf_counter()
+    rows_in = len(chunk)
+    chunk["latitude"] = pd.to_numeric(chunk["latitude"], errors="coerce").astype(np.float64)
+    chunk["longitude"] = pd.to_numeric(chunk["longitude"], errors="coerce").astype(np.float64)
+    chunk = chunk[valid_coordinates(chunk, bounds)]
+    chunk = chunk[chunk["facility_name"].notnull()]
+    timer.record("validate", time.perf_counter() - started, rows_in, len(chunk))
+
+    started = time.perf_counter()
+    for column in TEXT_COLUMNS:
+        chunk[column] = chunk[column].astype("string").str.strip().str.replace(r"\s+", " ", regex=True)
+    timer.record("normalize", time.perf_counter() - started, len(chunk), len(chunk))
+    return chunk[list(OUTPUT_COLUMNS)]
+
+
+def run_pipeline(
+    sources: Sequence[str],
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    bounds: Optional[Sequence[float]] = None,
+    dedup_radius_km: float = DEFAULT_DEDUP_RADIUS_KM,
+    name_similarity_threshold: float = DEFAULT_NAME_SIMILARITY,
+    timer: Optional[StageTimer] = None,
+) -> pd.DataFrame:
+    """
+    Read, repair, validate, normalize and deduplicate registries into one table.
+
+    Returns:
+        Cleaned facility table with the API's column names plus facility_category
+    """
+    timer = timer or StageTimer()
+    chunks: List[pd.DataFrame] = []
+    for source in sources:
+        reader = read_source(source, chunksize)
+        while True:
+            started = time.perf_counter()
+            chunk = next(reader, None)
+            if chunk is None:
+                break
+            timer.record("read", time.perf_counter() - started, len(chunk), len(chunk))
+            chunks.append(_clean_chunk(chunk, timer, bounds))
+
+    frame = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(OUTPUT_COLUMNS))
+
+    started = time.perf_counter()
+    types = frame["facility_type"].astype(object)
+    categories = {value: normalize_facility_type(value) for value in pd.unique(types)}
+    frame["facility_category"] = types.map(categories).astype("category")
+    timer.record("categorize", time.perf_counter() - started, len(frame), len(frame))
+
+    started = time.perf_counter()
+    rows_in = len(frame)
+    clusters = duplicate_clusters(frame, dedup_radius_km, name_similarity_threshold)
+    frame = frame[clusters == np.arange(len(frame))].reset_index(drop=True)
+    timer.record("dedup", time.perf_counter() - started, rows_in, len(frame))
+    return frame
+
+
+def write_output(frame: pd.DataFrame, path: str, timer: Optional[StageTimer] = None):
+    """Write the table in the registry column layout (xlsx or CSV by extension)"""
+    started = time.perf_counter()
+    output = frame[list(OUTPUT_COLUMNS)].rename(columns=OUTPUT_COLUMNS)
+    if path.lower().endswith(".csv"):
+        output.to_csv(path, index=False, encoding="utf-8")
+    else:
+        output.to_excel(path, index=False)
+    if timer is not None:
+        timer.record("write", time.perf_counter() - started, len(frame), len(frame))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="+", help="registry files in priority order (.csv, .geojson, .xlsx)")
+    parser.add_argument("--output", required=True, help="cleaned table to write (.xlsx or .csv)")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument("--bounds", help="min_lat,max_lat,min_lon,max_lon to keep")
+    parser.add_argument("--dedup-radius-km", type=float, default=DEFAULT_DEDUP_RADIUS_KM)
+    parser.add_argument("--name-similarity", type=float, default=DEFAULT_NAME_SIMILARITY)
+    args = parser.parse_args()
+
+    bounds = [float(v) for v in args.bounds.split(",")] if args.bounds else None
+    timer = StageTimer()
+    frame = run_pipeline(args.sources, args.chunksize, bounds, args.dedup_radius_km, args.name_similarity, timer)
+    write_output(frame, args.output, timer)
+
+    print(f"Wrote {len(frame)} facilities to {args.output}\n")
+    print(timer.report())
+
+
+if __name__ == "__main__":
+    main()
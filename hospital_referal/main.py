@@ -1,50 +1,149 @@
-from fastapi import FastAPI, Query, HTTPException, status
+from fastapi import FastAPI, Query, HTTPException, Request, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field, validator
-from typing import Optional, List
+from typing import Optional, List, Dict
+import asyncio
 import logging
-import traceback
+import os
+import sys
+import time
 from contextlib import asynccontextmanager
-from hospital_recommender import recommend_hospitals
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('hospital_api.log'),
-        logging.StreamHandler()
-    ]
+
+# Repository root, for the shared infrastructure package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.structured_logging import configure_logging, RequestLogContextMiddleware
+from shared.responses import FastJSONResponse, CompressionMiddleware, StaticJSONResource
+from shared.rate_limit import RateLimitMiddleware
+from shared.audit import audit_log_from_env
+from shared.execution import HealthCheckMiddleware, executor_from_env
+
+# Structured JSON logging through a background queue listener. Configured
+# before the facility data is loaded so its messages go through it as well.
+configure_logging(
+    "hospital-referral-api", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "hospital_api.log")
 )
 logger = logging.getLogger(__name__)
 
+import hospital_recommender
+from hospital_recommender import (
+    recommend_hospitals, batch_recommend_hospitals, hospitals_within_radius, nearest_hospitals_page,
+    escalate_referral, get_facility_types, encode_cursor, decode_cursor, StaleCursorError
+)
+from facility_index import FACILITY_CATEGORIES
+from performance import MetricsMiddleware, performance_monitor
+from security import get_current_user
+from transfer_graph import TRANSFER_GRAPH_K
+
 class HospitalRequest(BaseModel):
     lat: float = Field(..., ge=-90, le=90, description="Latitude coordinate")
     lon: float = Field(..., ge=-180, le=180, description="Longitude coordinate")
     type: Optional[str] = Field(None, description="Filter by facility type")
     top_n: int = Field(5, ge=1, le=50, description="Number of results to return")
+    category: Optional[str] = Field(None, description="Filter by normalized facility category")
+    region: Optional[str] = Field(None, description="Filter by region (Admin1)")
+    ownership: Optional[str] = Field(None, description="Filter by ownership")
+
+class BatchHospitalRequest(BaseModel):
+    queries: List[HospitalRequest] = Field(..., min_length=1, max_length=1000, description="Patient locations")
+    speculative: bool = Field(
+        False, description="Lookahead searches the caller picks from and audits itself (e.g. /triage/referral); not audited here"
+    )
 
 class HospitalResponse(BaseModel):
+    facility_id: int
     facility_name: str
     facility_type: str
     latitude: float
     longitude: float
     distance_km: float
 
+class FacilityInput(BaseModel):
+    facility_name: str = Field(..., min_length=1, description="Facility name")
+    facility_type: str = Field(..., min_length=1, description="Free-text facility type")
+    latitude: float = Field(..., ge=-90, le=90, description="Latitude coordinate")
+    longitude: float = Field(..., ge=-180, le=180, description="Longitude coordinate")
+    admin1: Optional[str] = Field(None, description="Region")
+    ownership: Optional[str] = Field(None, description="Ownership")
+    country: Optional[str] = Field(None, description="Country")
+
+class FacilityUpdate(BaseModel):
+    facility_name: Optional[str] = Field(None, min_length=1)
+    facility_type: Optional[str] = Field(None, min_length=1)
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+    admin1: Optional[str] = None
+    ownership: Optional[str] = None
+    country: Optional[str] = None
+
+class ReferralFacility(BaseModel):
+    facility_id: int
+    facility_name: str
+    facility_type: str
+    facility_category: str
+    level: int
+    latitude: float
+    longitude: float
+
+class EscalationTarget(HospitalResponse):
+    facility_category: str
+    level: int
+
+class EscalationResponse(BaseModel):
+    facility: ReferralFacility
+    escalation: List[EscalationTarget]
+
+class NearestPageResponse(BaseModel):
+    results: List[HospitalResponse]
+    next_cursor: Optional[str]
+
+class RadiusSearchResponse(BaseModel):
+    total: int
+    offset: int
+    limit: int
+    results: List[HospitalResponse]
+
+# Facility searches run here, off the event loop, with admission control
+# (EXECUTOR_*). Batches are admitted by query count: up to 2000 queries (two
+# full batches) at once, so small batches such as /triage/referral's
+# per-tier lookups don't each take a full batch's share.
+cpu_executor = executor_from_env({"/recommend-hospitals/batch": 2000})
+
+# Write-behind audit trail of searches and escalations (AUDIT_DB_PATH)
+audit_log = audit_log_from_env("hospital-referral-api")
+
+def _audit_search(kind, lat, lon, facilities, latency_ms):
+    """Queue an audit record of the facilities returned for a location; only touches memory"""
+    audit_log.record(
+        kind,
+        model_version=hospital_recommender.dataset.snapshot.dataset_version,
+        lat=lat,
+        lon=lon,
+        facilities=[facility["facility_id"] for facility in facilities],
+        latency_ms=latency_ms
+    )
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    audit_log.start()
     logger.info("Hospital Referral API started")
     yield
+    await asyncio.to_thread(audit_log.close)
+    cpu_executor.shutdown(wait=False)
     logger.info("Hospital Referral API shutting down")
 
 app = FastAPI(
     title="Hospital Referral API",
     description="API for finding nearby hospitals in Cameroon",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
+# Per-client limits (RATE_LIMIT_*); innermost, so 429s still get CORS headers
+app.add_middleware(RateLimitMiddleware)
+
 # Enable CORS for Flutter access
 app.add_middleware(
     CORSMiddleware,
@@ -52,13 +151,26 @@ app.add_middleware(
     allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestLogContextMiddleware)
+app.add_middleware(CompressionMiddleware)
+# Outermost but for health checks, so latencies include every other middleware
+app.add_middleware(MetricsMiddleware, monitor=performance_monitor)
+
+def health_status():
+    return {"status": "healthy", "service": "hospital-referral-api", "executor": cpu_executor.stats()}
+
+# Health checks are answered even while the executor is saturated
+app.add_middleware(HealthCheckMiddleware, status=health_status)
 
 @app.get("/recommend-hospitals", response_model=List[HospitalResponse])
 async def get_hospitals(
     lat: float = Query(..., ge=-90, le=90, description="Latitude coordinate"),
     lon: float = Query(..., ge=-180, le=180, description="Longitude coordinate"),
     type: Optional[str] = Query(None, description="Filter by facility type"),
-    top_n: int = Query(5, ge=1, le=50, description="Number of results to return")
+    top_n: int = Query(5, ge=1, le=50, description="Number of results to return"),
+    category: Optional[str] = Query(None, description="Filter by normalized facility category"),
+    region: Optional[str] = Query(None, description="Filter by region (Admin1)"),
+    ownership: Optional[str] = Query(None, description="Filter by ownership")
 ):
     """
     Get recommended hospitals based on user location.
@@ -67,29 +179,341 @@ async def get_hospitals(
     - **lon**: User's longitude coordinate
     - **type**: Optional filter by facility type (e.g., "Hospital", "Centre")
     - **top_n**: Number of results to return (1-50)
+    - **category**: Optional facility category, e.g. "district_hospital" or "health_centre"
+    - **region**: Optional region, e.g. "Littoral"
+    - **ownership**: Optional ownership, e.g. "MoH"
     """
+    if category is not None and category not in FACILITY_CATEGORIES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown category '{category}'. Expected one of: {', '.join(FACILITY_CATEGORIES)}"
+        )
+
+    start_time = time.perf_counter()
     try:
-        logger.info(f"Hospital search request: lat={lat}, lon={lon}, type={type}, top_n={top_n}")
+        logger.info("Hospital search request: lat=%s, lon=%s, type=%s, top_n=%s", lat, lon, type, top_n)
 
         user_location = (lat, lon)
-        hospitals = recommend_hospitals(user_location, top_n, type)
+        hospitals = await cpu_executor.run(
+            "/recommend-hospitals", recommend_hospitals, user_location, top_n, type, category, region, ownership
+        )
 
-        if hospitals.empty:
-            logger.warning(f"No hospitals found for location ({lat}, {lon}) with type filter: {type}")
+        result = hospitals.to_dict(orient="records")
+        _audit_search("search", lat, lon, result, (time.perf_counter() - start_time) * 1000)
+        if not result:
+            logger.warning("No hospitals found for location (%s, %s) with type filter: %s", lat, lon, type)
             return []
 
-        result = hospitals.to_dict(orient="records")
-        logger.info(f"Returning {len(result)} hospitals")
-        return result
+        logger.info("Returning %d hospitals", len(result))
+        # Rows already have HospitalResponse's fields; skip re-validating them
+        return FastJSONResponse(result)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error in get_hospitals: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch hospitals: {str(e)}"
+        )
+
+@app.get("/hospitals/within-radius", response_model=RadiusSearchResponse)
+async def get_hospitals_within_radius(
+    lat: float = Query(..., ge=-90, le=90, description="Latitude coordinate"),
+    lon: float = Query(..., ge=-180, le=180, description="Longitude coordinate"),
+    radius_km: float = Query(..., gt=0, le=1000, description="Search radius in kilometres"),
+    offset: int = Query(0, ge=0, description="Number of results to skip"),
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of results to return"),
+    type: Optional[str] = Query(None, description="Filter by facility type"),
+    category: Optional[str] = Query(None, description="Filter by normalized facility category"),
+    region: Optional[str] = Query(None, description="Filter by region (Admin1)"),
+    ownership: Optional[str] = Query(None, description="Filter by ownership")
+):
+    """
+    All hospitals within a radius of the user, nearest first.
+
+    - **radius_km**: Search radius (up to 1000 km)
+    - **offset** / **limit**: Page through the results (limit up to 100)
+    - **type**, **category**, **region**, **ownership**: Optional filters, as for `/recommend-hospitals`
+
+    Returns `{"total", "offset", "limit", "results"}`, where `total` counts
+    every facility in the radius.
+    """
+    if category is not None and category not in FACILITY_CATEGORIES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown category '{category}'. Expected one of: {', '.join(FACILITY_CATEGORIES)}"
+        )
+
+    try:
+        logger.info("Radius search request: lat=%s, lon=%s, radius_km=%s", lat, lon, radius_km)
+        total, hospitals = await cpu_executor.run(
+            "/hospitals/within-radius", hospitals_within_radius,
+            (lat, lon), radius_km, offset, limit, type, category, region, ownership
+        )
+        return FastJSONResponse({
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "results": hospitals.to_dict(orient="records"),
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error in get_hospitals_within_radius: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch hospitals: {str(e)}"
+        )
+
+@app.get("/hospitals/nearest", response_model=NearestPageResponse)
+async def get_nearest_page(
+    lat: Optional[float] = Query(None, ge=-90, le=90, description="Latitude coordinate (first page)"),
+    lon: Optional[float] = Query(None, ge=-180, le=180, description="Longitude coordinate (first page)"),
+    page_size: int = Query(20, ge=1, le=100, description="Number of results per page"),
+    type: Optional[str] = Query(None, description="Filter by facility type"),
+    category: Optional[str] = Query(None, description="Filter by normalized facility category"),
+    region: Optional[str] = Query(None, description="Filter by region (Admin1)"),
+    ownership: Optional[str] = Query(None, description="Filter by ownership"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page")
+):
+    """
+    Scroll through hospitals from nearest to farthest, a page at a time.
+
+    - First page: **lat**, **lon** and optional filters, as for `/recommend-hospitals`
+    - Next pages: pass the returned **cursor**; it carries the location and
+      filters, and the search continues beyond the last hospital returned
+    - A cursor from before the facility data changed gets 410; start again
+      from the first page
+
+    `next_cursor` is null once every matching facility has been returned.
+    """
+    if cursor is None and (lat is None or lon is None):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="lat and lon are required without a cursor"
+        )
+    if category is not None and category not in FACILITY_CATEGORIES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown category '{category}'. Expected one of: {', '.join(FACILITY_CATEGORIES)}"
+        )
+
+    try:
+        state = decode_cursor(cursor) if cursor is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    try:
+        page, next_state = await cpu_executor.run(
+            "/hospitals/nearest", nearest_hospitals_page,
+            (lat, lon), page_size, type, category, region, ownership, cursor=state
+        )
+        return FastJSONResponse({
+            "results": page.to_dict(orient="records"),
+            "next_cursor": encode_cursor(next_state) if next_state is not None else None,
+        })
+
+    except StaleCursorError as e:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error in get_nearest_page: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch hospitals: {str(e)}"
+        )
+
+@app.get("/facilities/{facility_id}/escalation", response_model=EscalationResponse)
+async def get_escalation(
+    facility_id: int,
+    min_level: Optional[int] = Query(None, ge=1, le=max(FACILITY_CATEGORIES.values()), description="Lowest acceptable care level"),
+    top_n: int = Query(3, ge=1, le=TRANSFER_GRAPH_K, description="Number of results to return")
+):
+    """
+    Nearest higher-level facilities to escalate a referral to from a facility.
+
+    - **facility_id**: The referring facility, as returned by the search endpoints
+    - **min_level**: Lowest acceptable care level (1 = health centre ... 5 =
+      central hospital); defaults to one level above the referring facility
+    - **top_n**: Number of results to return (1-5)
+    """
+    start_time = time.perf_counter()
+    try:
+        facility, hospitals = escalate_referral(facility_id, min_level, top_n)
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Facility {facility_id} not found")
+
+    try:
+        escalation = hospitals.to_dict(orient="records")
+        _audit_search(
+            "escalation", facility["latitude"], facility["longitude"], escalation,
+            (time.perf_counter() - start_time) * 1000
+        )
+        return FastJSONResponse({"facility": facility, "escalation": escalation})
+
+    except Exception as e:
+        logger.exception("Error in get_escalation: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch escalation: {str(e)}"
+        )
+
+_facility_types_resource = None
+_facility_types_source = None
+
+@app.get("/facility-types", response_model=List[str])
+async def facility_types(request: Request):
+    """
+    Facility types present in the dataset, for building type filters.
+
+    Serialized once per dataset snapshot; clients revalidating with
+    If-None-Match get a bodyless 304 while it is unchanged.
+    """
+    global _facility_types_resource, _facility_types_source
+    # Edits tombstone rows in place, so the frame object alone doesn't tell
+    # whether the types changed; every edit or reload publishes a new version
+    version = hospital_recommender.dataset.snapshot.version
+    if _facility_types_resource is None or _facility_types_source != version:
+        _facility_types_resource = StaticJSONResource(get_facility_types())
+        _facility_types_source = version
+    return _facility_types_resource.response(request)
 
+@app.post("/recommend-hospitals/batch", response_model=Dict[str, List[List[HospitalResponse]]])
+async def get_hospitals_batch(request: BatchHospitalRequest):
+    """
+    Nearest hospitals for many patient locations in one call.
+
+    - **queries**: Up to 1000 objects with `lat`, `lon` and optional `type`,
+      `top_n`, `category`, `region` and `ownership`, as for `/recommend-hospitals`
+    - **speculative**: Set for lookahead searches that the caller audits
+      itself once it has picked from them; they are not audited here
+
+    Returns `{"results": [...]}` with one result list per query, in input order.
+    """
+    for i, query in enumerate(request.queries):
+        if query.category is not None and query.category not in FACILITY_CATEGORIES:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Unknown category '{query.category}' in query {i}"
+            )
+
+    start_time = time.perf_counter()
+    try:
+        logger.info("Batch hospital search for %d locations", len(request.queries))
+        results = await cpu_executor.run_weighted(
+            "/recommend-hospitals/batch", len(request.queries),
+            batch_recommend_hospitals, [query.model_dump() for query in request.queries]
+        )
+        processing_time = (time.perf_counter() - start_time) * 1000
+        if not request.speculative:
+            for query, result in zip(request.queries, results):
+                _audit_search("search", query.lat, query.lon, result, processing_time)
+        return FastJSONResponse({"results": results})
+
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in get_hospitals: {e}\n{traceback.format_exc()}")
+        logger.exception("Error in get_hospitals_batch: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to fetch hospitals: {str(e)}"
         )
 
+def _dataset_status(snapshot) -> Dict:
+    return {
+        "version": snapshot.version,
+        "dataset_version": snapshot.dataset_version,
+        "facilities": snapshot.facility_count,
+        "rebuild_pending": snapshot.transfer_graph is None,
+    }
+
+@app.get("/admin/dataset", dependencies=[Depends(get_current_user)])
+async def dataset_status():
+    """Version and size of the facility snapshot being served"""
+    return _dataset_status(hospital_recommender.dataset.snapshot)
+
+@app.post("/admin/dataset/reload", dependencies=[Depends(get_current_user)])
+async def reload_dataset():
+    """Re-read the facility file and swap it in; in-memory admin edits are discarded"""
+    try:
+        snapshot = await asyncio.to_thread(hospital_recommender.dataset.reload)
+        return _dataset_status(snapshot)
+    except Exception as e:
+        logger.exception("Error reloading facility dataset: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to reload dataset: {str(e)}"
+        )
+
+@app.post("/admin/facilities", status_code=status.HTTP_201_CREATED, dependencies=[Depends(get_current_user)])
+async def add_facility(facility: FacilityInput):
+    """Add a facility; it is searchable as soon as this returns"""
+    try:
+        facility_id = await asyncio.to_thread(hospital_recommender.dataset.add_facility, facility.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    logger.info("Added facility %d", facility_id)
+    return {"facility_id": facility_id}
+
+@app.patch("/admin/facilities/{facility_id}", dependencies=[Depends(get_current_user)])
+async def update_facility(facility_id: int, changes: FacilityUpdate):
+    """Change some fields of a facility"""
+    try:
+        record = await asyncio.to_thread(
+            hospital_recommender.dataset.update_facility, facility_id, changes.model_dump(exclude_unset=True)
+        )
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Facility {facility_id} not found")
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    logger.info("Updated facility %d", facility_id)
+    return record
+
+@app.delete("/admin/facilities/{facility_id}", dependencies=[Depends(get_current_user)])
+async def remove_facility(facility_id: int):
+    """Remove a facility"""
+    try:
+        await asyncio.to_thread(hospital_recommender.dataset.remove_facility, facility_id)
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Facility {facility_id} not found")
+    logger.info("Removed facility %d", facility_id)
+    return {"removed": facility_id}
+
+@app.get("/admin/audit", dependencies=[Depends(get_current_user)])
+async def audit_records(
+    kind: Optional[str] = Query(None, description="Only records of this kind: search or escalation"),
+    since: Optional[float] = Query(None, description="Only records at or after this Unix time"),
+    limit: int = Query(100, ge=1, le=1000, description="Number of records to return")
+):
+    """Most recent audited searches and escalations, newest first, with the audit buffer's counters"""
+    try:
+        records = await asyncio.to_thread(audit_log.query, kind, since, limit)
+        return FastJSONResponse({"stats": audit_log.stats(), "records": records})
+    except Exception as e:
+        logger.exception("Error reading audit records: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to read audit records: {str(e)}"
+        )
+
+@app.get("/cache-stats")
+async def cache_stats():
+    """Hit rate and size of the location cache behind /recommend-hospitals"""
+    return {"location_cache": hospital_recommender.location_cache.stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    """Prometheus metrics: per-route latency percentiles, in-flight requests, stage timings and cache hit rates"""
+    location_cache = hospital_recommender.dataset.snapshot.location_cache.stats()
+    return PlainTextResponse(
+        performance_monitor.prometheus(extra_caches={"location": location_cache}),
+        media_type="text/plain; version=0.0.4",
+    )
+
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy", "service": "hospital-referral-api"}
+    """Liveness probe, with the executor's load; served by HealthCheckMiddleware ahead of routing"""
+    return health_status()
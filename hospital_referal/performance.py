@@ -2,150 +2,480 @@
 Performance optimization utilities for Hospital Referral API
 """
 import asyncio
+import bisect
+import os
+import threading
 import time
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
-from typing import Dict, Any, Optional
-import redis
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
 import json
 import hashlib
 from datetime import datetime, timedelta
 import logging
 
+from starlette.routing import Match
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis is an optional second tier
+    aioredis = None
+
 logger = logging.getLogger(__name__)
 
+# Seconds to stop using Redis after an error, so an outage costs one timeout
+REDIS_RETRY_SECONDS = 30
+
+
 class CacheManager:
-    """Redis-based caching for API responses"""
-    
-    def __init__(self, redis_url: str = "redis://localhost:6379"):
-        try:
-            self.redis_client = redis.from_url(redis_url, decode_responses=True)
-            self.redis_client.ping()
-            self.enabled = True
-            logger.info("Redis cache enabled")
-        except Exception as e:
-            logger.warning(f"Redis not available, caching disabled: {e}")
+    """
+    Async two-tier cache for API responses.
+
+    Lookups go to an in-process LRU with per-entry expiry first, then to an
+    optional Redis tier (REDIS_URL) through redis.asyncio, so the event loop
+    is never blocked on the network. Redis is connected lazily on first use
+    rather than pinged at import; if it errors it is skipped for
+    REDIS_RETRY_SECONDS and the service keeps running on the local tier.
+
+    get_many()/set_many() move whole batches in one round trip (MGET and a
+    pipelined SETEX), and get_or_compute() coalesces concurrent misses on the
+    same key so only one caller recomputes it (single-flight).
+
+    Values are stored as JSON in Redis and as the original objects locally;
+    callers must not mutate values they get back.
+    """
+
+    def __init__(
+        self,
+        redis_url: Optional[str] = None,
+        local_size: int = 1024,
+        local_ttl: int = 60,
+        redis_client=None,
+        monitor: Optional["PerformanceMonitor"] = None,
+    ):
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self.monitor = monitor
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._redis_down_until = 0.0
+
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if redis_client is not None:
+            self.redis_client = redis_client
+        elif redis_url and aioredis is not None:
+            self.redis_client = aioredis.from_url(redis_url, decode_responses=True)
+        else:
+            if redis_url:
+                logger.warning("REDIS_URL is set but redis is not installed; using the local cache only")
             self.redis_client = None
-            self.enabled = False
-    
+
+    @property
+    def redis_enabled(self) -> bool:
+        return self.redis_client is not None and time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self, operation: str, error: Exception):
+        logger.error("Cache %s error, skipping Redis for %ds: %s", operation, REDIS_RETRY_SECONDS, error)
+        self._redis_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+
     def _generate_key(self, prefix: str, **kwargs) -> str:
         """Generate cache key from parameters"""
-        key_data = json.dumps(kwargs, sort_keys=True)
+        key_data = json.dumps(kwargs, sort_keys=True, default=str)
         key_hash = hashlib.md5(key_data.encode()).hexdigest()
         return f"{prefix}:{key_hash}"
-    
-    def get(self, key: str) -> Optional[Any]:
-        """Get value from cache"""
-        if not self.enabled:
+
+    def _record(self, hit: bool):
+        if self.monitor is not None:
+            if hit:
+                self.monitor.record_cache_hit()
+            else:
+                self.monitor.record_cache_miss()
+
+    def _local_get(self, key: str) -> Optional[Any]:
+        entry = self._local.get(key)
+        if entry is None:
             return None
-        
-        try:
-            value = self.redis_client.get(key)
-            return json.loads(value) if value else None
-        except Exception as e:
-            logger.error(f"Cache get error: {e}")
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._local[key]
             return None
-    
-    def set(self, key: str, value: Any, ttl: int = 300):
+        self._local.move_to_end(key)
+        return value
+
+    def _local_set(self, key: str, value: Any, ttl: int):
+        self._local[key] = (time.monotonic() + min(ttl, self.local_ttl), value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Values for the keys found in either tier; missing keys are left out"""
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._local_get(key)
+            if value is not None:
+                found[key] = value
+            else:
+                missing.append(key)
+
+        if missing and self.redis_enabled:
+            try:
+                values = await self.redis_client.mget(missing)
+            except Exception as e:
+                self._redis_failed("get", e)
+            else:
+                for key, raw in zip(missing, values):
+                    if raw is not None:
+                        value = json.loads(raw)
+                        found[key] = value
+                        self._local_set(key, value, self.local_ttl)
+
+        for _ in found:
+            self._record(True)
+        for key in missing:
+            if key not in found:
+                self._record(False)
+        return found
+
+    async def set_many(self, values: Dict[str, Any], ttl: int = 300):
+        """Store several values in both tiers, with one pipelined Redis round trip"""
+        for key, value in values.items():
+            self._local_set(key, value, ttl)
+
+        if values and self.redis_enabled:
+            try:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for key, value in values.items():
+                    pipe.setex(key, ttl, json.dumps(value, default=str))
+                await pipe.execute()
+            except Exception as e:
+                self._redis_failed("set", e)
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Get value from cache"""
+        return (await self.get_many([key])).get(key)
+
+    async def set(self, key: str, value: Any, ttl: int = 300):
         """Set value in cache with TTL"""
-        if not self.enabled:
-            return
-        
-        try:
-            self.redis_client.setex(key, ttl, json.dumps(value, default=str))
-        except Exception as e:
-            logger.error(f"Cache set error: {e}")
-    
-    def delete(self, key: str):
+        await self.set_many({key: value}, ttl)
+
+    async def delete(self, key: str):
         """Delete key from cache"""
-        if not self.enabled:
-            return
-        
-        try:
-            self.redis_client.delete(key)
-        except Exception as e:
-            logger.error(f"Cache delete error: {e}")
+        self._local.pop(key, None)
+        if self.redis_enabled:
+            try:
+                await self.redis_client.delete(key)
+            except Exception as e:
+                self._redis_failed("delete", e)
 
-# Global cache instance
-cache = CacheManager()
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]], ttl: int = 300) -> Any:
+        """
+        Cached value for key, computing and storing it on a miss.
+
+        Concurrent callers missing on the same key wait for the first one's
+        computation instead of repeating it. The computation runs in its own
+        task that every caller awaits through asyncio.shield(), so a caller
+        being cancelled (a client disconnecting) neither aborts it nor
+        passes the cancellation on to the others.
+        """
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._record(True)
+            return await asyncio.shield(inflight)
+
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        # Another caller may have started computing while we awaited Redis
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._compute_and_store(key, compute, ttl))
+            self._inflight[key] = inflight
+            inflight.add_done_callback(lambda task: self._computed(key, task))
+        return await asyncio.shield(inflight)
+
+    async def _compute_and_store(self, key: str, compute: Callable[[], Awaitable[Any]], ttl: int) -> Any:
+        value = await compute()
+        await self.set(key, value, ttl)
+        return value
+
+    def _computed(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
 
 def cached_response(prefix: str, ttl: int = 300):
     """Decorator for caching API responses"""
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            # Generate cache key
             cache_key = cache._generate_key(prefix, args=args, kwargs=kwargs)
-            
-            # Try to get from cache
-            cached_result = cache.get(cache_key)
-            if cached_result is not None:
-                logger.info(f"Cache hit for {cache_key}")
-                return cached_result
-            
-            # Execute function
-            result = await func(*args, **kwargs)
-            
-            # Cache result
-            cache.set(cache_key, result, ttl)
-            logger.info(f"Cached result for {cache_key}")
-            
-            return result
+            return await cache.get_or_compute(cache_key, lambda: func(*args, **kwargs), ttl)
         return wrapper
     return decorator
 
+class LatencyHistogram:
+    """
+    Latency histogram over fixed logarithmic buckets.
+
+    Bucket bounds grow by 2**(1/8) (about 9%) from 10us to 100s, so any
+    percentile is known to within one bucket's width whatever the traffic,
+    in constant memory and with an O(log buckets) record().
+    """
+
+    BOUNDS = [1e-5 * 2 ** (i / 8) for i in range(int(np.ceil(8 * np.log2(1e7))) + 1)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th percentile (0-100), in seconds"""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(np.ceil(q / 100 * self.count)))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        bound = self.BOUNDS[bucket] if bucket < len(self.BOUNDS) else self.max
+        return min(bound, self.max)
+
+
 class PerformanceMonitor:
-    """Monitor API performance metrics"""
-    
+    """
+    Request and stage latencies, in-flight counts and cache hit rates.
+
+    Requests are keyed by (method, route template) so parameterized paths
+    share one series; stages by (operation, stage). All updates take one
+    lock, so the monitor can be fed from the event loop and worker threads.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
     def __init__(self):
-        self.metrics = {
-            'request_count': 0,
-            'total_response_time': 0,
-            'error_count': 0,
-            'cache_hits': 0,
-            'cache_misses': 0
-        }
+        self._lock = threading.Lock()
+        self.routes: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.errors: Dict[Tuple[str, str], int] = {}
+        self.in_flight: Dict[Tuple[str, str], int] = {}
+        self.stages: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.start_time = time.time()
-    
-    def record_request(self, response_time: float, error: bool = False):
-        """Record request metrics"""
-        self.metrics['request_count'] += 1
-        self.metrics['total_response_time'] += response_time
+
+    def request_started(self, method: str, route: str):
+        with self._lock:
+            key = (method, route)
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    def request_finished(self, method: str, route: str, response_time: float, error: bool = False):
+        with self._lock:
+            key = (method, route)
+            self.in_flight[key] = self.in_flight.get(key, 1) - 1
+            self._record(key, response_time, error)
+
+    def _record(self, key: Tuple[str, str], response_time: float, error: bool):
+        if key not in self.routes:
+            self.routes[key] = LatencyHistogram()
+            self.errors[key] = 0
+        self.routes[key].record(response_time)
         if error:
-            self.metrics['error_count'] += 1
-    
+            self.errors[key] += 1
+
+    def record_request(self, response_time: float, error: bool = False, route: str = "unrouted", method: str = "-"):
+        """Record request metrics"""
+        with self._lock:
+            self._record((method, route), response_time, error)
+
+    def record_stage(self, operation: str, stage: str, seconds: float):
+        with self._lock:
+            key = (operation, stage)
+            if key not in self.stages:
+                self.stages[key] = LatencyHistogram()
+            self.stages[key].record(seconds)
+
+    @contextmanager
+    def stage(self, operation: str, stage: str):
+        """Time the enclosed block as one stage of an operation"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(operation, stage, time.perf_counter() - start)
+
     def record_cache_hit(self):
         """Record cache hit"""
-        self.metrics['cache_hits'] += 1
-    
+        with self._lock:
+            self.cache_hits += 1
+
     def record_cache_miss(self):
         """Record cache miss"""
-        self.metrics['cache_misses'] += 1
-    
+        with self._lock:
+            self.cache_misses += 1
+
+    def _summary(self, histogram: LatencyHistogram) -> Dict[str, float]:
+        summary = {f"p{q}_ms": round(histogram.percentile(q) * 1000, 3) for q in self.PERCENTILES}
+        summary["count"] = histogram.count
+        summary["mean_ms"] = round(histogram.total / histogram.count * 1000, 3) if histogram.count else 0.0
+        return summary
+
     def get_stats(self) -> Dict[str, Any]:
         """Get performance statistics"""
-        uptime = time.time() - self.start_time
-        avg_response_time = (
-            self.metrics['total_response_time'] / self.metrics['request_count']
-            if self.metrics['request_count'] > 0 else 0
-        )
-        
-        cache_hit_rate = (
-            self.metrics['cache_hits'] / (self.metrics['cache_hits'] + self.metrics['cache_misses'])
-            if (self.metrics['cache_hits'] + self.metrics['cache_misses']) > 0 else 0
-        )
-        
-        return {
-            'uptime_seconds': uptime,
-            'total_requests': self.metrics['request_count'],
-            'error_rate': self.metrics['error_count'] / max(self.metrics['request_count'], 1),
-            'average_response_time': avg_response_time,
-            'cache_hit_rate': cache_hit_rate,
-            'requests_per_second': self.metrics['request_count'] / max(uptime, 1)
-        }
+        with self._lock:
+            uptime = time.time() - self.start_time
+            total_requests = sum(h.count for h in self.routes.values())
+            total_time = sum(h.total for h in self.routes.values())
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                'uptime_seconds': uptime,
+                'total_requests': total_requests,
+                'error_rate': sum(self.errors.values()) / max(total_requests, 1),
+                'average_response_time': total_time / total_requests if total_requests else 0,
+                'cache_hit_rate': self.cache_hits / lookups if lookups else 0,
+                'requests_per_second': total_requests / max(uptime, 1),
+                'routes': {
+                    f"{method} {route}": {
+                        **self._summary(histogram),
+                        'errors': self.errors[(method, route)],
+                        'in_flight': self.in_flight.get((method, route), 0),
+                    }
+                    for (method, route), histogram in self.routes.items()
+                },
+                'stages': {f"{operation}.{stage}": self._summary(h) for (operation, stage), h in self.stages.items()},
+            }
+
+    def prometheus(self, prefix: str = "hospital_api", extra_caches: Optional[Dict[str, Dict[str, float]]] = None) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Args:
+            prefix: Metric name prefix
+            extra_caches: Further caches' stats() (with hits and misses) by cache name
+
+        Returns:
+            The /metrics response body
+        """
+        lines = []
+
+        def summary(name: str, help_text: str, series: Dict[Tuple[str, ...], LatencyHistogram], labels: Tuple[str, ...]):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} summary")
+            for values, histogram in series.items():
+                label = ",".join(f'{k}="{_escape_label(v)}"' for k, v in zip(labels, values))
+                for q in self.PERCENTILES:
+                    lines.append(f'{prefix}_{name}{{{label},quantile="{q / 100:g}"}} {histogram.percentile(q):.6f}')
+                lines.append(f"{prefix}_{name}_sum{{{label}}} {histogram.total:.6f}")
+                lines.append(f"{prefix}_{name}_count{{{label}}} {histogram.count}")
+
+        def simple(name: str, kind: str, help_text: str, samples: Iterable[Tuple[str, float]]):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.extend(f"{prefix}_{name}{label} {value:g}" for label, value in samples)
+
+        def route_label(method: str, route: str) -> str:
+            return f'{{method="{method}",route="{_escape_label(route)}"}}'
+
+        with self._lock:
+            summary("request_duration_seconds", "Request latency by route", dict(self.routes), ("method", "route"))
+            simple("request_errors_total", "counter", "Requests answered with a 5xx status by route",
+                   [(route_label(*key), count) for key, count in self.errors.items()])
+            simple("requests_in_flight", "gauge", "Requests being served by route",
+                   [(route_label(*key), count) for key, count in self.in_flight.items()])
+            summary("stage_duration_seconds", "Time spent in each stage of an operation", dict(self.stages),
+                    ("operation", "stage"))
+            caches = {"response": {"hits": self.cache_hits, "misses": self.cache_misses}}
+            uptime = time.time() - self.start_time
+
+        caches.update(extra_caches or {})
+        simple("cache_hits_total", "counter", "Cache hits by cache",
+               [(f'{{cache="{name}"}}', stats["hits"]) for name, stats in caches.items()])
+        simple("cache_misses_total", "counter", "Cache misses by cache",
+               [(f'{{cache="{name}"}}', stats["misses"]) for name, stats in caches.items()])
+        simple("cache_hit_ratio", "gauge", "Share of cache lookups that hit, by cache",
+               [(f'{{cache="{name}"}}', stats["hits"] / max(stats["hits"] + stats["misses"], 1))
+                for name, stats in caches.items()])
+        simple("uptime_seconds", "gauge", "Seconds since the monitor started", [("", uptime)])
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware feeding a PerformanceMonitor with every HTTP request.
+
+    Requests are labelled with the matching route's path template (e.g.
+    /facilities/{facility_id}/escalation), looked up once per distinct
+    method and path, or "unmatched" for paths no route serves.
+    """
+
+    MAX_RESOLVED_PATHS = 10000
+
+    def __init__(self, app, monitor: Optional[PerformanceMonitor] = None):
+        self.app = app
+        self.monitor = monitor if monitor is not None else performance_monitor
+        self._resolved: Dict[Tuple[str, str], str] = {}
+
+    def _route_of(self, scope) -> str:
+        key = (scope.get("method", ""), scope.get("path", ""))
+        route = self._resolved.get(key)
+        if route is None:
+            route = "unmatched"
+            for candidate in getattr(scope.get("app"), "routes", ()):
+                match, _ = candidate.matches(scope)
+                if match == Match.FULL:
+                    route = getattr(candidate, "path", route)
+                    break
+            if len(self._resolved) >= self.MAX_RESOLVED_PATHS:
+                self._resolved.clear()
+            self._resolved[key] = route
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method, route = scope.get("method", ""), self._route_of(scope)
+        status_code = 500
+        self.monitor.request_started(method, route)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.monitor.request_finished(method, route, time.perf_counter() - start, error=status_code >= 500)
+
 
 # Global performance monitor
 performance_monitor = PerformanceMonitor()
 
+# Global cache instance
+cache = CacheManager(monitor=performance_monitor)
+
 def monitor_performance(func):
     """Decorator to monitor function performance"""
     @wraps(func)
@@ -170,61 +500,31 @@ class DatabaseOptimizer:
     
     @staticmethod
     def optimize_hospital_query(df, lat: float, lon: float, radius_km: float = 50):
-        """Pre-filter hospitals by approximate distance before expensive calculations"""
-        # Rough degree approximation (1 degree ≈ 111 km)
-        lat_delta = radius_km / 111.0
-        lon_delta = radius_km / (111.0 * abs(lat))  # Adjust for latitude
-        
+        """Pre-filter hospitals by a bounding box before expensive distance calculations"""
+        from geo import bounding_box
+
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+
         # Filter by bounding box first
         filtered_df = df[
-            (df['latitude'].between(lat - lat_delta, lat + lat_delta)) &
-            (df['longitude'].between(lon - lon_delta, lon + lon_delta))
+            (df['latitude'].between(min_lat, max_lat)) &
+            (df['longitude'].between(min_lon, max_lon))
         ]
         
-        logger.info(f"Pre-filtered hospitals: {len(df)} -> {len(filtered_df)}")
+        logger.info("Pre-filtered hospitals: %d -> %d", len(df), len(filtered_df))
         return filtered_df
     
     @staticmethod
     def batch_distance_calculation(df, patient_coords, batch_size: int = 1000):
-        """Calculate distances in batches for better performance"""
-        from geopy.distance import geodesic
-        
+        """Calculate distances in batches with the vectorized distance engine"""
+        from geo import distance_km
+
+        lat, lon = patient_coords
+        latitudes = df['latitude'].to_numpy(dtype=np.float64)
+        longitudes = df['longitude'].to_numpy(dtype=np.float64)
+
         distances = []
         for i in range(0, len(df), batch_size):
-            batch = df.iloc[i:i + batch_size]
-            batch_distances = batch.apply(
-                lambda row: geodesic(patient_coords, (row['latitude'], row['longitude'])).km,
-                axis=1
-            )
-            distances.extend(batch_distances.tolist())
-        
-        return distances
+            distances.extend(distance_km(lat, lon, latitudes[i:i + batch_size], longitudes[i:i + batch_size]).tolist())
 
-# Connection pooling for database connections
-class ConnectionPool:
-    """Simple connection pool implementation"""
-    
-    def __init__(self, max_connections: int = 10):
-        self.max_connections = max_connections
-        self.connections = asyncio.Queue(maxsize=max_connections)
-        self.created_connections = 0
-    
-    async def get_connection(self):
-        """Get connection from pool"""
-        if self.connections.empty() and self.created_connections < self.max_connections:
-            # Create new connection
-            connection = self._create_connection()
-            self.created_connections += 1
-            return connection
-        else:
-            # Wait for available connection
-            return await self.connections.get()
-    
-    async def return_connection(self, connection):
-        """Return connection to pool"""
-        await self.connections.put(connection)
-    
-    def _create_connection(self):
-        """Create new database connection"""
-        # Implement actual connection creation
-        pass
+        return distances
@@ -1,26 +1,102 @@
 """
 Security utilities for Hospital Referral API
+
+Verifying a JWT (HMAC check plus claim validation) is repeated on every
+authenticated request, although clients reuse one token for its whole
+lifetime. SecurityManager therefore keeps a bounded LRU of tokens it has
+already verified, keyed by their SHA-256 digest and holding the decoded
+payload until the token's exp; a cache hit skips decoding entirely.
+revoke_token() drops a token from the cache and rejects it until it
+expires, and clear_token_cache() forgets every verified token (e.g. after
+rotating SECRET_KEY).
 """
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
 import os
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 import hashlib
 import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from shared.rate_limit import RateLimiter
 
 # Security configuration
 SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_urlsafe(32))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", "4096"))
 
 security = HTTPBearer()
 
+class VerifiedTokenCache:
+    """LRU of token digests mapped to decoded payloads, each valid until its exp"""
+
+    def __init__(self, capacity: int = VERIFIED_TOKEN_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict()
+        # Revoked digest -> exp, kept only until the token would have expired
+        self._revoked: Dict[bytes, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, digest: bytes) -> Optional[dict]:
+        """Cached payload for a verified, unexpired token, or None"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return dict(payload)
+
+    def put(self, digest: bytes, payload: dict):
+        expires_at = payload.get("exp")
+        if not isinstance(expires_at, (int, float)):
+            return  # tokens without exp are always verified in full
+        with self._lock:
+            if digest in self._revoked:
+                return
+            self._entries[digest] = (dict(payload), float(expires_at))
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def is_revoked(self, digest: bytes) -> bool:
+        with self._lock:
+            return digest in self._revoked
+
+    def revoke(self, digest: bytes, expires_at: float):
+        with self._lock:
+            self._entries.pop(digest, None)
+            now = time.time()
+            for revoked, until in list(self._revoked.items()):
+                if until <= now:
+                    del self._revoked[revoked]
+            self._revoked[digest] = expires_at
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 class SecurityManager:
-    def __init__(self):
+    def __init__(self, token_cache_size: int = VERIFIED_TOKEN_CACHE_SIZE):
         self.secret_key = SECRET_KEY
         self.algorithm = ALGORITHM
+        self.token_cache = VerifiedTokenCache(token_cache_size)
         
     def create_access_token(self, data: dict, expires_delta: Optional[timedelta] = None):
         """Create JWT access token"""
@@ -35,21 +111,44 @@ class SecurityManager:
         return encoded_jwt
     
     def verify_token(self, token: str):
-        """Verify JWT token"""
+        """Verify JWT token, reusing the result of an earlier verification"""
+        digest = self.token_cache.digest(token)
+        payload = self.token_cache.get(digest)
+        if payload is not None:
+            return payload
+        if self.token_cache.is_revoked(digest):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Token revoked"
+            )
         try:
             payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+            self.token_cache.put(digest, payload)
             return payload
         except jwt.ExpiredSignatureError:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Token expired"
             )
-        except jwt.JWTError:
+        except jwt.InvalidTokenError:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid token"
             )
     
+    def revoke_token(self, token: str):
+        """Reject a token from now until it expires (e.g. on logout)"""
+        try:
+            claims = jwt.decode(token, options={"verify_signature": False, "verify_exp": False})
+            expires_at = float(claims.get("exp", time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60))
+        except jwt.InvalidTokenError:
+            expires_at = time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+        self.token_cache.revoke(self.token_cache.digest(token), expires_at)
+
+    def clear_token_cache(self):
+        """Forget every verified token, e.g. after rotating the secret key"""
+        self.token_cache.clear()
+
     def hash_api_key(self, api_key: str) -> str:
         """Hash API key for storage"""
         return hashlib.sha256(api_key.encode()).hexdigest()
@@ -66,41 +165,16 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     payload = security_manager.verify_token(token)
     return payload
 
-# Rate limiting (simple in-memory implementation)
-class RateLimiter:
-    def __init__(self, max_requests: int = 100, window_minutes: int = 60):
-        self.max_requests = max_requests
-        self.window_minutes = window_minutes
-        self.requests = {}
-    
-    def is_allowed(self, client_id: str) -> bool:
-        """Check if request is allowed for client"""
-        now = datetime.utcnow()
-        window_start = now - timedelta(minutes=self.window_minutes)
-        
-        if client_id not in self.requests:
-            self.requests[client_id] = []
-        
-        # Clean old requests
-        self.requests[client_id] = [
-            req_time for req_time in self.requests[client_id] 
-            if req_time > window_start
-        ]
-        
-        # Check if under limit
-        if len(self.requests[client_id]) >= self.max_requests:
-            return False
-        
-        # Add current request
-        self.requests[client_id].append(now)
-        return True
-
-rate_limiter = RateLimiter()
+# Rate limiting for routes that want a stricter limit than the app-wide
+# RateLimitMiddleware; same O(1) sliding-window counter (shared/rate_limit.py)
+rate_limiter = RateLimiter(limit=100, window_seconds=3600)
 
-def check_rate_limit(client_ip: str):
+async def check_rate_limit(client_ip: str):
     """Rate limiting dependency"""
-    if not rate_limiter.is_allowed(client_ip):
+    decision = await rate_limiter.check(client_ip)
+    if not decision.allowed:
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="Rate limit exceeded"
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(decision.retry_after)}
         )
@@ -0,0 +1,290 @@
+"""
+Spatial index for sublinear nearest-facility queries.
+
+Facilities are indexed in a KD-tree over their positions as 3D unit vectors
+on the sphere. The straight-line (chord) distance between two unit vectors
+grows monotonically with their great-circle distance, so the tree's
+Euclidean nearest neighbours are exactly the spherical nearest neighbours,
+with no special handling of the antimeridian or poles. A k-nearest query
+visits O(log n + k) nodes instead of scoring the whole table.
+
+Results are still reported and ordered by the ellipsoidal distance from
+geo.distance_km, which can rank two almost equidistant facilities
+differently from the sphere (the two differ by at most ~0.56% over
+Cameroon). To stay exact, nearest() works in two steps:
+  1. Take the k spherically nearest candidates and compute their exact
+     distances; the largest of them, D, bounds the true k-th distance.
+  2. Every facility in the true top k therefore lies within D of the query
+     on the ellipsoid, and within D * (1 + SPHERE_TOLERANCE) on the sphere.
+     A ball query with that radius returns every such facility; exact
+     distances are computed only for those survivors and the top k kept.
+
+Queries can be restricted to a subset of rows (e.g. one facility type) given
+as a sorted array of row positions. Small subsets are scanned directly;
+large ones are served from the tree, widening the search until enough
+members of the subset have been seen.
+
+Rows can be appended to an index without rebuilding its tree (appended()):
+they form a small tail that every search scans alongside the tree's
+candidates, until the owner rebuilds the index from scratch.
+
+Facilities at exactly the same distance are ordered by a per-row key: the
+row position unless the owner supplies keys (e.g. facility ids, which stay
+put when rows are renumbered). nearest_after() continues a k-nearest
+iteration past a (distance, key) cursor. It only looks at the annulus
+between the cursor distance and a growing outer radius, so paging through
+results never recomputes distances to facilities already returned.
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from geo import EARTH_RADIUS_KM, distance_km
+
+# Upper bound on |spherical / ellipsoidal - 1|; measured worst case is 0.56%
+SPHERE_TOLERANCE = 0.01
+
+# Subsets up to this size are cheaper to scan than to search in the tree
+BRUTE_FORCE_LIMIT = 512
+
+# No two points on the ellipsoid are further apart than this (km)
+MAX_SURFACE_DISTANCE_KM = 20004
+
+
+def to_unit_vectors(latitudes, longitudes) -> np.ndarray:
+    """Convert degrees to an (n, 3) array of unit vectors"""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_for_km(distance: float) -> float:
+    """Unit-sphere chord length for a spherical surface distance in km"""
+    return 2 * np.sin(min(distance / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def _members(positions: np.ndarray, subset: Optional[np.ndarray]) -> np.ndarray:
+    """Keep the positions that belong to a sorted subset array"""
+    if subset is None:
+        return positions
+    slots = np.minimum(np.searchsorted(subset, positions), len(subset) - 1)
+    return positions[subset[slots] == positions]
+
+
+class FacilitySpatialIndex:
+    """KD-tree over facility coordinates answering exact k-nearest queries"""
+
+    def __init__(self, latitudes, longitudes, tree: Optional[cKDTree] = None, keys=None):
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.tree = tree if tree is not None else cKDTree(to_unit_vectors(self.latitudes, self.longitudes))
+        # Tie-break key of each row for facilities at equal distances
+        self.keys = np.arange(len(self.latitudes)) if keys is None else np.asarray(keys, dtype=np.int64)
+        # Rows appended after the tree was built; always scanned
+        self.tail = np.arange(self.tree.n, len(self.latitudes), dtype=np.intp)
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def appended(self, latitudes, longitudes, keys=None) -> "FacilitySpatialIndex":
+        """New index with extra rows at the end, sharing this index's tree"""
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        if keys is None:
+            keys = np.arange(len(self.latitudes), len(self.latitudes) + len(latitudes))
+        return FacilitySpatialIndex(
+            np.concatenate((self.latitudes, latitudes)),
+            np.concatenate((self.longitudes, np.asarray(longitudes, dtype=np.float64))),
+            tree=self.tree,
+            keys=np.concatenate((self.keys, np.asarray(keys, dtype=np.int64))),
+        )
+
+    def _ball(self, point: np.ndarray, radius: float, subset: Optional[np.ndarray]) -> np.ndarray:
+        """Sorted subset members in the tree's ball around point, plus the tail's members"""
+        found = np.asarray(self.tree.query_ball_point(point, radius), dtype=np.intp)
+        if len(self.tail):
+            found = np.concatenate((found, self.tail))
+        return _members(np.sort(found), subset)
+
+    def distances(self, lat: float, lon: float, positions: np.ndarray) -> np.ndarray:
+        """Exact distances in km from a point to the given rows"""
+        return distance_km(lat, lon, self.latitudes[positions], self.longitudes[positions])
+
+    def _ranked(self, lat: float, lon: float, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top-k of the given rows, ordered by distance then key"""
+        distances = self.distances(lat, lon, positions)
+        order = np.lexsort((self.keys[positions], distances))[:k]
+        return positions[order], distances[order]
+
+    def _spherical_seeds(self, point: np.ndarray, k: int, subset: Optional[np.ndarray]) -> np.ndarray:
+        """k subset members (or all of them): tail members, then the spherically nearest tree members"""
+        tail = _members(self.tail, subset)
+        need = k - len(tail)
+        n = self.tree.n
+        if need <= 0 or n == 0:
+            return tail[:k]
+
+        share = 1.0 if subset is None else max(len(subset) - len(tail), 1) / n
+        k_try = min(n, int(np.ceil(need / share * 1.5)) + need)
+        while True:
+            _, found = self.tree.query(point, k=k_try)
+            found = _members(np.atleast_1d(found), subset)
+            if len(found) >= need or k_try == n:
+                return np.concatenate((found[:need], tail))
+            k_try = min(n, k_try * 2)
+
+    def nearest(self, lat: float, lon: float, k: int, subset: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest facilities by exact (ellipsoidal) distance.
+
+        Args:
+            lat, lon: Query point in degrees
+            k: Number of facilities to return
+            subset: Optional sorted array of row positions to restrict the search to
+
+        Returns:
+            Tuple of (row positions, distances in km), nearest first
+        """
+        size = len(self) if subset is None else len(subset)
+        k = min(k, size)
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+
+        if subset is not None and size <= BRUTE_FORCE_LIMIT:
+            return self._ranked(lat, lon, subset, k)
+
+        point = to_unit_vectors([lat], [lon])[0]
+        seeds = self._spherical_seeds(point, k, subset)
+        bound = self.distances(lat, lon, seeds).max()
+
+        radius = chord_for_km(bound * (1 + SPHERE_TOLERANCE)) + 1e-12
+        survivors = self._ball(point, radius, subset)
+        return self._ranked(lat, lon, survivors, k)
+
+    def within(self, lat: float, lon: float, radius_km: float, subset: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        All facilities within radius_km by exact (ellipsoidal) distance.
+
+        Returns:
+            Tuple of (row positions, distances in km), nearest first
+        """
+        if subset is not None and len(subset) <= BRUTE_FORCE_LIMIT:
+            candidates = subset
+        else:
+            point = to_unit_vectors([lat], [lon])[0]
+            radius = chord_for_km(radius_km * (1 + SPHERE_TOLERANCE)) + 1e-12
+            candidates = self._ball(point, radius, subset)
+
+        distances = self.distances(lat, lon, candidates)
+        inside = distances <= radius_km
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.lexsort((self.keys[candidates], distances))
+        return candidates[order], distances[order]
+
+    def nearest_after(
+        self,
+        lat: float,
+        lon: float,
+        k: int,
+        after: Tuple[float, int],
+        subset: Optional[np.ndarray] = None,
+        width_km: float = 1.0,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The next k facilities after a cursor in (distance, key) order.
+
+        Searches the annulus from the cursor distance out to a radius that
+        doubles its width until k facilities past the cursor are found.
+        Facilities spherically well inside the cursor distance are dropped
+        before any exact distance is computed.
+
+        Args:
+            lat, lon: Query point in degrees
+            k: Number of facilities to return
+            after: (distance in km, key) of the last facility already returned
+            subset: Optional sorted array of row positions to restrict the search to
+            width_km: Initial annulus width, e.g. the distance span of the previous page
+
+        Returns:
+            Tuple of (row positions, distances in km), nearest first
+        """
+        after_distance, after_key = after
+        if subset is not None and len(subset) <= BRUTE_FORCE_LIMIT:
+            positions, distances = subset, self.distances(lat, lon, subset)
+            beyond = (distances > after_distance) | ((distances == after_distance) & (self.keys[positions] > after_key))
+            positions, distances = positions[beyond], distances[beyond]
+            order = np.lexsort((self.keys[positions], distances))[:k]
+            return positions[order], distances[order]
+
+        point = to_unit_vectors([lat], [lon])[0]
+        inner_chord = chord_for_km(after_distance * (1 - SPHERE_TOLERANCE))
+        width = max(width_km, 1e-3)
+        while True:
+            outer = after_distance + width
+            radius = chord_for_km(outer * (1 + SPHERE_TOLERANCE)) + 1e-12
+            candidates = np.asarray(self.tree.query_ball_point(point, radius), dtype=np.intp)
+            chords = np.linalg.norm(self.tree.data[candidates] - point, axis=1)
+            candidates = candidates[chords >= inner_chord - 1e-12]
+            if len(self.tail):
+                candidates = np.concatenate((candidates, self.tail))
+            candidates = _members(np.sort(candidates), subset)
+
+            distances = self.distances(lat, lon, candidates)
+            beyond = (distances > after_distance) | ((distances == after_distance) & (self.keys[candidates] > after_key))
+            found = beyond & (distances <= outer)
+            if found.sum() >= k or outer >= MAX_SURFACE_DISTANCE_KM:
+                positions, distances = candidates[found], distances[found]
+                order = np.lexsort((self.keys[positions], distances))[:k]
+                return positions[order], distances[order]
+            width *= 2
+
+    def nearest_many(self, latitudes, longitudes, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact k nearest facilities for many query points at once.
+
+        The same two-step search as nearest(), with the tree queries for all
+        points issued as single vectorized calls.
+
+        Returns:
+            Tuple of (row positions, distances in km) arrays of shape
+            (points, k), nearest first; rows are padded with -1 / NaN when
+            fewer than k facilities exist
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        positions = np.full((len(latitudes), k), -1, dtype=np.intp)
+        distances = np.full((len(latitudes), k), np.nan)
+        k_found = min(k, len(self))
+        if k_found == 0 or len(latitudes) == 0:
+            return positions, distances
+
+        points = to_unit_vectors(latitudes, longitudes)
+        k_tree = min(k_found, self.tree.n)
+        seeds = np.empty((len(points), 0), dtype=np.intp)
+        if k_tree:
+            _, seeds = self.tree.query(points, k=k_tree)
+            seeds = seeds.reshape(len(points), k_tree)
+        seeds = np.hstack((seeds, np.broadcast_to(self.tail, (len(points), len(self.tail)))))
+        seed_distances = distance_km(
+            latitudes[:, None], longitudes[:, None], self.latitudes[seeds], self.longitudes[seeds]
+        )
+        bounds = np.partition(seed_distances, k_found - 1, axis=1)[:, k_found - 1]
+        angles = np.minimum(bounds * (1 + SPHERE_TOLERANCE) / EARTH_RADIUS_KM, np.pi)
+        balls = self.tree.query_ball_point(points, 2 * np.sin(angles / 2) + 1e-12)
+        if len(self.tail):
+            tail = self.tail.tolist()
+            balls = [ball + tail for ball in balls]
+
+        # Rank every ball member in one flat pass: sort by (row, distance,
+        # key) and keep each row's first k_found entries
+        sizes = np.fromiter((len(ball) for ball in balls), dtype=np.intp, count=len(balls))
+        rows = np.repeat(np.arange(len(balls)), sizes)
+        members = np.fromiter((p for ball in balls for p in ball), dtype=np.intp, count=int(sizes.sum()))
+        member_distances = distance_km(latitudes[rows], longitudes[rows], self.latitudes[members], self.longitudes[members])
+        order = np.lexsort((self.keys[members], member_distances, rows))
+        rank = np.arange(len(order)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        keep = order[rank < k_found]
+        positions[:, :k_found] = members[keep].reshape(-1, k_found)
+        distances[:, :k_found] = member_distances[keep].reshape(-1, k_found)
+        return positions, distances
@@ -3,6 +3,8 @@ Comprehensive tests for Hospital Referral API
 """
 import pytest
 import asyncio
+import json
+import numpy as np
 from fastapi.testclient import TestClient
 from unittest.mock import patch, MagicMock
 import pandas as pd
@@ -59,6 +61,184 @@ class TestHospitalAPI:
         response = client.get("/recommend-hospitals?lat=3.8480&lon=11.5021&top_n=0")
         assert response.status_code == 422
 
+    def test_facility_types_etag_revalidation(self):
+        """Facility types are served with an ETag and revalidate to a bodyless 304"""
+        response = client.get("/facility-types")
+        assert response.status_code == 200
+        types = response.json()
+        assert isinstance(types, list) and types == sorted(types)
+        etag = response.headers["etag"]
+
+        revalidated = client.get("/facility-types", headers={"If-None-Match": etag})
+        assert revalidated.status_code == 304
+        assert revalidated.content == b""
+
+    def test_large_responses_are_gzipped(self):
+        """Large result lists are compressed for clients that accept gzip"""
+        response = client.get(
+            "/recommend-hospitals?lat=3.8480&lon=11.5021&top_n=50",
+            headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert len(response.json()) == 50
+
+    def test_recommend_hospitals_combined_filters(self):
+        """Category, region and ownership filters combine"""
+        response = client.get(
+            "/recommend-hospitals?lat=4.05&lon=9.7&category=district_hospital&region=littoral&ownership=moh&top_n=5"
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data) == 5
+        assert all("District" in h["facility_type"] for h in data)
+
+    def test_recommend_hospitals_unknown_category(self):
+        """Unknown categories are rejected as validation errors"""
+        response = client.get("/recommend-hospitals?lat=4.05&lon=9.7&category=spaceport")
+        assert response.status_code == 422
+
+    def test_recommend_hospitals_unknown_region(self):
+        """A region without facilities yields an empty list"""
+        response = client.get("/recommend-hospitals?lat=4.05&lon=9.7&region=Atlantis")
+        assert response.status_code == 200
+        assert response.json() == []
+
+    def test_batch_matches_single_queries(self):
+        """Batch results equal the corresponding single queries, in input order"""
+        import numpy as np
+
+        rng = np.random.default_rng(3)
+        queries = []
+        for i in range(40):
+            query = {"lat": float(rng.uniform(2, 12)), "lon": float(rng.uniform(9, 16)), "top_n": int(rng.integers(1, 20))}
+            if i % 3 == 1:
+                query["type"] = "District"
+            if i % 5 == 2:
+                query["category"] = "health_centre"
+                query["region"] = "Centre"
+            queries.append(query)
+
+        response = client.post("/recommend-hospitals/batch", json={"queries": queries})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert len(results) == len(queries)
+        for query, result in zip(queries, results):
+            single = client.get("/recommend-hospitals", params=query).json()
+            assert result == single
+
+    def test_cache_stats(self):
+        """Location cache hit rate is reported"""
+        client.get("/recommend-hospitals?lat=4.0501&lon=9.7001")
+        client.get("/recommend-hospitals?lat=4.0502&lon=9.7002&top_n=10")
+        response = client.get("/cache-stats")
+        assert response.status_code == 200
+        stats = response.json()["location_cache"]
+        assert stats["hits"] >= 1
+        assert 0 < stats["hit_rate"] <= 1
+
+    def test_within_radius_matches_full_scan(self):
+        """Radius search returns every facility in the circle, sorted, across pages"""
+        import numpy as np
+        from geo import distance_km
+        from hospital_recommender import df
+
+        distances = distance_km(4.05, 9.7, df["latitude"].to_numpy(), df["longitude"].to_numpy())
+        expected = np.sort(np.round(distances[distances <= 40], 2))
+
+        first = client.get("/hospitals/within-radius?lat=4.05&lon=9.7&radius_km=40&limit=100").json()
+        assert first["total"] == len(expected)
+        pages = first["results"]
+        while len(pages) < first["total"]:
+            pages += client.get(
+                f"/hospitals/within-radius?lat=4.05&lon=9.7&radius_km=40&limit=100&offset={len(pages)}"
+            ).json()["results"]
+        assert [h["distance_km"] for h in pages] == expected.tolist()
+
+    def test_within_radius_filters_and_validation(self):
+        """Radius search honours filters and validates its parameters"""
+        response = client.get("/hospitals/within-radius?lat=3.848&lon=11.502&radius_km=100&category=district_hospital")
+        assert response.status_code == 200
+        body = response.json()
+        assert body["offset"] == 0 and body["limit"] == 20
+        assert all("district" in h["facility_type"].lower() for h in body["results"])
+        assert client.get("/hospitals/within-radius?lat=3.8&lon=11.5&radius_km=0").status_code == 422
+        assert client.get("/hospitals/within-radius?lat=3.8&lon=11.5&radius_km=5&limit=500").status_code == 422
+        assert client.get("/hospitals/within-radius?lat=3.8&lon=11.5&radius_km=5&category=x").status_code == 422
+        far = client.get("/hospitals/within-radius?lat=-40&lon=-20&radius_km=10").json()
+        assert far == {"total": 0, "offset": 0, "limit": 20, "results": []}
+
+    def test_nearest_pages_cover_every_facility(self):
+        """Following cursors lists every matching facility exactly once, nearest first"""
+        import numpy as np
+        from geo import distance_km
+        from hospital_recommender import df, attribute_index
+
+        rows = attribute_index.select(region="Littoral")
+        distances = distance_km(4.05, 9.7, df["latitude"].to_numpy()[rows], df["longitude"].to_numpy()[rows])
+        expected = rows[np.lexsort((rows, distances))]
+
+        seen = []
+        response = client.get("/hospitals/nearest?lat=4.05&lon=9.7&region=Littoral&page_size=37").json()
+        seen += response["results"]
+        while response["next_cursor"]:
+            response = client.get(f"/hospitals/nearest?page_size=37&cursor={response['next_cursor']}").json()
+            seen += response["results"]
+
+        assert [h["facility_name"] for h in seen] == df["facility_name"].to_numpy()[expected].tolist()
+        assert [h["distance_km"] for h in seen] == sorted(h["distance_km"] for h in seen)
+
+    def test_nearest_first_page_matches_recommendations(self):
+        """The first page equals /recommend-hospitals with the same filters"""
+        page = client.get("/hospitals/nearest?lat=3.848&lon=11.502&page_size=10&category=health_centre").json()
+        single = client.get("/recommend-hospitals?lat=3.848&lon=11.502&top_n=10&category=health_centre").json()
+        assert page["results"] == single
+        assert page["next_cursor"]
+
+    def test_nearest_validation(self):
+        """Missing coordinates and malformed cursors are rejected"""
+        assert client.get("/hospitals/nearest").status_code == 422
+        assert client.get("/hospitals/nearest?cursor=not-a-cursor").status_code == 400
+        assert client.get("/hospitals/nearest?lat=3.8&lon=11.5&page_size=0").status_code == 422
+
+    def test_escalation_from_health_centre(self):
+        """Escalation returns the nearest higher-level facilities from a facility"""
+        import numpy as np
+        from geo import distance_km
+        from facility_index import FACILITY_CATEGORIES
+        from hospital_recommender import df
+
+        health_centre = df[df["facility_category"] == "health_centre"].iloc[0]
+        response = client.get(f"/facilities/{health_centre['facility_id']}/escalation?top_n=5")
+        assert response.status_code == 200
+        body = response.json()
+        assert body["facility"]["level"] == 1
+        assert len(body["escalation"]) == 5
+
+        levels = df["facility_category"].map(FACILITY_CATEGORIES).astype(int).to_numpy()
+        higher = np.flatnonzero(levels >= 2)
+        distances = distance_km(health_centre["latitude"], health_centre["longitude"],
+                                df["latitude"].to_numpy()[higher], df["longitude"].to_numpy()[higher])
+        expected = higher[np.lexsort((higher, distances))[:5]]
+        assert [h["facility_id"] for h in body["escalation"]] == df["facility_id"].to_numpy()[expected].tolist()
+        assert all(h["level"] >= 2 for h in body["escalation"])
+
+    def test_escalation_min_level_and_unknown_facility(self):
+        """min_level narrows the targets; unknown ids are 404"""
+        from hospital_recommender import df
+        body = client.get(f"/facilities/{df['facility_id'].iat[0]}/escalation?min_level=4").json()
+        assert all(h["level"] >= 4 for h in body["escalation"])
+        assert client.get("/facilities/999999/escalation").status_code == 404
+        assert client.get("/facilities/0/escalation?top_n=50").status_code == 422
+
+    def test_batch_validation(self):
+        """Batch requests validate every item"""
+        assert client.post("/recommend-hospitals/batch", json={"queries": []}).status_code == 422
+        bad_coords = {"queries": [{"lat": 3.8, "lon": 11.5}, {"lat": 95, "lon": 11.5}]}
+        assert client.post("/recommend-hospitals/batch", json=bad_coords).status_code == 422
+        bad_category = {"queries": [{"lat": 3.8, "lon": 11.5, "category": "spaceport"}]}
+        assert client.post("/recommend-hospitals/batch", json=bad_category).status_code == 422
+
 class TestHospitalRecommender:
     
     def test_recommend_hospitals_basic(self):
@@ -81,6 +261,244 @@ class TestHospitalRecommender:
             # Check that all results contain the filter term
             assert all("District" in str(facility_type) for facility_type in result['facility_type'])
     
+    def test_recommend_hospitals_distances_match_geodesic(self):
+        """Vectorized distances agree with geopy's geodesic to the API's 10 m rounding"""
+        from geopy.distance import geodesic
+
+        coords = (3.8480, 11.5021)
+        result = recommend_hospitals(coords, top_n=20)
+        for _, row in result.iterrows():
+            expected = geodesic(coords, (row["latitude"], row["longitude"])).km
+            assert abs(row["distance_km"] - expected) <= 0.011
+        assert result["distance_km"].is_monotonic_increasing
+
+    def test_distance_engines_against_geodesic(self):
+        """Ellipsoidal engine is metre-accurate; haversine within 0.6%"""
+        import numpy as np
+        from geopy.distance import geodesic
+        from geo import ellipsoidal_km, haversine_km
+
+        rng = np.random.default_rng(0)
+        lats = rng.uniform(1.6, 13.1, 200)
+        lons = rng.uniform(8.4, 16.2, 200)
+        expected = np.array([geodesic((4.05, 9.7), (a, b)).km for a, b in zip(lats, lons)])
+        assert np.abs(ellipsoidal_km(4.05, 9.7, lats, lons) - expected).max() < 0.005
+        assert (np.abs(haversine_km(4.05, 9.7, lats, lons) - expected) / expected).max() < 0.006
+        assert ellipsoidal_km(4.05, 9.7, np.array([4.05]), np.array([9.7]))[0] == 0.0
+
+    def test_batch_distance_calculation_uses_engine(self):
+        """DatabaseOptimizer's batch helper returns one distance per row, in order"""
+        from performance import DatabaseOptimizer
+        from hospital_recommender import df
+        from geo import distance_km
+
+        distances = DatabaseOptimizer.batch_distance_calculation(df, (3.8480, 11.5021), batch_size=500)
+        assert len(distances) == len(df)
+        assert distances[-1] == distance_km(3.8480, 11.5021, df["latitude"].iloc[-1:], df["longitude"].iloc[-1:])[0]
+
+    def test_spatial_index_matches_full_scan(self):
+        """k-nearest queries return exactly what a full exact scan would"""
+        import numpy as np
+        from geo import distance_km
+        from spatial_index import FacilitySpatialIndex
+
+        rng = np.random.default_rng(7)
+        lats = rng.uniform(1.6, 13.1, 5000)
+        lons = rng.uniform(8.4, 16.2, 5000)
+        index = FacilitySpatialIndex(lats, lons)
+        subsets = [None, np.sort(rng.choice(5000, 300, replace=False)), np.sort(rng.choice(5000, 2500, replace=False))]
+        for _ in range(50):
+            lat, lon = rng.uniform(1.6, 13.1), rng.uniform(8.4, 16.2)
+            k = int(rng.integers(1, 60))
+            for subset in subsets:
+                rows = np.arange(5000) if subset is None else subset
+                distances = distance_km(lat, lon, lats[rows], lons[rows])
+                expected = rows[np.lexsort((rows, distances))[:k]]
+                positions, found = index.nearest(lat, lon, k, subset)
+                np.testing.assert_array_equal(positions, expected)
+                assert np.all(np.diff(found) >= 0)
+
+    def test_spatial_index_k_larger_than_subset(self):
+        """Asking for more facilities than exist returns all of them"""
+        import numpy as np
+        from spatial_index import FacilitySpatialIndex
+
+        index = FacilitySpatialIndex([3.8, 6.0, 4.0], [11.5, 12.0, 11.6])
+        positions, _ = index.nearest(3.8, 11.5, 10)
+        assert list(positions) == [0, 2, 1]
+        positions, _ = index.nearest(3.8, 11.5, 10, subset=np.array([1, 2]))
+        assert list(positions) == [2, 1]
+
+    def test_location_cache_is_exact(self):
+        """Cached cell supersets re-rank to exactly the uncached k-nearest, for any k"""
+        import numpy as np
+        from geo_cache import GeoCellCache
+        from spatial_index import FacilitySpatialIndex
+
+        rng = np.random.default_rng(11)
+        lats, lons = rng.uniform(2, 12, 3000), rng.uniform(9, 16, 3000)
+        index = FacilitySpatialIndex(lats, lons)
+        cache = GeoCellCache(index, cell_deg=0.5)
+        subset = np.sort(rng.choice(3000, 900, replace=False))
+        # Many points per cell so most lookups are hits
+        for _ in range(300):
+            lat, lon = rng.uniform(4, 5), rng.uniform(11, 12)
+            k = int(rng.integers(1, 51))
+            for rows, key in ((None, None), (subset, "subset")):
+                positions, distances = cache.nearest(lat, lon, k, rows, key)
+                expected, expected_distances = index.nearest(lat, lon, k, rows)
+                np.testing.assert_array_equal(positions, expected)
+                np.testing.assert_allclose(distances, expected_distances)
+
+        stats = cache.stats()
+        assert stats["entries"] == 8
+        assert stats["misses"] == 8
+        assert stats["hits"] == 592
+
+    def test_location_cache_bypass_and_eviction(self):
+        """k above max_k skips the cache; the LRU never exceeds its capacity"""
+        import numpy as np
+        from geo_cache import GeoCellCache
+        from spatial_index import FacilitySpatialIndex
+
+        rng = np.random.default_rng(12)
+        index = FacilitySpatialIndex(rng.uniform(2, 12, 500), rng.uniform(9, 16, 500))
+        cache = GeoCellCache(index, cell_deg=0.1, capacity=3, max_k=10)
+        positions, _ = cache.nearest(4.0, 11.0, 20)
+        assert len(positions) == 20
+        assert cache.stats()["hits"] + cache.stats()["misses"] == 0
+        for i in range(5):
+            cache.nearest(4.0 + i, 11.0, 5)
+        assert cache.stats()["entries"] == 3
+
+    def test_bounding_box_prefilter_near_equator(self):
+        """The prefilter keeps every facility within the radius, however close to the equator"""
+        import numpy as np
+        from geo import distance_km
+        from performance import DatabaseOptimizer
+
+        rng = np.random.default_rng(9)
+        frame = pd.DataFrame({"latitude": rng.uniform(-1, 1, 2000), "longitude": rng.uniform(9, 12, 2000)})
+        for lat in (0.0, 0.05, 2.0):
+            filtered = DatabaseOptimizer.optimize_hospital_query(frame, lat, 10.5, radius_km=50)
+            inside = distance_km(lat, 10.5, frame["latitude"], frame["longitude"]) <= 50
+            assert set(np.flatnonzero(inside)) <= set(filtered.index)
+            assert len(filtered) < len(frame)
+
+    def test_nearest_after_continues_exactly(self):
+        """Paging with nearest_after() reproduces a full sort, ties broken by position"""
+        import numpy as np
+        from geo import distance_km
+        from spatial_index import FacilitySpatialIndex
+
+        rng = np.random.default_rng(13)
+        lats = np.round(rng.uniform(2, 12, 3000), 2)
+        lons = np.round(rng.uniform(9, 16, 3000), 2)
+        lats[:50], lons[:50] = 4.0, 11.0  # coincident facilities tie exactly
+        index = FacilitySpatialIndex(lats, lons)
+        for subset in (None, np.sort(rng.choice(3000, 200, replace=False)), np.arange(0, 3000, 2)):
+            rows = np.arange(3000) if subset is None else subset
+            distances = distance_km(4.1, 11.1, lats[rows], lons[rows])
+            expected = rows[np.lexsort((rows, distances))]
+
+            positions, found = index.nearest(4.1, 11.1, 30, subset)
+            seen = list(positions)
+            while len(positions):
+                positions, found = index.nearest_after(4.1, 11.1, 30, (found[-1], positions[-1]), subset)
+                seen += list(positions)
+            assert seen == list(expected)
+
+    def test_nearest_after_breaks_ties_by_key(self):
+        """With keys, ties are ordered and resumed by key rather than row position"""
+        import numpy as np
+        from spatial_index import FacilitySpatialIndex
+
+        keys = np.array([50, 40, 30, 20, 10, 60])
+        index = FacilitySpatialIndex([4.0] * 5 + [4.5], [11.0] * 6, keys=keys)
+        positions, found = index.nearest(4.0, 11.0, 2)
+        assert keys[positions].tolist() == [10, 20]
+        positions, found = index.nearest_after(4.0, 11.0, 3, (found[-1], int(keys[positions[-1]])))
+        assert keys[positions].tolist() == [30, 40, 50]
+        index = index.appended([4.0], [11.0], [15])
+        assert index.keys[index.nearest(4.0, 11.0, 3)[0]].tolist() == [10, 15, 20]
+
+    def test_transfer_graph_excludes_self_and_pads(self):
+        """Each level lists the k nearest other facilities, padded when a level is small"""
+        import numpy as np
+        from transfer_graph import TransferGraph
+
+        lats = np.array([4.0, 4.1, 4.2, 4.3, 9.0])
+        lons = np.array([11.0, 11.0, 11.0, 11.0, 13.0])
+        graph = TransferGraph.build(lats, lons, np.array([1, 1, 1, 3, 5], dtype=np.int8), k=3)
+        assert graph.levels.tolist() == [1, 3, 5]
+        assert graph.neighbors[0, 0].tolist() == [1, 2, -1]
+        assert graph.neighbors[3, 1].tolist() == [-1, -1, -1]
+        positions, distances = graph.escalation(0, min_level=2, top_n=3)
+        assert positions.tolist() == [3, 4]
+        assert np.all(np.diff(distances) > 0)
+
+    def test_facility_type_taxonomy(self):
+        """Free-text facility types normalize onto the category taxonomy"""
+        from facility_index import normalize_facility_type
+
+        assert normalize_facility_type("Centre de Santé Intégré") == "health_centre"
+        assert normalize_facility_type("Health Centre") == "health_centre"
+        assert normalize_facility_type("Centre Medical d’Arrondissement") == "medical_centre"
+        assert normalize_facility_type("Hôpital de District") == "district_hospital"
+        assert normalize_facility_type("Hôpital Régional") == "regional_hospital"
+        assert normalize_facility_type("Hôpital Général") == "central_hospital"
+        assert normalize_facility_type("Hôpital Centraux") == "central_hospital"
+        assert normalize_facility_type("Dispensaire") == "dispensary"
+        assert normalize_facility_type(None) == "other"
+
+    def test_attribute_index_matches_frame_filters(self):
+        """Index selections equal the equivalent full-frame boolean filters"""
+        import numpy as np
+        from hospital_recommender import df, attribute_index
+
+        rows = attribute_index.select(type_query="district", region="LITTORAL")
+        expected = np.flatnonzero(
+            df["facility_type"].str.contains("district", case=False, na=False).to_numpy()
+            & (df["admin1"].str.lower() == "littoral").to_numpy()
+        )
+        np.testing.assert_array_equal(rows, expected)
+        assert attribute_index.select() is None
+        assert len(attribute_index.select(category="health_centre", ownership="nobody")) == 0
+
+    def test_nearest_in_blocks_bounds_block_size(self):
+        """Tiny memory bounds (one row per block) give the same answers"""
+        import numpy as np
+        from geo import nearest_in_blocks
+
+        rng = np.random.default_rng(5)
+        lats, lons = rng.uniform(2, 12, 800), rng.uniform(9, 16, 800)
+        qlats, qlons = rng.uniform(2, 12, 25), rng.uniform(9, 16, 25)
+        ks = rng.integers(1, 30, 25)
+        big = nearest_in_blocks(qlats, qlons, lats, lons, ks)
+        small = nearest_in_blocks(qlats, qlons, lats, lons, ks, block_bytes=1)
+        for (p1, d1), (p2, d2), k in zip(big, small, ks):
+            assert len(p1) == k
+            np.testing.assert_array_equal(p1, p2)
+            np.testing.assert_allclose(d1, d2)
+
+    def test_nearest_in_blocks_peak_memory_within_bound(self):
+        """block_bytes bounds the whole computation, distance_km's temporaries included"""
+        import tracemalloc
+        import numpy as np
+        from geo import nearest_in_blocks
+
+        rng = np.random.default_rng(6)
+        lats, lons = rng.uniform(2, 12, 3000), rng.uniform(9, 16, 3000)
+        qlats, qlons = rng.uniform(2, 12, 1000), rng.uniform(9, 16, 1000)
+        block_bytes = 4 * 1024 * 1024
+        tracemalloc.start()
+        try:
+            nearest_in_blocks(qlats, qlons, lats, lons, np.full(1000, 5), block_bytes=block_bytes)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak < block_bytes
+
     def test_recommend_hospitals_invalid_coords(self):
         """Test with invalid coordinates"""
         with pytest.raises(ValueError):
@@ -94,6 +512,451 @@ class TestHospitalRecommender:
         assert isinstance(result, pd.DataFrame)
         assert result.empty
 
+class TestDatasetManager:
+
+    @pytest.fixture(autouse=True)
+    def restore_dataset(self):
+        import hospital_recommender
+        delay = hospital_recommender.dataset.rebuild_delay
+        yield
+        hospital_recommender.dataset.rebuild_delay = delay
+        hospital_recommender.dataset.reload()
+
+    def _headers(self):
+        from security import security_manager
+        return {"Authorization": f"Bearer {security_manager.create_access_token({'sub': 'admin'})}"}
+
+    def test_cursor_from_replaced_snapshot_is_rejected(self):
+        """Paging can't resume across a data change, which could skip facilities"""
+        import hospital_recommender
+        hospital_recommender.dataset.rebuild_delay = 60
+        page = client.get("/hospitals/nearest?lat=3.848&lon=11.502&page_size=5").json()
+        assert client.get(f"/hospitals/nearest?cursor={page['next_cursor']}").status_code == 200
+
+        facility = {"facility_name": "Cursor Clinic", "facility_type": "Clinique", "latitude": 3.849, "longitude": 11.503}
+        assert client.post("/admin/facilities", json=facility, headers=self._headers()).status_code == 201
+        response = client.get(f"/hospitals/nearest?cursor={page['next_cursor']}")
+        assert response.status_code == 410
+        assert "first page" in response.json()["detail"]
+
+    def test_cursor_survives_background_rebuild(self):
+        """Compaction doesn't change the facilities, so cursors stay valid"""
+        import hospital_recommender
+        dataset = hospital_recommender.dataset
+        dataset.rebuild_delay = 60
+        facility = {"facility_name": "Rebuild Clinic", "facility_type": "Clinique", "latitude": 3.849, "longitude": 11.503}
+        assert client.post("/admin/facilities", json=facility, headers=self._headers()).status_code == 201
+        page = client.get("/hospitals/nearest?lat=3.848&lon=11.502&page_size=5").json()
+
+        version = dataset.snapshot.version
+        dataset.rebuild()
+        assert dataset.snapshot.version == version
+        assert dataset.snapshot.live is None
+        response = client.get(f"/hospitals/nearest?cursor={page['next_cursor']}")
+        assert response.status_code == 200
+        assert response.json()["results"][0]["distance_km"] >= page["results"][-1]["distance_km"]
+
+    def test_admin_edits_are_served_immediately(self):
+        """Added, updated and removed facilities show up in searches without a restart"""
+        facility = {"facility_name": "Test Clinic", "facility_type": "Clinique", "latitude": 5.4321, "longitude": 12.3456}
+        response = client.post("/admin/facilities", json=facility, headers=self._headers())
+        assert response.status_code == 201
+        facility_id = response.json()["facility_id"]
+
+        nearest = client.get("/recommend-hospitals?lat=5.4321&lon=12.3456&top_n=1").json()[0]
+        assert nearest["facility_id"] == facility_id
+        assert nearest["distance_km"] == 0
+        clinics = client.get("/recommend-hospitals?lat=5.4321&lon=12.3456&top_n=1&category=clinic").json()
+        assert clinics[0]["facility_id"] == facility_id
+
+        response = client.patch(f"/admin/facilities/{facility_id}", json={"facility_name": "Renamed Clinic"}, headers=self._headers())
+        assert response.status_code == 200
+        nearest = client.get("/recommend-hospitals?lat=5.4321&lon=12.3456&top_n=2").json()
+        assert nearest[0]["facility_name"] == "Renamed Clinic"
+        assert nearest[1]["facility_id"] != facility_id
+
+        assert client.delete(f"/admin/facilities/{facility_id}", headers=self._headers()).status_code == 200
+        nearest = client.get("/recommend-hospitals?lat=5.4321&lon=12.3456&top_n=1").json()[0]
+        assert nearest["facility_id"] != facility_id
+        assert client.get(f"/facilities/{facility_id}/escalation").status_code == 404
+        assert client.delete(f"/admin/facilities/{facility_id}", headers=self._headers()).status_code == 404
+        # Ids derive from name and coordinates, so re-adding restores the same id
+        assert client.post("/admin/facilities", json=facility, headers=self._headers()).json()["facility_id"] == facility_id
+
+    def test_facility_types_follow_admin_edits(self):
+        """Adding or removing the only facility of a type changes the list and its ETag"""
+        facility = {"facility_name": "Type Probe", "facility_type": "Zz Probe Type", "latitude": 4.1, "longitude": 9.8}
+        before = client.get("/facility-types")
+        facility_id = client.post("/admin/facilities", json=facility, headers=self._headers()).json()["facility_id"]
+        added = client.get("/facility-types", headers={"If-None-Match": before.headers["etag"]})
+        assert added.status_code == 200
+        assert "Zz Probe Type" in added.json()
+
+        assert client.delete(f"/admin/facilities/{facility_id}", headers=self._headers()).status_code == 200
+        removed = client.get("/facility-types", headers={"If-None-Match": added.headers["etag"]})
+        assert removed.status_code == 200
+        assert removed.json() == before.json()
+
+    def test_admin_api_requires_token_and_valid_fields(self):
+        """Admin routes reject anonymous callers and invalid facilities"""
+        facility = {"facility_name": "X", "facility_type": "Clinique", "latitude": 5.0, "longitude": 12.0}
+        assert client.post("/admin/facilities", json=facility).status_code in (401, 403)
+        assert client.post("/admin/dataset/reload").status_code in (401, 403)
+        bad = dict(facility, latitude=120)
+        assert client.post("/admin/facilities", json=bad, headers=self._headers()).status_code == 422
+        from hospital_recommender import df
+        existing = int(df["facility_id"].iat[0])
+        assert client.patch(f"/admin/facilities/{existing}", json={"facility_name": None}, headers=self._headers()).status_code == 422
+
+    def test_incremental_snapshot_matches_rebuild(self):
+        """Edited snapshots answer like a snapshot rebuilt from scratch"""
+        import numpy as np
+        import hospital_recommender
+
+        dataset = hospital_recommender.dataset
+        dataset.rebuild_delay = 3600
+        rng = np.random.default_rng(21)
+        for i in range(30):
+            dataset.add_facility({
+                "facility_name": f"New {i}", "facility_type": "Hôpital de District",
+                "latitude": float(rng.uniform(3, 6)), "longitude": float(rng.uniform(9, 12)),
+            })
+        ids = dataset.snapshot.df["facility_id"].to_numpy()
+        for facility_id in rng.choice(ids[:3000], 40, replace=False):
+            dataset.remove_facility(int(facility_id))
+        for facility_id in rng.choice(ids[3000:3050], 10, replace=False):
+            dataset.update_facility(int(facility_id), {"latitude": float(rng.uniform(3, 6))})
+
+        edited = dataset.snapshot
+        assert edited.transfer_graph is None
+        rebuilt = edited.compacted()
+        assert edited.facility_count == rebuilt.facility_count == len(rebuilt.df)
+        for _ in range(30):
+            lat, lon = rng.uniform(3, 6), rng.uniform(9, 12)
+            for category in (None, "district_hospital"):
+                expected = rebuilt.spatial_index.nearest(lat, lon, 20, rebuilt.select(category=category))
+                found = edited.spatial_index.nearest(lat, lon, 20, edited.select(category=category))
+                assert edited.df["facility_id"].to_numpy()[found[0]].tolist() == \
+                    rebuilt.df["facility_id"].to_numpy()[expected[0]].tolist()
+
+    def test_escalation_while_graph_is_stale(self):
+        """Escalations fall back to an exact search that matches the graph's answer"""
+        import hospital_recommender
+
+        dataset = hospital_recommender.dataset
+        dataset.rebuild_delay = 3600
+        expected = client.get("/facilities/10/escalation?top_n=5").json()
+        dataset.add_facility({"facility_name": "Far away", "facility_type": "Clinique", "latitude": 12.9, "longitude": 15.9})
+        assert dataset.snapshot.transfer_graph is None
+        assert client.get("/facilities/10/escalation?top_n=5").json() == expected
+
+    def test_old_snapshot_stays_consistent(self):
+        """A request holding a snapshot is unaffected by later edits and rebuilds"""
+        import hospital_recommender
+
+        dataset = hospital_recommender.dataset
+        before = dataset.snapshot
+        positions, _ = before.spatial_index.nearest(3.848, 11.502, 5)
+        dataset.remove_facility(int(before.df["facility_id"].iat[positions[0]]))
+        dataset.rebuild()
+        assert dataset.snapshot is not before
+        assert before.facility_count == len(before.df)
+        assert before.spatial_index.nearest(3.848, 11.502, 5)[0].tolist() == positions.tolist()
+
+    def test_background_rebuild_restores_transfer_graph(self):
+        """Edits schedule a background rebuild that compacts and rebuilds the graph"""
+        import time
+        import hospital_recommender
+
+        dataset = hospital_recommender.dataset
+        dataset.rebuild_delay = 0
+        removed = int(dataset.snapshot.df["facility_id"].iat[0])
+        dataset.remove_facility(removed)
+        deadline = time.time() + 10
+        while dataset.snapshot.transfer_graph is None and time.time() < deadline:
+            time.sleep(0.02)
+        snapshot = dataset.snapshot
+        assert snapshot.transfer_graph is not None
+        assert snapshot.live is None
+        assert removed not in snapshot.id_positions
+        response = client.get("/admin/dataset", headers=self._headers()).json()
+        assert response["rebuild_pending"] is False
+        # Rebuilding doesn't hide that the data differs from the source file
+        assert response["dataset_version"].endswith("+edited")
+
+class TestDataCache:
+
+    def _copy_source(self, tmp_path):
+        import shutil
+        source = tmp_path / "camerounhopitals.xlsx"
+        shutil.copy("camerounhopitals.xlsx", source)
+        return str(source)
+
+    def test_cache_roundtrip_skips_excel(self, tmp_path, monkeypatch):
+        """A second load is served from the cache without parsing the xlsx"""
+        import hospital_recommender
+
+        source = self._copy_source(tmp_path)
+        monkeypatch.setenv("HOSPITAL_CACHE_DIR", str(tmp_path / "cache"))
+        fresh, fresh_graph = hospital_recommender.load_hospital_data(source)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("xlsx parsed despite a current cache")
+
+        monkeypatch.setattr(hospital_recommender.pd, "read_excel", fail)
+        cached, cached_graph = hospital_recommender.load_hospital_data(source)
+        pd.testing.assert_frame_equal(fresh, cached)
+        for name, value in fresh_graph.to_arrays().items():
+            np.testing.assert_array_equal(value, cached_graph.to_arrays()[name])
+
+    def test_cache_invalidated_by_source_edit(self, tmp_path, monkeypatch):
+        """Editing the source file changes the cache key and drops the stale cache"""
+        import os
+        from data_cache import FacilityDataCache
+        import hospital_recommender
+
+        source = self._copy_source(tmp_path)
+        monkeypatch.setenv("HOSPITAL_CACHE_DIR", str(tmp_path / "cache"))
+        hospital_recommender.load_hospital_data(source)
+        old_path = FacilityDataCache(source).path
+
+        raw = pd.read_excel(source)
+        raw.iloc[:-1].to_excel(source, index=False)
+        assert FacilityDataCache(source).path != old_path
+        assert FacilityDataCache(source).load() is None
+
+        edited, _ = hospital_recommender.load_hospital_data(source)
+        expected = hospital_recommender.clean_hospital_data(raw.iloc[:-1].copy())
+        assert len(edited) == len(expected)
+        assert not os.path.exists(old_path)
+
+    def test_facility_ids_survive_source_edits(self):
+        """Ids come from name and coordinates, so removing or reordering rows keeps the others' ids"""
+        import hospital_recommender
+
+        raw = pd.read_excel("camerounhopitals.xlsx")
+        original = hospital_recommender.clean_hospital_data(raw.copy())
+        edited = hospital_recommender.clean_hospital_data(raw.iloc[:0:-1].copy())
+
+        assert original["facility_id"].is_unique
+        assert original["facility_id"].max() < 2 ** 53
+        ids = dict(zip(original["facility_name"] + original["latitude"].astype(str), original["facility_id"]))
+        assert all(
+            ids[name + str(lat)] == facility_id
+            for name, lat, facility_id in zip(edited["facility_name"], edited["latitude"], edited["facility_id"])
+        )
+
+    def test_frame_arrays_roundtrip_preserves_nulls_and_categories(self):
+        """Text nulls and categorical columns survive the pickle-free layout"""
+        from data_cache import arrays_to_frame, frame_to_arrays
+
+        frame = pd.DataFrame({
+            "name": ["a", None, "c"],
+            "lat": [1.0, 2.0, 3.0],
+            "kind": pd.Categorical(["x", "y", "x"]),
+        })
+        restored = arrays_to_frame(frame_to_arrays(frame))
+        assert restored["name"].isna().tolist() == [False, True, False]
+        assert restored["name"][0] == "a"
+        assert restored["lat"].dtype == "float64"
+        assert restored["kind"].tolist() == ["x", "y", "x"]
+        assert isinstance(restored["kind"].dtype, pd.CategoricalDtype)
+
+class TestCoverageAnalysis:
+
+    def test_grid_matches_brute_force(self, tmp_path):
+        """Tiled, multi-process grids equal a direct nearest-distance computation"""
+        import json
+        from coverage_analysis import run_coverage
+        from geo import distance_km
+
+        rng = np.random.default_rng(17)
+        frame = pd.DataFrame({
+            "latitude": rng.uniform(3, 6, 200),
+            "longitude": rng.uniform(10, 13, 200),
+            "facility_category": pd.Categorical(rng.choice(["health_centre", "district_hospital"], 200, p=[0.9, 0.1])),
+            "admin1": rng.choice(["Centre", "Littoral"], 200),
+        })
+        summary = run_coverage(frame, str(tmp_path), resolution_km=15, workers=2, tile_rows=5, max_reach_km=1000)
+
+        with open(tmp_path / "grid.json") as handle:
+            grid = json.load(handle)
+        shape = (grid["rows"], grid["cols"])
+        lats = grid["lat0"] + grid["lat_step"] * np.arange(grid["rows"])
+        lons = grid["lon0"] + grid["lon_step"] * np.arange(grid["cols"])
+        cell_lats, cell_lons = np.meshgrid(lats, lons, indexing="ij")
+        distances = distance_km(cell_lats[..., None], cell_lons[..., None], frame["latitude"].to_numpy(), frame["longitude"].to_numpy())
+
+        nearest_all = np.memmap(tmp_path / "distance_all.f32", dtype=np.float32, mode="r", shape=shape)
+        np.testing.assert_allclose(nearest_all, distances.min(axis=2), rtol=1e-6)
+        hospitals = (frame["facility_category"] == "district_hospital").to_numpy()
+        nearest_hospital = np.memmap(tmp_path / "distance_district_hospital.f32", dtype=np.float32, mode="r", shape=shape)
+        np.testing.assert_allclose(nearest_hospital, distances[..., hospitals].min(axis=2), rtol=1e-6)
+
+        regions = np.memmap(tmp_path / "region.i16", dtype=np.int16, mode="r", shape=shape)
+        expected_regions = frame["admin1"].to_numpy()[distances.argmin(axis=2)]
+        assert (np.asarray(grid["regions"])[regions] == expected_regions).all()
+
+        assert set(summary) == {"Centre", "Littoral"}
+        centre = summary["Centre"]["categories"]["district_hospital"]["area_beyond_km2"]
+        assert centre["5"] >= centre["10"] >= centre["20"] >= centre["50"]
+
+class TestIngest:
+
+    def test_repair_mojibake_matches_row_wise_fix(self):
+        """The vectorized repair gives the same values as fixing each row"""
+        from ingest import fix_mojibake, repair_mojibake
+
+        mangled = "Centre de Santé Intégré".encode("utf-8").decode("cp437")
+        values = pd.Series([mangled, "Health Centre", None, mangled, "Hôpital"], dtype=object)
+        repaired = repair_mojibake(values)
+        assert repaired.tolist() == [fix_mojibake(value) for value in values]
+        assert repaired[0] == "Centre de Santé Intégré"
+
+    def test_pipeline_merges_sources(self, tmp_path):
+        """CSV and GeoJSON sources are validated, categorized and deduplicated"""
+        from ingest import run_pipeline, write_output
+        from hospital_recommender import load_hospital_data
+
+        mangled = "Centre de Santé Intégré".encode("utf-8").decode("cp437")
+        pd.DataFrame({
+            "Facility_n": ["CSI Nkolbisson", "Hopital de District Biyem-Assi", "No coordinates", "Zero island"],
+            "Facility_t": [mangled, "Hôpital de District", "Health Centre", "Clinic"],
+            "Admin1": ["Centre", "Centre", "Centre", "Littoral"],
+            "Lat": [3.8700, 3.8400, None, 0.0],
+            "Long": [11.4500, 11.5000, 11.5, 0.0],
+        }).to_csv(tmp_path / "registry.csv", index=False)
+        features = [
+            # Same facility ~50 m away with a slightly different name: a duplicate
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [11.4504, 3.8702]},
+             "properties": {"name": "CSI  Nkolbisson ", "type": "Health Centre"}},
+            # Same name far away: a different facility
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [9.70, 4.05]},
+             "properties": {"name": "CSI Nkolbisson", "type": "Health Centre"}},
+        ]
+        with open(tmp_path / "extra.geojson", "w") as handle:
+            json.dump({"type": "FeatureCollection", "features": features}, handle)
+
+        frame = run_pipeline([str(tmp_path / "registry.csv"), str(tmp_path / "extra.geojson")], chunksize=2)
+        assert frame["facility_name"].tolist() == ["CSI Nkolbisson", "Hopital de District Biyem-Assi", "CSI Nkolbisson"]
+        assert frame["facility_type"].iat[0] == "Centre de Santé Intégré"
+        assert frame["facility_category"].astype(str).tolist() == ["health_centre", "district_hospital", "health_centre"]
+
+        write_output(frame, str(tmp_path / "facilities.csv"))
+        loaded, _ = load_hospital_data(str(tmp_path / "facilities.csv"), use_cache=False)
+        assert loaded["facility_name"].tolist() == frame["facility_name"].tolist()
+
+    def test_geojson_features_are_streamed(self):
+        """Features decode one at a time across block boundaries, skipping other members"""
+        import io
+        from ingest import _iter_geojson_features
+
+        features = [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [11.5 + i / 7, 3.8 - i / 9]},
+             "properties": {"name": f"CSI {i} ]}}", "beds": i * 1000003, "public": i % 2 == 0, "owner": None}}
+            for i in range(20)
+        ]
+        document = {"type": "FeatureCollection", "name": 'not "features": [', "bbox": [9, 2, 16, 12.5], "features": features}
+        text = json.dumps(document, indent=1)
+        for block_chars in (1, 5, 64):
+            assert list(_iter_geojson_features(io.StringIO(text), block_chars)) == features
+        assert list(_iter_geojson_features(io.StringIO('{"type": "FeatureCollection", "features": []}'))) == []
+        with pytest.raises(ValueError):
+            list(_iter_geojson_features(io.StringIO('{"features": [{"type": "Feature"}'), 4))
+
+    def test_candidate_pairs_cover_close_points(self):
+        """Grid neighbourhoods contain every pair within the cell size"""
+        from ingest import candidate_pairs
+        from geo import distance_km
+
+        rng = np.random.default_rng(5)
+        lats, lons = rng.uniform(3, 3.2, 400), rng.uniform(11, 11.2, 400)
+        first, second = candidate_pairs(lats, lons, 1.0)
+        candidates = set(zip(first.tolist(), second.tolist()))
+        distances = distance_km(lats[:, None], lons[:, None], lats, lons)
+        close = {(i, j) for i, j in zip(*np.nonzero(distances <= 1.0)) if i < j}
+        assert close <= candidates
+        assert len(candidates) < 400 * 399 / 2
+
+class TestSecurity:
+
+    def test_verified_tokens_skip_decoding(self):
+        """A token is decoded once, then served from the cache"""
+        from security import SecurityManager
+        import security
+
+        manager = SecurityManager()
+        token = manager.create_access_token({"sub": "admin"})
+        with patch.object(security.jwt, "decode", wraps=security.jwt.decode) as decode:
+            first = manager.verify_token(token)
+            first["sub"] = "changed"
+            assert manager.verify_token(token)["sub"] == "admin"
+            assert decode.call_count == 1
+
+    def test_invalid_expired_and_revoked_tokens(self):
+        """Bad tokens get 401s; revoked tokens stop working at once"""
+        from datetime import timedelta
+        from fastapi import HTTPException
+        from security import SecurityManager
+
+        manager = SecurityManager()
+        for token in ("not-a-jwt", manager.create_access_token({"sub": "a"}, timedelta(seconds=-5))):
+            with pytest.raises(HTTPException) as error:
+                manager.verify_token(token)
+            assert error.value.status_code == 401
+        assert len(manager.token_cache) == 0
+
+        token = manager.create_access_token({"sub": "a"})
+        manager.verify_token(token)
+        manager.revoke_token(token)
+        with pytest.raises(HTTPException) as error:
+            manager.verify_token(token)
+        assert error.value.detail == "Token revoked"
+
+    def test_cache_is_bounded(self):
+        from security import SecurityManager
+
+        manager = SecurityManager(token_cache_size=3)
+        for i in range(10):
+            manager.verify_token(manager.create_access_token({"sub": f"user-{i}"}))
+        assert len(manager.token_cache) == 3
+
+class TestAudit:
+
+    def test_searches_are_audited_and_readable_by_admins(self, tmp_path, monkeypatch):
+        """Searches leave audit records that the admin endpoint returns newest first"""
+        import main
+        from security import security_manager
+        from shared.audit import AuditLog
+
+        audit = AuditLog(str(tmp_path / "audit.db"), "hospital-referral-api")
+        monkeypatch.setattr(main, "audit_log", audit)
+        single = client.get("/recommend-hospitals", params={"lat": 3.848, "lon": 11.502, "top_n": 2}).json()
+        batch = client.post("/recommend-hospitals/batch", json={"queries": [{"lat": 4.05, "lon": 9.7, "top_n": 3}]}).json()
+        # Lookahead searches (e.g. from /triage/referral) are audited by the caller instead
+        speculative = {"queries": [{"lat": 5.0, "lon": 10.0}] * 5, "speculative": True}
+        assert client.post("/recommend-hospitals/batch", json=speculative).status_code == 200
+
+        headers = {"Authorization": f"Bearer {security_manager.create_access_token({'sub': 'admin'})}"}
+        assert client.get("/admin/audit").status_code in (401, 403)
+        response = client.get("/admin/audit", params={"kind": "search"}, headers=headers)
+        assert response.status_code == 200
+        assert response.json()["records"] == []
+
+        audit.flush()
+        body = client.get("/admin/audit", params={"kind": "search"}, headers=headers).json()
+        assert body["stats"]["written"] == 2
+        latest, first = body["records"]
+        assert (first["lat"], first["lon"]) == (3.848, 11.502)
+        assert first["facilities"] == [h["facility_id"] for h in single]
+        assert latest["facilities"] == [h["facility_id"] for h in batch["results"][0]]
+        # The source file's SHA-256 identifies the dataset across processes and restarts
+        from data_cache import file_digest
+        assert first["model_version"] == file_digest(main.hospital_recommender.HOSPITAL_DATA_FILE)
+        assert first["latency_ms"] > 0
+        audit.close()
+
+
 class TestPerformance:
     
     def test_api_response_time(self):
@@ -122,6 +985,274 @@ class TestPerformance:
         for response in results:
             assert response.status_code == 200
 
+    def test_histogram_percentiles_within_a_bucket(self):
+        """Log-bucket percentiles are within one bucket width (~9%) of the exact values"""
+        from performance import LatencyHistogram
+
+        samples = np.random.default_rng(3).lognormal(mean=-5, sigma=1, size=20000)
+        histogram = LatencyHistogram()
+        for sample in samples:
+            histogram.record(sample)
+        for q in (50, 95, 99):
+            exact = np.percentile(samples, q)
+            assert exact <= histogram.percentile(q) <= exact * 2 ** (1 / 8) * 1.001
+
+    def test_metrics_endpoint(self):
+        """/metrics reports route templates, stage timings and cache hit rates"""
+        client.get("/recommend-hospitals?lat=3.8480&lon=11.5021")
+        client.get("/facilities/1/escalation")
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        assert 'hospital_api_request_duration_seconds{method="GET",route="/recommend-hospitals",quantile="0.99"}' in body
+        assert 'route="/facilities/{facility_id}/escalation"' in body
+        assert 'route="/facilities/1/escalation"' not in body
+        for stage in ("filter", "distance", "sort"):
+            assert f'operation="recommend_hospitals",stage="{stage}"' in body
+        assert 'hospital_api_cache_hit_ratio{cache="location"}' in body
+        assert 'hospital_api_requests_in_flight{method="GET",route="/metrics"} 1' in body
+
+    def test_benchmark_engines_agree_and_regressions_flagged(self):
+        """Benchmark engines return the exact results; slower runs are reported"""
+        import benchmark
+        import hospital_recommender
+
+        base = hospital_recommender.dataset.snapshot
+        snapshot = benchmark.snapshot_of(benchmark.scale_facilities(base.df, 2, 0.1, seed=1))
+        queries = benchmark.make_queries(20, seed=7)
+        assert queries == benchmark.make_queries(20, seed=7)
+        try:
+            reference = benchmark.vectorized_engine(snapshot)
+            for name in ("kdtree", "recommend"):
+                benchmark.check_agreement(reference, benchmark.ENGINES[name](snapshot), snapshot, queries, 0.006)
+        finally:
+            hospital_recommender.dataset.snapshot = base
+
+        baseline = {"engines": {"kdtree@x1": {"median_us": 100.0}}, "throughput": {"c8": {"rps": 200.0}}}
+        results = {"engines": {"kdtree@x1": {"median_us": 140.0}}, "throughput": {"c8": {"rps": 190.0}}}
+        assert len(benchmark.compare(results, baseline, tolerance=0.25)) == 1
+
+    def test_searches_are_shed_when_executor_is_full(self, monkeypatch):
+        """Searches get 503 with Retry-After when admission fails; /health stays up"""
+        import main
+        from shared.execution import CPUExecutor
+
+        executor = CPUExecutor(workers=1)
+        monkeypatch.setattr(executor, "_admit", lambda endpoint, weight=1: False)
+        monkeypatch.setattr(main, "cpu_executor", executor)
+
+        for response in (
+            client.get("/recommend-hospitals?lat=3.848&lon=11.502"),
+            client.post("/recommend-hospitals/batch", json={"queries": [{"lat": 3.848, "lon": 11.502}]}),
+            client.get("/hospitals/within-radius?lat=3.848&lon=11.502&radius_km=5"),
+        ):
+            assert response.status_code == 503
+            assert int(response.headers["retry-after"]) >= 1
+        health = client.get("/health")
+        assert health.status_code == 200
+        assert health.json()["executor"]["workers"] == 1
+        executor.shutdown()
+
+    def test_small_batches_are_admitted_by_query_count(self, monkeypatch):
+        """Concurrent referral-sized batches aren't shed as if each were a full batch"""
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        import main
+        from shared.execution import CPUExecutor
+
+        executor = CPUExecutor(workers=2, endpoint_limits=main.cpu_executor.endpoint_limits)
+        release = threading.Event()
+        searches = main.batch_recommend_hospitals
+        monkeypatch.setattr(main, "cpu_executor", executor)
+        monkeypatch.setattr(main, "batch_recommend_hospitals", lambda queries: release.wait(5) and searches(queries))
+
+        referral = {"queries": [{"lat": 3.848, "lon": 11.502, "category": category} for category in
+                                ("district_hospital", "regional_hospital", "central_hospital", "medical_centre", None)],
+                    "speculative": True}
+        with ThreadPoolExecutor(5) as pool:
+            responses = [pool.submit(client.post, "/recommend-hospitals/batch", json=referral) for _ in range(5)]
+            deadline = time.time() + 5
+            while executor.stats()["pending"] < 5 and time.time() < deadline:
+                time.sleep(0.01)
+            assert executor.stats()["active"] == {"/recommend-hospitals/batch": 25}
+            release.set()
+            assert [response.result().status_code for response in responses] == [200] * 5
+        executor.shutdown()
+
+class InMemoryRedis:
+    """Stand-in for the redis.asyncio client calls the cache makes"""
+
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+        self.fail = False
+
+    def _trip(self):
+        if self.fail:
+            raise ConnectionError("redis down")
+        self.round_trips += 1
+
+    async def mget(self, keys):
+        self._trip()
+        return [self.data.get(key) for key in keys]
+
+    async def delete(self, key):
+        self._trip()
+        self.data.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        redis, commands = self, []
+
+        class Pipeline:
+            def setex(self, key, ttl, value):
+                commands.append((key, value))
+                return self
+
+            async def execute(self):
+                redis._trip()
+                redis.data.update(commands)
+
+        return Pipeline()
+
+class TestCacheManager:
+
+    def _cache(self, **kwargs):
+        from performance import CacheManager, PerformanceMonitor
+        return CacheManager(redis_client=InMemoryRedis(), monitor=PerformanceMonitor(), **kwargs)
+
+    def test_two_tier_batch_get_set(self):
+        """Batches cost one Redis round trip; Redis hits are promoted to the local tier"""
+        cache = self._cache()
+
+        async def scenario():
+            await cache.set_many({"a": 1, "b": [2, 3]})
+            assert cache.redis_client.round_trips == 1
+            cache._local.clear()
+            found = await cache.get_many(["a", "b", "c"])
+            assert found == {"a": 1, "b": [2, 3]}
+            assert cache.redis_client.round_trips == 2
+            assert await cache.get("a") == 1
+            assert cache.redis_client.round_trips == 2
+
+        asyncio.run(scenario())
+        assert cache.monitor.cache_hits == 3
+        assert cache.monitor.cache_misses == 1
+
+    def test_local_tier_expiry_and_eviction(self):
+        """Local entries expire after local_ttl and the LRU stays bounded"""
+        import time
+        cache = self._cache(local_size=2, local_ttl=10)
+        cache.redis_client = None
+
+        async def scenario():
+            for key in ("a", "b", "c"):
+                await cache.set(key, key)
+            assert list(cache._local) == ["b", "c"]
+            now = time.monotonic()
+            with patch("performance.time.monotonic", return_value=now + 11):
+                assert await cache.get("c") is None
+
+        asyncio.run(scenario())
+
+    def test_single_flight(self):
+        """Concurrent misses on one key run the computation once"""
+        cache = self._cache()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"value": 42}
+
+        async def scenario():
+            return await asyncio.gather(*(cache.get_or_compute("k", compute) for _ in range(20)))
+
+        results = asyncio.run(scenario())
+        assert len(calls) == 1
+        assert all(result == {"value": 42} for result in results)
+        assert json.loads(cache.redis_client.data["k"]) == {"value": 42}
+
+    def test_single_flight_propagates_errors(self):
+        """A failed computation is raised to every waiter and not cached"""
+        cache = self._cache()
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("boom")
+
+        async def scenario():
+            return await asyncio.gather(*(cache.get_or_compute("k", compute) for _ in range(3)), return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert "k" not in cache.redis_client.data
+        assert not cache._inflight
+
+    def _cancel_one_of_three(self, cancel_index):
+        cache = self._cache()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"value": 7}
+
+        async def scenario():
+            tasks = []
+            for _ in range(3):
+                tasks.append(asyncio.ensure_future(cache.get_or_compute("k", compute)))
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.01)
+            tasks[cancel_index].cancel()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        assert isinstance(results[cancel_index], asyncio.CancelledError)
+        assert [r for i, r in enumerate(results) if i != cancel_index] == [{"value": 7}] * 2
+        assert len(calls) == 1
+        assert json.loads(cache.redis_client.data["k"]) == {"value": 7}
+        assert not cache._inflight
+
+    def test_single_flight_survives_cancelled_waiter(self):
+        """A waiter disconnecting doesn't disturb the leader or the other waiters"""
+        self._cancel_one_of_three(1)
+
+    def test_single_flight_survives_cancelled_leader(self):
+        """The leader disconnecting doesn't abort the computation its waiters share"""
+        self._cancel_one_of_three(0)
+
+    def test_redis_outage_falls_back_to_local(self):
+        """Redis errors are logged and the local tier keeps serving"""
+        cache = self._cache()
+        cache.redis_client.fail = True
+
+        async def scenario():
+            await cache.set("a", 1)
+            assert not cache.redis_enabled
+            assert await cache.get("a") == 1
+
+        asyncio.run(scenario())
+
+    def test_cached_response_decorator(self):
+        """The decorator serves repeated calls from the cache"""
+        import performance
+        calls = []
+
+        @performance.cached_response("test", ttl=60)
+        async def handler(x):
+            calls.append(x)
+            return {"x": x}
+
+        async def scenario():
+            return [await handler(1), await handler(1), await handler(2)]
+
+        with patch.object(performance, "cache", self._cache()):
+            assert asyncio.run(scenario()) == [{"x": 1}, {"x": 1}, {"x": 2}]
+        assert calls == [1, 2]
+
 class TestErrorHandling:
     
     def test_missing_parameters(self):
@@ -0,0 +1,95 @@
+"""
+Precomputed facility-to-facility transfer graph for referral escalation.
+
+Escalating a referral ("nearest higher-level hospital from this health
+centre") used to be a full /recommend-hospitals search from the facility's
+coordinates. The answer only depends on the facility table, so it is
+computed once per dataset instead.
+
+For every facility and every care level in FACILITY_CATEGORIES, the graph
+keeps the k nearest facilities of that level (excluding the facility
+itself) with their exact distances, as dense arrays:
+
+    levels     (L,)        the care levels present, ascending
+    neighbors  (n, L, k)   row positions, -1 where a level has fewer than k
+    distances  (n, L, k)   km, NaN in the same padding slots
+
+Building it runs one batched k-nearest search per level. The arrays are
+stored as extras of the columnar data cache, so a warm start loads them
+without recomputation, and an escalation query is an array lookup plus a
+merge of at most L * k entries.
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from facility_index import FACILITY_CATEGORIES
+from spatial_index import FacilitySpatialIndex
+
+# Neighbours kept per facility and level
+TRANSFER_GRAPH_K = 5
+
+_ARRAY_NAMES = ("transfer_levels", "transfer_neighbors", "transfer_distances")
+
+
+def facility_levels(categories) -> np.ndarray:
+    """Care level of each facility from its category"""
+    return np.asarray([FACILITY_CATEGORIES.get(category, 0) for category in categories], dtype=np.int8)
+
+
+class TransferGraph:
+    """k nearest facilities of each care level, for every facility"""
+
+    def __init__(self, levels: np.ndarray, neighbors: np.ndarray, distances: np.ndarray):
+        self.levels = levels
+        self.neighbors = neighbors
+        self.distances = distances
+
+    @classmethod
+    def build(cls, latitudes, longitudes, facility_level: np.ndarray, k: int = TRANSFER_GRAPH_K) -> "TransferGraph":
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        levels = np.unique(facility_level[facility_level > 0])
+        neighbors = np.full((len(latitudes), len(levels), k), -1, dtype=np.int32)
+        distances = np.full((len(latitudes), len(levels), k), np.nan)
+
+        for slot, level in enumerate(levels):
+            members = np.flatnonzero(facility_level == level)
+            # One extra neighbour so a facility can be dropped from its own level
+            found, found_distances = FacilitySpatialIndex(latitudes[members], longitudes[members]).nearest_many(
+                latitudes, longitudes, k + 1
+            )
+            found = np.where(found >= 0, members[np.maximum(found, 0)], -1)
+            is_self = found == np.arange(len(latitudes))[:, None]
+            # Rows without themselves among the results drop their last (k+1-th) entry instead
+            drop = np.where(is_self.any(axis=1), is_self.argmax(axis=1), k)
+            keep = np.arange(k + 1)[None, :] != drop[:, None]
+            neighbors[:, slot] = found[keep].reshape(-1, k)
+            distances[:, slot] = found_distances[keep].reshape(-1, k)
+
+        return cls(levels, neighbors, distances)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return dict(zip(_ARRAY_NAMES, (self.levels, self.neighbors, self.distances)))
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Optional["TransferGraph"]:
+        """Graph stored by to_arrays(), or None if the arrays are missing"""
+        if not all(name in arrays for name in _ARRAY_NAMES):
+            return None
+        return cls(*(arrays[name] for name in _ARRAY_NAMES))
+
+    def escalation(self, position: int, min_level: int, top_n: int = TRANSFER_GRAPH_K) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Nearest facilities of level min_level or above from one facility.
+
+        Returns:
+            Tuple of (row positions, distances in km), nearest first, ties by position
+        """
+        slots = self.levels >= min_level
+        positions = self.neighbors[position, slots].ravel()
+        distances = self.distances[position, slots].ravel()
+        valid = positions >= 0
+        positions, distances = positions[valid].astype(np.intp), distances[valid]
+        order = np.lexsort((positions, distances))[:top_n]
+        return positions[order], distances[order]
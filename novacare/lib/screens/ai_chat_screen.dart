@@ -2,6 +2,7 @@ import 'package:flutter/material.dart';
 import 'package:flutter/services.dart';
 import 'package:http/http.dart' as http;
 import 'dart:convert';
+import 'dart:math';
 import '../services/supabase_service.dart';
 // import '../models/chat_conversation.dart';
 import 'chat_history_screen.dart';
@@ -34,6 +35,19 @@ class _AiChatScreenState extends State<AiChatScreen>
   final String apiUrl = '$_baseUrl/webhook';
   final String symptomsUrl = '$_baseUrl/symptoms';
 
+  // Server-side symptom session: the backend accumulates symptoms per
+  // session, so each turn only needs to send the new message.
+  String _sessionId = _newSessionId();
+
+  static final Random _secureRandom = Random.secure();
+
+  // The backend trusts whoever presents a session id, so it must not be
+  // guessable: 128 random bits, hex encoded.
+  static String _newSessionId() {
+    final bytes = List<int>.generate(16, (_) => _secureRandom.nextInt(256));
+    return 'novacare-${bytes.map((b) => b.toRadixString(16).padLeft(2, '0')).join()}';
+  }
+
   // Chat saving state
   String? _currentConversationId;
   bool _isChatSaved = false;
@@ -179,6 +193,7 @@ class _AiChatScreenState extends State<AiChatScreen>
               'Accept': 'application/json',
             },
             body: jsonEncode({
+              'session': _sessionId,
               'queryResult': {
                 'queryText': userMessage,
               }
@@ -355,6 +370,7 @@ class _AiChatScreenState extends State<AiChatScreen>
     setState(() {
       _messages.clear();
       _currentConversationId = null;
+      _sessionId = _newSessionId();
       _isChatSaved = false;
       isStartPhase = true;
       isSymptomPhase = false;
@@ -0,0 +1,7 @@
+"""
+Infrastructure shared by the Disease Prediction API (Dataset/) and the
+Hospital Referral API (hospital_referal/).
+
+Each service is started from its own directory, so its main.py puts the
+repository root on sys.path before importing from this package.
+"""
@@ -0,0 +1,423 @@
+"""
+Write-behind audit trail of predictions and referrals, shared by both
+NovaCare APIs.
+
+Until now the only record of what the models predicted and where patients
+were referred was log lines, which cannot be queried for clinical audit.
+AuditLog keeps one compact row per decision (symptom bitmask, top-k
+predictions, urgency, model or dataset version, patient coordinates, chosen
+facility ids and latency) in an embedded SQLite database.
+
+Writing to the database from a request handler would put disk I/O (and
+SQLite's file lock) on the request path, so records are write-behind:
+  - record() only appends a tuple to an in-memory ring buffer, under a lock
+    held for the append; serialization happens later, off the request path.
+  - A background thread wakes every flush interval (or as soon as a batch
+    has filled up), drains the buffer and inserts it with executemany(),
+    batch_size rows per transaction, through a SQLiteConnectionPool.
+
+Loss is bounded rather than unbounded memory growth: the ring buffer holds
+at most `capacity` records, and when the writer falls behind (or the
+database is unavailable) the oldest unwritten records are overwritten and
+counted in `dropped`, which is logged at the next flush and exposed by
+stats(). A batch that fails to insert is put back in front of the buffer,
+as far as there is room, and retried on the next flush.
+
+audit_log_from_env() configures it from AUDIT_DB_PATH (an empty value
+disables auditing), AUDIT_BUFFER_SIZE, AUDIT_BATCH_SIZE,
+AUDIT_FLUSH_SECONDS and AUDIT_POOL_SIZE.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_SECONDS = 1.0
+DEFAULT_POOL_SIZE = 2
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS audit_events (
+        id INTEGER PRIMARY KEY,
+        ts REAL NOT NULL,
+        service TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        symptom_mask TEXT,
+        top_k TEXT,
+        urgency TEXT,
+        model_version TEXT,
+        lat REAL,
+        lon REAL,
+        facilities TEXT,
+        latency_ms REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS audit_events_ts ON audit_events (ts)",
+    "CREATE INDEX IF NOT EXISTS audit_events_kind_ts ON audit_events (kind, ts)",
+)
+
+_INSERT = (
+    "INSERT INTO audit_events (ts, service, kind, symptom_mask, top_k, urgency, model_version,"
+    " lat, lon, facilities, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+class SQLiteConnectionPool:
+    """
+    Fixed-size pool of SQLite connections shareable across threads.
+
+    Connections are opened on demand up to `size`, in WAL mode so readers
+    are not blocked by the writer, and reused most recently returned first.
+    When all of them are in use, acquiring one waits up to `timeout`
+    seconds and then raises TimeoutError.
+    """
+
+    def __init__(self, path: str, size: int = DEFAULT_POOL_SIZE, timeout: float = 5.0):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode: transactions are opened explicitly by transaction()
+        connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free connection to {self.path} within {self.timeout}s")
+
+    def _release(self, connection: sqlite3.Connection, broken: bool = False):
+        if self._closed or broken:
+            connection.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put_nowait(connection)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """A pooled connection, returned to the pool on exit"""
+        connection = self._acquire()
+        broken = False
+        try:
+            yield connection
+        except sqlite3.DatabaseError:
+            # Don't hand a connection in an unknown state to the next caller
+            broken = True
+            raise
+        finally:
+            self._release(connection, broken)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """A pooled connection inside a write transaction, committed on success and rolled back on error"""
+        with self.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def close(self):
+        """Close idle connections now and the others as they are returned"""
+        self._closed = True
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self._lock:
+                self._created -= 1
+
+
+class AuditLog:
+    """Ring buffer of audit records with a background thread writing them to SQLite"""
+
+    def __init__(
+        self,
+        path: str,
+        service: str,
+        capacity: int = DEFAULT_CAPACITY,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_SECONDS,
+        pool_size: int = DEFAULT_POOL_SIZE,
+    ):
+        self.path = path
+        self.service = service
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool = SQLiteConnectionPool(path, pool_size)
+        self.written = 0
+        self.dropped = 0
+        self.flush_errors = 0
+        self.invalid = 0
+        self._buffer: deque = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._schema_ready = False
+        self._reported_drops = 0
+
+    def record(
+        self,
+        kind: str,
+        *,
+        symptom_mask: Optional[int] = None,
+        top_k: Optional[Sequence[Tuple[str, float]]] = None,
+        urgency: Optional[str] = None,
+        model_version: Optional[str] = None,
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+        facilities: Optional[Sequence[int]] = None,
+        latency_ms: Optional[float] = None,
+    ):
+        """
+        Queue one audit record. Never blocks on I/O.
+
+        Args:
+            kind: What was decided, e.g. "prediction" or "referral"
+            symptom_mask: Reported symptoms as a bitmask over the model's columns
+            top_k: (label, confidence) pairs, best first
+            urgency: Predicted urgency level
+            model_version: Version of the model or facility dataset used
+            lat, lon: Patient location
+            facilities: Ids of the facilities returned, nearest first
+            latency_ms: Server-side processing time
+        """
+        entry = (time.time(), kind, symptom_mask, top_k, urgency, model_version, lat, lon, facilities, latency_ms)
+        with self._lock:
+            if len(self._buffer) == self.capacity:
+                self.dropped += 1
+            self._buffer.append(entry)
+            batch_ready = len(self._buffer) >= self.batch_size
+        if batch_ready:
+            self._wake.set()
+
+    def _drain(self, limit: int) -> List[tuple]:
+        with self._lock:
+            return [self._buffer.popleft() for _ in range(min(limit, len(self._buffer)))]
+
+    def _requeue(self, batch: List[tuple]):
+        # Back in front, oldest first, as far as newer records left room
+        with self._lock:
+            room = self.capacity - len(self._buffer)
+            kept = batch[len(batch) - room:] if room < len(batch) else batch
+            self.dropped += len(batch) - len(kept)
+            self._buffer.extendleft(reversed(kept))
+
+    def _row(self, entry: tuple) -> tuple:
+        ts, kind, mask, top_k, urgency, version, lat, lon, facilities, latency_ms = entry
+        return (
+            ts, self.service, kind,
+            format(mask, "x") if mask is not None else None,
+            json.dumps([[label, float(score)] for label, score in top_k]) if top_k is not None else None,
+            urgency, version,
+            float(lat) if lat is not None else None,
+            float(lon) if lon is not None else None,
+            json.dumps([int(facility) for facility in facilities]) if facilities is not None else None,
+            round(float(latency_ms), 3) if latency_ms is not None else None,
+        )
+
+    def _ensure_schema(self):
+        if self._schema_ready:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.pool.transaction() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        self._schema_ready = True
+
+    def flush(self) -> int:
+        """
+        Write every buffered record, batch_size rows per transaction.
+
+        Returns:
+            Number of records written
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._drain(self.batch_size)
+                if not batch:
+                    break
+                valid, rows = [], []
+                for entry in batch:
+                    try:
+                        rows.append(self._row(entry))
+                        valid.append(entry)
+                    except (TypeError, ValueError) as e:
+                        # A malformed record must not hold up the rest of its batch
+                        self.invalid += 1
+                        logger.error("Unserializable %s audit record discarded: %s", entry[1], e)
+                try:
+                    self._ensure_schema()
+                    with self.pool.transaction() as connection:
+                        connection.executemany(_INSERT, rows)
+                except Exception as e:
+                    self.flush_errors += 1
+                    logger.error("Audit flush of %d records to %s failed: %s", len(rows), self.path, e)
+                    self._requeue(valid)
+                    break
+                written += len(rows)
+            self.written += written
+            if self.dropped > self._reported_drops:
+                logger.warning(
+                    "Audit buffer overflowed: %d records dropped (%d in total)",
+                    self.dropped - self._reported_drops, self.dropped
+                )
+                self._reported_drops = self.dropped
+        return written
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def start(self):
+        """Start the background writer"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"audit-writer-{self.service}", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: float = 5.0):
+        """Stop the writer after a last flush and close the pool"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            self.flush()
+        self.pool.close()
+
+    def query(self, kind: Optional[str] = None, since: Optional[float] = None, limit: int = 100) -> List[Dict]:
+        """
+        Most recent written records, newest first.
+
+        Args:
+            kind: Only records of this kind
+            since: Only records at or after this Unix time
+            limit: Maximum number of records
+
+        Returns:
+            Records as dictionaries, with top_k and facilities decoded
+        """
+        self._ensure_schema()
+        clauses, params = [], []
+        if kind is not None:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self.pool.connection() as connection:
+            cursor = connection.execute(
+                f"SELECT * FROM audit_events{where} ORDER BY id DESC LIMIT ?", (*params, limit)
+            )
+            names = [column[0] for column in cursor.description]
+            rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+        for row in rows:
+            for field in ("top_k", "facilities"):
+                if row[field] is not None:
+                    row[field] = json.loads(row[field])
+        return rows
+
+    def stats(self) -> Dict:
+        with self._lock:
+            buffered = len(self._buffer)
+        return {
+            "buffered": buffered,
+            "capacity": self.capacity,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flush_errors": self.flush_errors,
+            "invalid": self.invalid,
+        }
+
+
+class NullAuditLog:
+    """Stand-in when auditing is disabled; records are discarded"""
+
+    def record(self, kind: str, **fields):
+        pass
+
+    def start(self):
+        pass
+
+    def close(self, timeout: float = 5.0):
+        pass
+
+    def flush(self) -> int:
+        return 0
+
+    def query(self, kind: Optional[str] = None, since: Optional[float] = None, limit: int = 100) -> List[Dict]:
+        return []
+
+    def stats(self) -> Dict:
+        return {"buffered": 0, "capacity": 0, "written": 0, "dropped": 0, "flush_errors": 0, "invalid": 0}
+
+
+def audit_log_from_env(service: str, default_path: str = "logs/audit.db"):
+    """AuditLog configured from AUDIT_* (a NullAuditLog when AUDIT_DB_PATH is empty)"""
+    path = os.getenv("AUDIT_DB_PATH", default_path)
+    if not path:
+        return NullAuditLog()
+    return AuditLog(
+        path,
+        service,
+        capacity=int(os.getenv("AUDIT_BUFFER_SIZE", str(DEFAULT_CAPACITY))),
+        batch_size=int(os.getenv("AUDIT_BATCH_SIZE", str(DEFAULT_BATCH_SIZE))),
+        flush_interval=float(os.getenv("AUDIT_FLUSH_SECONDS", str(DEFAULT_FLUSH_SECONDS))),
+        pool_size=int(os.getenv("AUDIT_POOL_SIZE", str(DEFAULT_POOL_SIZE))),
+    )
@@ -0,0 +1,228 @@
+"""
+Admission control and thread-pool offload for CPU-bound request handlers,
+shared by both NovaCare APIs.
+
+Model inference and pandas facility searches used to run directly inside
+`async def` handlers, on the event loop. A burst of them queued up without
+limit behind each other, and everything else on the loop, health checks
+included, waited until the burst had been worked through.
+
+CPUExecutor runs such work on a sized thread pool instead, behind
+admission control:
+  - At most `workers` calls run and `queue_size` more wait; a call that
+    would exceed that is rejected at once with Overloaded, a 503 carrying a
+    Retry-After estimated from the backlog and the measured service time,
+    rather than queueing until the client has given up.
+  - Each endpoint may hold at most its own limit of those slots (by
+    default three quarters of them), so a burst on one endpoint cannot
+    starve the others. run_weighted() charges a call more than one unit of
+    its endpoint's limit, e.g. a batch by its number of queries, so the
+    limit bounds the work admitted rather than the number of calls: a
+    five-query batch doesn't take the place of a thousand-query one.
+  - Calls run in a copy of the caller's contextvars context, so the
+    request-scoped log fields of shared/structured_logging.py still apply
+    to records logged from a worker.
+
+Threads rather than processes: the models and facility frames are large
+and shared read-only, and the sklearn, numpy and pandas routines doing the
+work release the GIL for most of it. A slot is only freed when the call
+actually finishes, so a client disconnecting does not let more work in
+than the pool can run.
+
+HealthCheckMiddleware answers /health before routing and every other
+middleware, so liveness probes stay fast while the executor is saturated.
+
+executor_from_env() reads EXECUTOR_WORKERS (default: CPU count),
+EXECUTOR_QUEUE_SIZE (default 16 per worker) and EXECUTOR_ENDPOINT_LIMITS
+("path=n,path=n", overriding the limits the service sets).
+"""
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+from shared.responses import dumps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_PER_WORKER = 16
+HEALTH_PATH = "/health"
+# Weight of the latest call in the moving average of service time
+SERVICE_TIME_SMOOTHING = 0.1
+
+
+class Overloaded(HTTPException):
+    """503 raised when the executor, or an endpoint's share of it, is full"""
+
+    def __init__(self, endpoint: str, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"Server busy, retry in {retry_after}s",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def parse_endpoint_limits(spec: Optional[str]) -> Dict[str, int]:
+    """Parse "path=limit,path=limit" into a dict, ignoring malformed entries"""
+    limits = {}
+    for item in (spec or "").split(","):
+        path, _, limit = item.strip().partition("=")
+        try:
+            limits[path.strip()] = max(int(limit), 1)
+        except ValueError:
+            continue
+    return limits
+
+
+class CPUExecutor:
+    """Thread pool with a bounded queue and per-endpoint concurrency limits"""
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        queue_size: Optional[int] = None,
+        endpoint_limits: Optional[Dict[str, int]] = None,
+        default_endpoint_limit: Optional[int] = None,
+    ):
+        self.workers = workers or os.cpu_count() or 4
+        self.queue_size = queue_size if queue_size is not None else self.workers * DEFAULT_QUEUE_PER_WORKER
+        self.capacity = self.workers + self.queue_size
+        self.default_endpoint_limit = default_endpoint_limit or max(1, self.capacity * 3 // 4)
+        self.endpoint_limits = dict(endpoint_limits or {})
+        self.pending = 0
+        self.service_time = 0.0
+        self._active: Dict[str, int] = {}
+        self._rejected: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu-worker")
+
+    def limit_for(self, endpoint: str) -> int:
+        """Units of work the endpoint may hold, running plus waiting"""
+        return self.endpoint_limits.get(endpoint, self.default_endpoint_limit)
+
+    def _admit(self, endpoint: str, weight: int = 1) -> bool:
+        with self._lock:
+            active = self._active.get(endpoint, 0)
+            if self.pending >= self.capacity or active + weight > self.limit_for(endpoint):
+                self._rejected[endpoint] = self._rejected.get(endpoint, 0) + 1
+                return False
+            self.pending += 1
+            self._active[endpoint] = active + weight
+            return True
+
+    def _release(self, endpoint: str, weight: int = 1):
+        with self._lock:
+            self.pending -= 1
+            self._active[endpoint] -= weight
+
+    def _call(self, context: contextvars.Context, fn: Callable, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return context.run(fn, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.service_time += SERVICE_TIME_SMOOTHING * (elapsed - self.service_time)
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog should have drained, at least 1"""
+        with self._lock:
+            backlog = self.pending * self.service_time / self.workers
+        return max(1, math.ceil(backlog))
+
+    async def run(self, endpoint: str, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Run fn(*args, **kwargs) on the pool and await its result.
+
+        Args:
+            endpoint: Name the concurrency limit is kept under, usually the route path
+            fn: Function to call in a worker thread
+
+        Raises:
+            Overloaded: The pool's queue or the endpoint's limit is full
+        """
+        return await self.run_weighted(endpoint, 1, fn, *args, **kwargs)
+
+    async def run_weighted(self, endpoint: str, weight: int, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Like run(), charging the call `weight` units of the endpoint's limit.
+
+        A call heavier than the whole limit is charged the limit, so it can
+        still run when the endpoint is otherwise idle.
+
+        Raises:
+            Overloaded: The pool's queue is full or the endpoint lacks `weight` free units
+        """
+        weight = min(max(int(weight), 1), self.limit_for(endpoint))
+        if not self._admit(endpoint, weight):
+            retry_after = self.retry_after()
+            logger.warning("Shedding %s: executor busy, retry after %ss", endpoint, retry_after)
+            raise Overloaded(endpoint, retry_after)
+        try:
+            future = self._pool.submit(self._call, contextvars.copy_context(), fn, args, kwargs)
+        except BaseException:
+            self._release(endpoint, weight)
+            raise
+        # Freed when the call finishes, even if the awaiting request is cancelled first
+        future.add_done_callback(lambda _: self._release(endpoint, weight))
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "pending": self.pending,
+                "service_time_ms": round(self.service_time * 1000, 3),
+                "active": {endpoint: n for endpoint, n in self._active.items() if n},
+                "rejected": dict(self._rejected),
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+def executor_from_env(endpoint_limits: Optional[Dict[str, int]] = None) -> CPUExecutor:
+    """Executor configured from EXECUTOR_* on top of the service's own endpoint limits"""
+    workers = int(os.getenv("EXECUTOR_WORKERS", "0")) or None
+    queue_size = os.getenv("EXECUTOR_QUEUE_SIZE")
+    return CPUExecutor(
+        workers=workers,
+        queue_size=int(queue_size) if queue_size else None,
+        endpoint_limits={**(endpoint_limits or {}), **parse_endpoint_limits(os.getenv("EXECUTOR_ENDPOINT_LIMITS"))},
+    )
+
+
+class HealthCheckMiddleware:
+    """ASGI middleware answering GET/HEAD /health itself, ahead of routing and other middleware"""
+
+    def __init__(self, app, status: Callable[[], Dict], path: str = HEALTH_PATH):
+        self.app = app
+        self.status = status
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        body = dumps(self.status())
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"cache-control", b"no-store"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body if scope["method"] == "GET" else b""})
@@ -0,0 +1,341 @@
+"""
+Per-client rate limiting shared by both NovaCare APIs.
+
+The old limiter kept a list of every request timestamp per client and
+rebuilt it on each check, so a check cost O(requests in the window) and
+the table grew with every client IP ever seen. This one uses a sliding
+window counter: per client only the request counts of the current and the
+previous fixed window are kept, and the rate is estimated as
+
+    previous * (share of the previous window still inside the sliding window) + current
+
+which makes each check O(1) with a small, constant amount of state.
+
+Counts live in a pluggable store:
+  - MemoryRateLimitStore keeps them in-process, in an LRU table that
+    evicts clients idle for two windows (and the least recently seen
+    clients beyond max_clients).
+  - RedisRateLimitStore keeps them in Redis (one pipelined GET, INCR and
+    EXPIRE per check, through any redis.asyncio-compatible client), so the limit holds
+    across worker processes; keys expire on their own. When Redis is
+    unreachable it falls back to an in-process store for
+    REDIS_RETRY_SECONDS.
+
+RateLimitMiddleware applies a limiter to every HTTP request except the
+exempt paths, answering 429 with Retry-After when a client is over its
+limit. Clients are keyed by the connection's peer address. X-Forwarded-For
+is only honoured when the peer is one of TRUSTED_PROXIES (IPs or CIDR
+ranges): the client controls every hop it sends itself, so the key is the
+rightmost hop not added by a trusted proxy.
+
+Service-to-service calls (the Disease API's referral lookups) would
+otherwise put every end user behind one bucket, the calling service's.
+A caller holding INTERNAL_API_TOKEN sends it in X-Internal-Token together
+with the end client's address in X-Client-Address, and is then counted
+against that client's bucket instead. rate_limiter_from_env() builds the limiter from RATE_LIMIT_REQUESTS,
+RATE_LIMIT_WINDOW_SECONDS and RATE_LIMIT_REDIS_URL (falling back to
+REDIS_URL); RATE_LIMIT_REQUESTS=0 turns limiting off.
+"""
+import hmac
+import ipaddress
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis is optional; limits are then per process
+    aioredis = None
+
+from shared.responses import dumps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 600
+DEFAULT_WINDOW_SECONDS = 60.0
+DEFAULT_MAX_CLIENTS = 100000
+REDIS_RETRY_SECONDS = 30
+EXEMPT_PATHS = ("/health", "/metrics")
+INTERNAL_TOKEN_HEADER = "X-Internal-Token"
+CLIENT_ADDRESS_HEADER = "X-Client-Address"
+
+
+class RateLimitDecision(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: int
+
+
+class MemoryRateLimitStore:
+    """In-process window counts with idle-client eviction"""
+
+    def __init__(self, max_clients: int = DEFAULT_MAX_CLIENTS):
+        self.max_clients = max_clients
+        # client -> [last window seen, its count, the window before's count]
+        self._counts: "OrderedDict[str, list]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def _evict(self, window: int):
+        # Least recently seen first, so stop at the first client still active
+        while self._counts:
+            oldest = next(iter(self._counts.values()))
+            if len(self._counts) <= self.max_clients and oldest[0] >= window - 1:
+                break
+            self._counts.popitem(last=False)
+
+    async def increment(self, key: str, window: int, window_seconds: float) -> Tuple[int, int]:
+        """Count one request in `window`; returns (previous window count, current count)"""
+        entry = self._counts.pop(key, None)
+        if entry is None or entry[0] < window - 1:
+            entry = [window, 0, 0]
+        elif entry[0] == window - 1:
+            entry = [window, 0, entry[1]]
+        entry[1] += 1
+        self._counts[key] = entry
+        self._evict(window)
+        return entry[2], entry[1]
+
+    async def decrement(self, key: str, window: int):
+        """Take back a request counted by increment() (a rejected one)"""
+        entry = self._counts.get(key)
+        if entry is not None and entry[0] == window and entry[1] > 0:
+            entry[1] -= 1
+
+
+class RedisRateLimitStore:
+    """Window counts in Redis, shared by every worker, with a local fallback"""
+
+    def __init__(self, redis_client=None, redis_url: Optional[str] = None, prefix: str = "ratelimit"):
+        if redis_client is None:
+            if aioredis is None:
+                raise RuntimeError("redis is not installed")
+            redis_client = aioredis.from_url(redis_url, decode_responses=True)
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.fallback = MemoryRateLimitStore()
+        self._redis_down_until = 0.0
+
+    def _key(self, key: str, window: int) -> str:
+        return f"{self.prefix}:{key}:{window}"
+
+    def _redis_available(self) -> bool:
+        return time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self, error: Exception):
+        logger.error("Rate limit store error, using per-process limits for %ds: %s", REDIS_RETRY_SECONDS, error)
+        self._redis_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+
+    async def increment(self, key: str, window: int, window_seconds: float) -> Tuple[int, int]:
+        if not self._redis_available():
+            return await self.fallback.increment(key, window, window_seconds)
+        current_key = self._key(key, window)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(self._key(key, window - 1))
+            pipe.incr(current_key)
+            # Two windows: the count is still needed as "previous" in the next one
+            pipe.expire(current_key, int(math.ceil(2 * window_seconds)))
+            previous, current, _ = await pipe.execute()
+            return int(previous or 0), int(current)
+        except Exception as e:
+            self._redis_failed(e)
+            return await self.fallback.increment(key, window, window_seconds)
+
+    async def decrement(self, key: str, window: int):
+        if not self._redis_available():
+            await self.fallback.decrement(key, window)
+            return
+        try:
+            await self.redis_client.decr(self._key(key, window))
+        except Exception as e:
+            self._redis_failed(e)
+
+
+class RateLimiter:
+    """Sliding-window-counter limiter: at most `limit` requests per `window_seconds` per client"""
+
+    def __init__(
+        self,
+        limit: int = DEFAULT_LIMIT,
+        window_seconds: float = DEFAULT_WINDOW_SECONDS,
+        store=None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.store = store if store is not None else MemoryRateLimitStore()
+        self.clock = clock
+
+    async def check(self, client_id: str) -> RateLimitDecision:
+        """Count a request from client_id and decide whether it may proceed"""
+        now = self.clock()
+        window, offset = divmod(now, self.window_seconds)
+        window = int(window)
+        previous, current = await self.store.increment(client_id, window, self.window_seconds)
+
+        previous_weight = 1.0 - offset / self.window_seconds
+        estimate = previous * previous_weight + current
+        if estimate <= self.limit:
+            return RateLimitDecision(True, self.limit, int(self.limit - estimate), 0)
+
+        # Rejected requests don't count against the client
+        await self.store.decrement(client_id, window)
+        if current > self.limit or previous == 0:
+            retry_after = self.window_seconds - offset
+        else:
+            # Wait until enough of the previous window has slid out
+            excess = estimate - self.limit
+            retry_after = min(excess / previous * self.window_seconds, self.window_seconds - offset)
+        return RateLimitDecision(False, self.limit, 0, max(1, int(math.ceil(retry_after))))
+
+
+def rate_limiter_from_env() -> RateLimiter:
+    """Limiter configured from RATE_LIMIT_* (and Redis, when a URL is set)"""
+    redis_url = os.getenv("RATE_LIMIT_REDIS_URL") or os.getenv("REDIS_URL")
+    store = None
+    if redis_url:
+        if aioredis is not None:
+            store = RedisRateLimitStore(redis_url=redis_url)
+        else:
+            logger.warning("A Redis URL is set but redis is not installed; rate limits are per process")
+    return RateLimiter(
+        limit=int(os.getenv("RATE_LIMIT_REQUESTS", str(DEFAULT_LIMIT))),
+        window_seconds=float(os.getenv("RATE_LIMIT_WINDOW_SECONDS", str(DEFAULT_WINDOW_SECONDS))),
+        store=store,
+    )
+
+
+def parse_trusted_proxies(spec: Optional[str]) -> Tuple:
+    """Parse "ip,cidr,..." into networks, ignoring (and logging) malformed entries"""
+    networks = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.warning("Ignoring malformed TRUSTED_PROXIES entry %r", item)
+    return tuple(networks)
+
+
+TRUSTED_PROXIES = parse_trusted_proxies(os.getenv("TRUSTED_PROXIES"))
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN") or None
+
+
+def _is_trusted(address: str, trusted_proxies: Sequence) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_proxies)
+
+
+def _header(scope, name: str) -> Optional[str]:
+    name = name.lower().encode("latin-1")
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1").strip()
+    return None
+
+
+def internal_client_headers(client: Optional[str], token: Optional[str] = None) -> dict:
+    """Headers for a service-to-service call counted against `client`; empty without a token"""
+    token = INTERNAL_API_TOKEN if token is None else token
+    if not token or not client:
+        return {}
+    return {INTERNAL_TOKEN_HEADER: token, CLIENT_ADDRESS_HEADER: client}
+
+
+def client_address(
+    scope, trusted_proxies: Optional[Sequence] = None, internal_token: Optional[str] = None
+) -> str:
+    """
+    Client IP of a request: the peer, or behind trusted proxies the
+    rightmost X-Forwarded-For hop they did not add themselves. An internal
+    call carrying the internal token is counted against the end client it
+    names in X-Client-Address.
+
+    Args:
+        scope: ASGI connection scope
+        trusted_proxies: Networks whose forwarding headers are believed (default TRUSTED_PROXIES)
+        internal_token: Shared secret of internal callers (default INTERNAL_API_TOKEN)
+    """
+    trusted_proxies = TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+    internal_token = INTERNAL_API_TOKEN if internal_token is None else internal_token
+    if internal_token:
+        token, forwarded_client = _header(scope, INTERNAL_TOKEN_HEADER), _header(scope, CLIENT_ADDRESS_HEADER)
+        if token and forwarded_client and hmac.compare_digest(token.encode("latin-1"), internal_token.encode("latin-1")):
+            return forwarded_client
+
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    if not _is_trusted(peer, trusted_proxies):
+        return peer
+
+    hops = [
+        hop.strip()
+        for name, value in scope.get("headers", [])
+        if name == b"x-forwarded-for"
+        for hop in value.decode("latin-1").split(",")
+        if hop.strip()
+    ]
+    for hop in reversed(hops):
+        if not _is_trusted(hop, trusted_proxies):
+            return hop
+    # Every hop is a trusted proxy: the request started inside the deployment
+    return hops[0] if hops else peer
+
+
+class RateLimitMiddleware:
+    """ASGI middleware rejecting requests over the client's limit with 429"""
+
+    def __init__(
+        self,
+        app,
+        limiter: Optional[RateLimiter] = None,
+        exempt_paths: Iterable[str] = EXEMPT_PATHS,
+        key_func: Callable = client_address,
+    ):
+        self.app = app
+        self.limiter = limiter if limiter is not None else rate_limiter_from_env()
+        self.exempt_paths = frozenset(exempt_paths)
+        self.key_func = key_func
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in self.exempt_paths or self.limiter.limit <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        decision = await self.limiter.check(self.key_func(scope))
+        limit_headers = [
+            (b"x-ratelimit-limit", str(decision.limit).encode()),
+            (b"x-ratelimit-remaining", str(decision.remaining).encode()),
+        ]
+
+        if not decision.allowed:
+            body = dumps({"error": "Rate limit exceeded", "retry_after": decision.retry_after})
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": limit_headers + [
+                    (b"retry-after", str(decision.retry_after).encode()),
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + limit_headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
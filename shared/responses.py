@@ -0,0 +1,181 @@
+"""
+Response layer shared by both NovaCare APIs: fast JSON, compression and ETags.
+
+- FastJSONResponse serializes with orjson when it is installed (falling back
+  to the standard library encoder) and can be set as an app's
+  default_response_class or returned directly from a handler, which also
+  skips FastAPI's response_model re-validation on hot paths.
+- CompressionMiddleware compresses complete response bodies above a size
+  threshold with brotli (when installed and accepted) or gzip. Streaming
+  responses and responses that already carry a Content-Encoding pass
+  through untouched.
+- StaticJSONResource serializes a payload that rarely changes (the symptom
+  vocabulary, the facility type list) once, precomputes its ETag, caches
+  compressed variants, and answers If-None-Match revalidations with a
+  bodyless 304. Each content coding is its own representation with its own
+  strong ETag (``"<hash>-gzip"``), so a validator is never reused across
+  encodings.
+"""
+import gzip
+import hashlib
+import json
+from typing import Any, Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - exercised only without orjson
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - exercised only without brotli
+    brotli = None
+
+# Bodies smaller than this are not worth the compression CPU or headers
+MINIMUM_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(content: Any) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes, via orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with the fastest available encoder"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def negotiate_encoding(accept_encoding: str, size: int, minimum_size: int = MINIMUM_COMPRESS_SIZE) -> Optional[str]:
+    """Pick "br", "gzip" or None for a body of the given size"""
+    if size < minimum_size or not accept_encoding:
+        return None
+    accepted = {token.split(";")[0].strip().lower() for token in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing complete response bodies above a size threshold"""
+
+    def __init__(self, app, minimum_size: int = MINIMUM_COMPRESS_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            headers = [(k, v) for k, v in start["headers"]]
+            already_encoded = any(k.lower() == b"content-encoding" for k, _ in headers)
+            encoding = None
+            if not message.get("more_body", False) and not already_encoded:
+                encoding = negotiate_encoding(accept_encoding, len(body), self.minimum_size)
+
+            if encoding is not None:
+                body = compress(body, encoding)
+                headers = [
+                    (k, _encoded_etag(v.decode("latin-1"), encoding).encode("latin-1") if k.lower() == b"etag" else v)
+                    for k, v in headers
+                    if k.lower() != b"content-length"
+                ]
+                headers += [
+                    (b"content-encoding", encoding.encode()),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"vary", b"Accept-Encoding"),
+                ]
+                message = {**message, "body": body}
+
+            await send({**start, "headers": headers})
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _encoded_etag(etag: str, encoding: Optional[str]) -> str:
+    """Return the entity tag of ``etag``'s representation under ``encoding``.
+
+    RFC 9110 requires a distinct strong validator for every representation, so
+    a gzip or br body tags the identity ETag with its coding (``"<hash>-gzip"``).
+    Otherwise a cache revalidating with one coding could be told to reuse bytes
+    stored under another.
+    """
+    if encoding is None or not etag.endswith('"'):
+        return etag
+    return etag[:-1] + "-" + encoding + '"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class StaticJSONResource:
+    """A JSON payload serialized once, served with an ETag and conditional 304s"""
+
+    def __init__(self, payload: Any, max_age: int = 0):
+        self.payload = payload
+        self.body = dumps(payload)
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=16).hexdigest() + '"'
+        self.cache_control = f"public, max-age={max_age}, must-revalidate"
+        self._encoded: Dict[str, bytes] = {}
+
+    def etag_for(self, encoding: Optional[str]) -> str:
+        """ETag of the representation served with ``encoding`` (None for identity)"""
+        return _encoded_etag(self.etag, encoding)
+
+    def response(self, request: Request) -> Response:
+        body = self.body
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), len(body))
+        etag = self.etag_for(encoding)
+        headers = {"ETag": etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+        if encoding is not None:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = compress(body, encoding)
+            body = self._encoded[encoding]
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="application/json", headers=headers)
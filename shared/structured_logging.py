@@ -0,0 +1,173 @@
+"""
+Non-blocking, sampled, structured logging shared by both NovaCare APIs.
+
+Both services used to log through logging.basicConfig() with a FileHandler,
+so every log call on the request path formatted its message (usually an
+f-string, built even when the record was going to be discarded) and then
+wrote to disk synchronously on the event loop.
+
+configure_logging() replaces that with:
+  - A QueueHandler as the only handler on the root logger. The request path
+    just appends the record to an in-memory queue; a QueueListener thread
+    owns the file and console handlers and does all formatting and I/O.
+  - Lazy formatting: LazyQueueHandler enqueues the record with its msg/args
+    untouched, so "%s"-style messages are only rendered by the listener
+    thread, and only for records that survive sampling.
+  - JSON records (one object per line) with the service name, the request
+    path the record was emitted under and any `extra=` fields.
+  - Per-endpoint sampling. RequestLogContextMiddleware decides once per
+    request whether that request is sampled, based on LOG_SAMPLE_RATES
+    (e.g. "/predict=0.1,/recommend-hospitals=0.05") and LOG_SAMPLE_DEFAULT.
+    Unsampled requests drop their DEBUG/INFO records before they are even
+    queued; WARNING and above are always kept.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# Path of the request currently being served and whether it is sampled
+_request_path = contextvars.ContextVar("request_path", default=None)
+_request_sampled = contextvars.ContextVar("request_sampled", default=True)
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "service"}
+
+
+def parse_sample_rates(spec: Optional[str]) -> Dict[str, float]:
+    """Parse "path=rate,path=rate" into a dict, ignoring malformed entries"""
+    rates = {}
+    for item in (spec or "").split(","):
+        path, _, rate = item.strip().partition("=")
+        try:
+            rates[path.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+class JSONFormatter(logging.Formatter):
+    """Render records as single-line JSON objects"""
+
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Drop low-severity records of unsampled requests and tag the rest with their path"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and not _request_sampled.get():
+            return False
+        path = _request_path.get()
+        if path is not None:
+            record.path = path
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # Tracebacks pin frames; render them now and drop the live objects
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RequestLogContextMiddleware:
+    """ASGI middleware that makes the sampling decision once per request"""
+
+    def __init__(self, app, sample_rates: Optional[Dict[str, float]] = None, default_rate: Optional[float] = None):
+        self.app = app
+        self.sample_rates = (
+            sample_rates if sample_rates is not None else parse_sample_rates(os.getenv("LOG_SAMPLE_RATES"))
+        )
+        self.default_rate = (
+            default_rate if default_rate is not None else float(os.getenv("LOG_SAMPLE_DEFAULT", "1.0"))
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope.get("path", "")
+        rate = self.sample_rates.get(path, self.default_rate)
+        path_token = _request_path.set(path)
+        sampled_token = _request_sampled.set(rate >= 1.0 or random.random() < rate)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_sampled.reset(sampled_token)
+            _request_path.reset(path_token)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(service: str, log_file: str, level: Optional[str] = None) -> logging.handlers.QueueListener:
+    """
+    Route all logging through a background queue listener writing JSON lines.
+
+    Args:
+        service: Service name stamped on every record
+        log_file: File the listener appends JSON records to
+        level: Root log level (defaults to $LOG_LEVEL, then INFO)
+
+    Returns:
+        The running QueueListener (stopped automatically at exit)
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    log_dir = os.path.dirname(log_file)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    formatter = JSONFormatter(service)
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
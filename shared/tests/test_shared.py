@@ -0,0 +1,509 @@
+"""
+Tests for the infrastructure shared by both APIs.
+
+Run from the repository root with:
+    python -m pytest shared
+"""
+import asyncio
+import contextvars
+import gzip
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from shared import responses
+from shared.audit import AuditLog, SQLiteConnectionPool
+from shared.execution import CPUExecutor, HealthCheckMiddleware, Overloaded, parse_endpoint_limits
+from shared.rate_limit import (
+    MemoryRateLimitStore, RateLimiter, RateLimitMiddleware, RedisRateLimitStore, client_address, internal_client_headers,
+    parse_trusted_proxies
+)
+from shared.responses import CompressionMiddleware, FastJSONResponse, StaticJSONResource, negotiate_encoding
+from shared.structured_logging import (
+    JSONFormatter, LazyQueueHandler, RequestLogContextMiddleware, SamplingFilter, parse_sample_rates
+)
+
+
+class _Lazy:
+    """Object whose str() records that it was rendered"""
+
+    def __init__(self):
+        self.rendered = False
+
+    def __str__(self):
+        self.rendered = True
+        return "lazy"
+
+
+def _record(level=logging.INFO, msg="value=%s", args=("x",), **extra):
+    record = logging.LogRecord("test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def _run_in_request(middleware, path, fn):
+    """Run fn inside the middleware's request context and return its result"""
+    results = []
+
+    async def app(scope, receive, send):
+        results.append(fn())
+
+    asyncio.run(RequestLogContextMiddleware(app, **middleware)({"type": "http", "path": path}, None, None))
+    return results[0]
+
+
+class TestStructuredLogging:
+
+    def test_json_formatter_includes_extra_fields(self):
+        line = JSONFormatter("svc").format(_record(endpoint="/predict", items=3))
+        entry = json.loads(line)
+        assert entry["service"] == "svc"
+        assert entry["message"] == "value=x"
+        assert entry["endpoint"] == "/predict"
+        assert entry["items"] == 3
+
+    def test_queue_handler_defers_formatting(self):
+        log_queue = queue.SimpleQueue()
+        handler = LazyQueueHandler(log_queue)
+        lazy = _Lazy()
+        handler.handle(_record(args=(lazy,)))
+        queued = log_queue.get_nowait()
+        assert not lazy.rendered
+        assert queued.getMessage() == "value=lazy"
+
+    def test_unsampled_request_drops_info_but_keeps_warnings(self):
+        sampling = SamplingFilter()
+        config = {"sample_rates": {"/predict": 0.0}, "default_rate": 1.0}
+        assert not _run_in_request(config, "/predict", lambda: sampling.filter(_record()))
+        assert _run_in_request(config, "/predict", lambda: sampling.filter(_record(level=logging.WARNING)))
+        assert _run_in_request(config, "/symptoms", lambda: sampling.filter(_record()))
+
+    def test_records_are_tagged_with_request_path(self):
+        sampling = SamplingFilter()
+        record = _record()
+        _run_in_request({"sample_rates": {}, "default_rate": 1.0}, "/recommend-hospitals", lambda: sampling.filter(record))
+        assert record.path == "/recommend-hospitals"
+
+    def test_parse_sample_rates(self):
+        rates = parse_sample_rates("/predict=0.1, /recommend-hospitals=2,broken,/x=abc")
+        assert rates == {"/predict": 0.1, "/recommend-hospitals": 1.0}
+
+
+def _response_app():
+    resource = StaticJSONResource([f"item-{i}" for i in range(500)])
+
+    async def big(request):
+        return FastJSONResponse({"values": list(range(1000))})
+
+    async def small(request):
+        return FastJSONResponse({"ok": True})
+
+    async def static(request):
+        return resource.response(request)
+
+    app = Starlette(routes=[Route("/big", big), Route("/small", small), Route("/static", static)])
+    app.add_middleware(CompressionMiddleware)
+    return TestClient(app), resource
+
+
+class TestResponses:
+
+    def test_gzip_above_threshold_only(self):
+        client, _ = _response_app()
+        big = client.get("/big", headers={"Accept-Encoding": "gzip"})
+        assert big.headers["content-encoding"] == "gzip"
+        assert big.json()["values"][-1] == 999
+        small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in small.headers
+
+    def test_identity_when_not_accepted(self):
+        client, _ = _response_app()
+        response = client.get("/big", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in response.headers
+
+    def test_brotli_preferred_when_available(self):
+        if responses.brotli is None:
+            pytest.skip("brotli not installed")
+        assert negotiate_encoding("gzip, br", 10_000) == "br"
+        client, _ = _response_app()
+        response = client.get("/big", headers={"Accept-Encoding": "gzip, br"})
+        assert response.headers["content-encoding"] == "br"
+
+    def test_static_resource_etag_and_304(self):
+        client, resource = _response_app()
+        first = client.get("/static", headers={"Accept-Encoding": "identity"})
+        assert first.headers["etag"] == resource.etag
+        assert "content-encoding" not in first.headers
+        assert first.json()[0] == "item-0"
+
+        for header in (resource.etag, "W/" + resource.etag, '"other", ' + resource.etag, "*"):
+            revalidated = client.get("/static", headers={"Accept-Encoding": "identity", "If-None-Match": header})
+            assert revalidated.status_code == 304
+            assert revalidated.content == b""
+
+        changed = client.get("/static", headers={"If-None-Match": '"stale"'})
+        assert changed.status_code == 200
+
+    def test_static_resource_etag_differs_per_encoding(self):
+        client, resource = _response_app()
+        gzipped = client.get("/static", headers={"Accept-Encoding": "gzip"})
+        assert gzipped.headers["content-encoding"] == "gzip"
+        assert gzipped.headers["etag"] == resource.etag_for("gzip") == resource.etag[:-1] + '-gzip"'
+        assert gzipped.headers["etag"] != resource.etag
+
+        revalidated = client.get("/static", headers={"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["etag"]})
+        assert revalidated.status_code == 304
+        assert revalidated.headers["etag"] == gzipped.headers["etag"]
+
+        identity = client.get("/static", headers={"Accept-Encoding": "identity", "If-None-Match": gzipped.headers["etag"]})
+        assert identity.status_code == 200
+        assert identity.headers["etag"] == resource.etag
+        assert "content-encoding" not in identity.headers
+
+    def test_compression_middleware_tags_etag_with_encoding(self):
+        async def tagged(request):
+            return FastJSONResponse({"values": list(range(1000))}, headers={"ETag": '"abc"'})
+
+        app = Starlette(routes=[Route("/tagged", tagged)])
+        app.add_middleware(CompressionMiddleware)
+        client = TestClient(app)
+        assert client.get("/tagged", headers={"Accept-Encoding": "gzip"}).headers["etag"] == '"abc-gzip"'
+        assert client.get("/tagged", headers={"Accept-Encoding": "identity"}).headers["etag"] == '"abc"'
+
+    def test_static_resource_caches_compressed_body(self):
+        resource = StaticJSONResource(list(range(2000)))
+        scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+        resource.response(Request(scope))
+        assert gzip.decompress(resource._encoded["gzip"]) == resource.body
+
+
+class _Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class InMemoryRedis:
+    """Stand-in for the redis.asyncio calls the rate limit store makes"""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.fail = False
+
+    def pipeline(self, transaction=True):
+        redis, commands = self, []
+
+        class Pipeline:
+            def get(self, key):
+                commands.append(lambda: redis.data.get(key))
+
+            def incr(self, key):
+                def run():
+                    redis.data[key] = redis.data.get(key, 0) + 1
+                    return redis.data[key]
+                commands.append(run)
+
+            def expire(self, key, seconds):
+                commands.append(lambda: redis.expiry.__setitem__(key, seconds))
+
+            async def execute(self):
+                if redis.fail:
+                    raise ConnectionError("redis down")
+                return [command() for command in commands]
+
+        return Pipeline()
+
+    async def decr(self, key):
+        self.data[key] -= 1
+        return self.data[key]
+
+
+class TestRateLimit:
+
+    def test_limit_then_retry_after(self):
+        clock = _Clock()
+        limiter = RateLimiter(limit=3, window_seconds=60, clock=clock)
+        decisions = [asyncio.run(limiter.check("a")) for _ in range(5)]
+        assert [d.allowed for d in decisions] == [True, True, True, False, False]
+        assert decisions[0].remaining == 2
+        assert 1 <= decisions[3].retry_after <= 60
+        # Other clients are unaffected
+        assert asyncio.run(limiter.check("b")).allowed
+
+    def test_previous_window_slides_out(self):
+        """Rejected requests aren't counted, and the previous window's weight decays"""
+        clock = _Clock(now=60 * 1000)
+        limiter = RateLimiter(limit=10, window_seconds=60, clock=clock)
+        for _ in range(12):
+            asyncio.run(limiter.check("a"))
+        clock.now += 60  # start of the next window: all 10 accepted requests still weigh fully
+        rejected = asyncio.run(limiter.check("a"))
+        assert not rejected.allowed
+        clock.now += rejected.retry_after
+        assert asyncio.run(limiter.check("a")).allowed
+
+    def test_memory_store_evicts_idle_clients(self):
+        store = MemoryRateLimitStore(max_clients=50)
+        for i in range(200):
+            asyncio.run(store.increment(f"client-{i}", 1, 60))
+        assert len(store) == 50
+        asyncio.run(store.increment("late", 5, 60))
+        assert len(store) == 1
+
+    def test_redis_store_shares_limit_across_workers(self):
+        redis = InMemoryRedis()
+        clock = _Clock()
+        workers = [RateLimiter(limit=4, window_seconds=60, store=RedisRateLimitStore(redis), clock=clock) for _ in range(2)]
+        allowed = [asyncio.run(workers[i % 2].check("a")).allowed for i in range(6)]
+        assert allowed == [True] * 4 + [False] * 2
+        assert set(redis.expiry.values()) == {120}
+
+        redis.fail = True
+        assert asyncio.run(workers[0].check("b")).allowed
+
+    def test_middleware_rejects_with_429(self):
+        async def ok(request):
+            return FastJSONResponse({"ok": True})
+
+        app = Starlette(routes=[Route("/work", ok), Route("/health", ok)])
+        app.add_middleware(RateLimitMiddleware, limiter=RateLimiter(limit=2, window_seconds=60))
+        client = TestClient(app)
+
+        responses_ = [client.get("/work") for _ in range(3)]
+        assert [r.status_code for r in responses_] == [200, 200, 429]
+        assert responses_[0].headers["x-ratelimit-remaining"] == "1"
+        assert int(responses_[2].headers["retry-after"]) >= 1
+        assert responses_[2].json()["error"] == "Rate limit exceeded"
+        assert client.get("/health").status_code == 200
+        # A forged X-Forwarded-For from an untrusted peer doesn't open a new bucket
+        assert client.get("/work", headers={"X-Forwarded-For": "10.0.0.9"}).status_code == 429
+
+    def test_client_address_trusts_only_configured_proxies(self):
+        """X-Forwarded-For is used behind trusted proxies only, from its rightmost untrusted hop"""
+        proxies = parse_trusted_proxies("10.0.0.0/8, 192.168.1.5, not-an-ip")
+        assert len(proxies) == 2
+
+        def scope(peer, *forwarded):
+            return {"client": (peer, 5000), "headers": [(b"x-forwarded-for", hop.encode()) for hop in forwarded]}
+
+        # Direct connection: the header is the client's own claim
+        assert client_address(scope("203.0.113.7", "1.2.3.4"), proxies) == "203.0.113.7"
+        assert client_address(scope("203.0.113.7", "1.2.3.4"), ()) == "203.0.113.7"
+        # Spoofed leftmost hops are skipped; the hop our proxies added is used
+        assert client_address(scope("10.1.2.3", "6.6.6.6, 198.51.100.4"), proxies) == "198.51.100.4"
+        assert client_address(scope("10.1.2.3", "6.6.6.6, 198.51.100.4, 192.168.1.5"), proxies) == "198.51.100.4"
+        assert client_address(scope("10.1.2.3", "6.6.6.6", "198.51.100.4"), proxies) == "198.51.100.4"
+        # Trusted peer without the header, or only trusted hops
+        assert client_address(scope("10.1.2.3"), proxies) == "10.1.2.3"
+        assert client_address(scope("10.1.2.3", "10.9.9.9"), proxies) == "10.9.9.9"
+
+    def test_internal_calls_count_against_the_end_client(self):
+        """Callers holding the internal token are keyed by the client they forward"""
+        headers = internal_client_headers("198.51.100.4", token="s3cret")
+        scope = {"client": ("10.0.0.2", 5000), "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()]}
+        assert client_address(scope, (), internal_token="s3cret") == "198.51.100.4"
+        # Wrong or unconfigured token: the forwarded identity is ignored
+        assert client_address(scope, (), internal_token="other") == "10.0.0.2"
+        assert client_address(scope, (), internal_token="") == "10.0.0.2"
+        assert internal_client_headers("198.51.100.4", token="") == {}
+
+
+class TestAudit:
+
+    def test_flush_writes_batched_records(self, tmp_path):
+        audit = AuditLog(str(tmp_path / "audit" / "audit.db"), "test-api", batch_size=2)
+        audit.record("prediction", symptom_mask=(1 << 100) | 5, top_k=[("Migraine", 81.5)], urgency="Low",
+                     model_version="abc", latency_ms=1.23456)
+        audit.record("referral", lat=3.8, lon=11.5, facilities=[7, 3])
+        audit.record("prediction", urgency="High")
+        assert audit.flush() == 3
+
+        records = audit.query()
+        assert [r["kind"] for r in records] == ["prediction", "referral", "prediction"]
+        assert records[1]["facilities"] == [7, 3]
+        oldest = records[2]
+        assert int(oldest["symptom_mask"], 16) == (1 << 100) | 5
+        assert oldest["top_k"] == [["Migraine", 81.5]]
+        assert oldest["service"] == "test-api"
+        assert oldest["latency_ms"] == 1.235
+        assert [r["kind"] for r in audit.query(kind="referral")] == ["referral"]
+        audit.close()
+
+    def test_overflow_drops_oldest_and_counts(self, tmp_path):
+        audit = AuditLog(str(tmp_path / "audit.db"), "test-api", capacity=3)
+        for i in range(5):
+            audit.record("prediction", latency_ms=i)
+        assert audit.stats()["dropped"] == 2
+        audit.flush()
+        assert [r["latency_ms"] for r in audit.query()] == [4, 3, 2]
+        audit.close()
+
+    def test_failed_flush_is_retried_and_bad_records_skipped(self, tmp_path):
+        def unavailable():
+            raise sqlite3.OperationalError("disk I/O error")
+
+        audit = AuditLog(str(tmp_path / "audit.db"), "test-api")
+        audit._ensure_schema = unavailable
+        audit.record("prediction", facilities=["not an id"])
+        audit.record("prediction", urgency="Low")
+        assert audit.flush() == 0
+        assert audit.stats()["flush_errors"] == 1
+        assert audit.stats()["invalid"] == 1
+        assert audit.stats()["buffered"] == 1
+
+        del audit._ensure_schema
+        assert audit.flush() == 1
+        assert audit.query()[0]["urgency"] == "Low"
+        audit.close()
+
+    def test_background_writer_flushes_and_close_drains(self, tmp_path):
+        audit = AuditLog(str(tmp_path / "audit.db"), "test-api", batch_size=1, flush_interval=60)
+        audit.start()
+        audit.record("prediction")
+        deadline = time.time() + 5
+        while audit.written < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert audit.written == 1
+        audit.record("prediction")
+        audit.close()
+        assert audit.written == 2
+
+    def test_pool_bounds_open_connections(self, tmp_path):
+        pool = SQLiteConnectionPool(str(tmp_path / "pool.db"), size=1, timeout=0.05)
+        with pool.connection() as first:
+            with pytest.raises(TimeoutError):
+                with pool.connection():
+                    pass
+        with pool.connection() as second:
+            assert second is first
+        with pytest.raises(ZeroDivisionError):
+            with pool.transaction() as connection:
+                connection.execute("CREATE TABLE t (x)")
+                1 / 0
+        with pool.connection() as connection:
+            assert connection.execute("SELECT name FROM sqlite_master WHERE name = 't'").fetchall() == []
+        pool.close()
+
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class TestExecution:
+
+    def test_sheds_beyond_queue_and_endpoint_limits(self):
+        executor = CPUExecutor(workers=1, queue_size=2, endpoint_limits={"/batch": 1})
+        release = threading.Event()
+
+        async def scenario():
+            running = [asyncio.ensure_future(executor.run("/predict", release.wait)) for _ in range(2)]
+            batch = asyncio.ensure_future(executor.run("/batch", release.wait))
+            await asyncio.sleep(0.05)
+            with pytest.raises(Overloaded) as full:
+                await executor.run("/predict", release.wait)
+            stats = executor.stats()
+            release.set()
+            await asyncio.gather(*running, batch)
+            return full.value, stats
+
+        overloaded, stats = asyncio.run(scenario())
+        assert overloaded.status_code == 503
+        assert int(overloaded.headers["Retry-After"]) >= 1
+        assert stats["pending"] == 3
+        assert stats["rejected"] == {"/predict": 1}
+        assert executor.stats()["pending"] == 0
+
+        async def second_batch():
+            release.clear()
+            first = asyncio.ensure_future(executor.run("/batch", release.wait))
+            await asyncio.sleep(0.05)
+            with pytest.raises(Overloaded):
+                await executor.run("/batch", release.wait)
+            # Other endpoints still have room while the batch holds its share
+            release.set()
+            await asyncio.gather(first, executor.run("/predict", len, "ok"))
+
+        asyncio.run(second_batch())
+        executor.shutdown()
+
+    def test_weighted_calls_share_an_endpoint_limit(self):
+        """Small batches fit alongside each other; only the units they carry count"""
+        executor = CPUExecutor(workers=1, queue_size=16, endpoint_limits={"/batch": 10})
+        release = threading.Event()
+
+        async def scenario():
+            small = [asyncio.ensure_future(executor.run_weighted("/batch", 3, release.wait)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            with pytest.raises(Overloaded):
+                await executor.run_weighted("/batch", 3, release.wait)
+            last = asyncio.ensure_future(executor.run_weighted("/batch", 1, release.wait))
+            await asyncio.sleep(0.05)
+            stats = executor.stats()
+            release.set()
+            await asyncio.gather(*small, last)
+            # Heavier than the whole limit: charged the limit, so it runs alone
+            return stats, await executor.run_weighted("/batch", 500, len, "ok")
+
+        stats, result = asyncio.run(scenario())
+        assert stats["active"] == {"/batch": 10}
+        assert stats["pending"] == 4
+        assert result == 2
+        assert executor.stats()["active"] == {}
+        executor.shutdown()
+
+    def test_runs_in_callers_context(self):
+        executor = CPUExecutor(workers=2)
+
+        async def scenario():
+            _request_id.set("req-42")
+            return await executor.run("/predict", lambda: (_request_id.get(), threading.current_thread().name))
+
+        request_id, thread = asyncio.run(scenario())
+        assert request_id == "req-42"
+        assert thread.startswith("cpu-worker")
+        executor.shutdown()
+
+    def test_overloaded_handler_and_health_fast_path(self):
+        from fastapi import FastAPI
+
+        executor = CPUExecutor(workers=1, queue_size=0)
+        release = threading.Event()
+        app = FastAPI()
+
+        @app.get("/work")
+        async def work():
+            return {"done": await executor.run("/work", release.wait, 5)}
+
+        app.add_middleware(HealthCheckMiddleware, status=lambda: {"status": "healthy", **executor.stats()})
+        client = TestClient(app)
+
+        blocked = threading.Thread(target=client.get, args=("/work",))
+        blocked.start()
+        deadline = time.time() + 5
+        while executor.pending == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        shed = client.get("/work")
+        health = client.get("/health")
+        release.set()
+        blocked.join()
+
+        assert shed.status_code == 503
+        assert shed.headers["retry-after"] == "1"
+        assert health.status_code == 200
+        assert health.json()["pending"] == 1
+        assert client.head("/health").content == b""
+        executor.shutdown()
+
+    def test_parse_endpoint_limits(self):
+        assert parse_endpoint_limits("/predict=4, /batch=0,bad,/x=y") == {"/predict": 4, "/batch": 1}